@@ -19,6 +19,8 @@ options = Options()
 options.debug = False
 options.verbose = False
 options.min_buffer_time = 0.0
+options.use_mp4dump = False
+options.analysis_cache = None
 options.exec_dir = path.join(SCRIPT_PATH, 'bin', platform)
 
 class Sidx(object): pass
@@ -0,0 +1,548 @@
+#! /usr/bin/env python3
+
+__author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
+__copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
+
+###
+# Benchmark for the Python packaging layer.
+# Compares the built-in atom parser with the mp4dump based analysis
+# of fragmented MP4 files, and checks that both produce the same tables.
+# With --suite, measures the analysis, bandwidth computation, track selection
+# and manifest generation stages on a synthetic corpus of fragmented MP4 files
+# with an increasing number of segments, and compares the results with a
+# baseline saved by a previous run.
+# With --memory-check, checks that the peak memory of the analysis of a
+# synthetic file with many fragments stays below a fixed ceiling, and does
+# not grow with the number of samples.
+# With --check-bandwidth, checks the bandwidth computations on random inputs,
+# against the original quadratic ComputeBandwidth and a brute-force sliding
+# window computation.
+
+from optparse import OptionParser
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import os.path as path
+from mp4utils import Mp4File, MediaSource, ComputeBandwidth, ComputeSlidingWindowBandwidth, GetPeakRss, PrintErrorAndExit
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+# setup main options
+VERSION = "1.0.0"
+SDK_REVISION = '641'
+SCRIPT_PATH = path.abspath(path.dirname(__file__))
+sys.path += [SCRIPT_PATH]
+
+BENCHMARK_RESULTS_VERSION = 1
+
+# mp4-dash.py configurations of the suite, with the stages they measure
+SUITE_CONFIGURATIONS = [
+    ('template', ['--hls'],                  ['SelectTracks', 'OutputDash', 'OutputHls']),
+    ('timeline', ['--use-segment-timeline'], ['OutputDash']),
+    ('list',     ['--use-segment-list'],     ['OutputDash']),
+    ('smooth',   ['--smooth'],               ['OutputSmooth'])
+]
+
+#############################################
+def GetTrackTables(mp4_file):
+    tables = {}
+    for track in mp4_file.tracks.values():
+        tables[track.id] = (list(track.moofs),
+                            list(track.sample_counts),
+                            list(track.segment_offsets),
+                            list(track.segment_lengths),
+                            list(track.segment_sizes),
+                            list(track.segment_scaled_durations),
+                            list(track.segment_bitrates),
+                            list(track.segment_iframe_offsets),
+                            list(track.segment_iframe_sizes),
+                            track.timescale,
+                            track.bandwidth,
+                            track.key_info.get('kid'))
+    return tables
+
+#############################################
+def RunAnalysis(options, filename, use_mp4dump, measure_memory=True):
+    # (tracing the memory allocations slows the analysis down a lot)
+    options.use_mp4dump = use_mp4dump
+    media_source = MediaSource(options, filename)
+
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(options.iterations):
+        options.min_buffer_time = 0.0 # this gets updated by the analysis
+        mp4_file = Mp4File(options, media_source)
+    elapsed = (time.perf_counter()-start)/options.iterations
+    peak_memory = 0
+    if measure_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return (elapsed, peak_memory, mp4_file)
+
+#############################################
+def BenchmarkAnalysis(options, filename):
+    print('Analyzing', filename)
+    results = {}
+    for (name, use_mp4dump) in [('native', False), ('mp4dump', True)]:
+        results[name] = RunAnalysis(options, filename, use_mp4dump)
+        (elapsed, peak_memory, _) = results[name]
+        print('  {:8}: {:9.3f} ms, peak memory {:9.1f} kB'.format(name, 1000.0*elapsed, peak_memory/1024.0))
+
+    if GetTrackTables(results['native'][2]) != GetTrackTables(results['mp4dump'][2]):
+        PrintErrorAndExit('ERROR: the native and mp4dump analysis results differ for '+filename)
+    if results['native'][0]:
+        print('  speedup : {:9.1f}x'.format(results['mp4dump'][0]/results['native'][0]))
+
+#############################################
+# Synthetic corpus
+#
+# The files have one video track (AVC, 640x360) and audio tracks (AAC), with
+# one fragment per track for each segment, and random sample sizes (with a
+# fixed seed, so that the same parameters always produce the same file). The
+# media data is all zeros, only the structure of the files matters here.
+#############################################
+SYNTHETIC_AVC_SPS = bytes.fromhex('6742c01ed9005005bb011000000300100000030300f162e480')
+SYNTHETIC_AVC_PPS = bytes.fromhex('68cb83cb20')
+SYNTHETIC_VIDEO_TIMESCALE = 90000
+SYNTHETIC_AUDIO_TIMESCALE = 48000
+
+def MakeAtom(type, payload):
+    return struct.pack('>I4s', 8+len(payload), type)+payload
+
+def MakeFullAtom(type, version, flags, payload):
+    return MakeAtom(type, struct.pack('>I', (version << 24) | flags)+payload)
+
+def MakeSampleEntry(track_type):
+    if track_type == 'video':
+        avcc = MakeAtom(b'avcC', bytes([1, 0x42, 0xC0, 0x1E, 0xFF, 0xE1])+struct.pack('>H', len(SYNTHETIC_AVC_SPS))+SYNTHETIC_AVC_SPS+
+                                 bytes([1])+struct.pack('>H', len(SYNTHETIC_AVC_PPS))+SYNTHETIC_AVC_PPS)
+        return MakeAtom(b'avc1', bytes(6)+struct.pack('>H', 1)+bytes(16)+struct.pack('>HHIIIH', 640, 360, 0x480000, 0x480000, 0, 1)+
+                                 bytes(32)+struct.pack('>Hh', 24, -1)+avcc)
+    else:
+        decoder_specific_info = bytes([5, 2, 0x11, 0x90]) # AAC-LC, 48kHz, stereo
+        decoder_config = bytes([4, 13+len(decoder_specific_info), 0x40, 0x15, 0, 0, 0])+struct.pack('>II', 128000, 128000)+decoder_specific_info
+        es_descriptor = bytes([3, 3+len(decoder_config)+3])+struct.pack('>HB', 1, 0)+decoder_config+bytes([6, 1, 2])
+        return MakeAtom(b'mp4a', bytes(6)+struct.pack('>H', 1)+bytes(8)+struct.pack('>HHHHI', 2, 16, 0, 0, SYNTHETIC_AUDIO_TIMESCALE << 16)+
+                                 MakeFullAtom(b'esds', 0, 0, es_descriptor))
+
+def MakeTrak(track_id, track_type, timescale):
+    width_height = struct.pack('>II', 640 << 16, 360 << 16) if track_type == 'video' else bytes(8)
+    tkhd = MakeFullAtom(b'tkhd', 0, 7, struct.pack('>IIIII', 0, 0, track_id, 0, 0)+bytes(8)+
+                                       struct.pack('>hhhH', 0, 0, 0x100 if track_type == 'audio' else 0, 0)+
+                                       struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)+width_height)
+    mdhd = MakeFullAtom(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, timescale, 0, 0x55C4, 0)) # language 'und'
+    hdlr = MakeFullAtom(b'hdlr', 0, 0, struct.pack('>I4s', 0, b'vide' if track_type == 'video' else b'soun')+bytes(12)+b'\0')
+    if track_type == 'video':
+        media_header = MakeFullAtom(b'vmhd', 0, 1, bytes(8))
+    else:
+        media_header = MakeFullAtom(b'smhd', 0, 0, bytes(4))
+    dinf = MakeAtom(b'dinf', MakeFullAtom(b'dref', 0, 0, struct.pack('>I', 1)+MakeFullAtom(b'url ', 0, 1, b'')))
+    stbl = MakeAtom(b'stbl', MakeFullAtom(b'stsd', 0, 0, struct.pack('>I', 1)+MakeSampleEntry(track_type))+
+                             MakeFullAtom(b'stts', 0, 0, bytes(4))+
+                             MakeFullAtom(b'stsc', 0, 0, bytes(4))+
+                             MakeFullAtom(b'stsz', 0, 0, bytes(8))+
+                             MakeFullAtom(b'stco', 0, 0, bytes(4)))
+    return MakeAtom(b'trak', tkhd+MakeAtom(b'mdia', mdhd+hdlr+MakeAtom(b'minf', media_header+dinf+stbl)))
+
+def MakeSyntheticMp4(filename, segment_count, segment_duration=2.0, track_count=2, samples_per_segment=8, sample_size=32, seed=1):
+    generator = random.Random(seed)
+    tracks = [] # (track ID, type, timescale, sample duration)
+    for i in range(track_count):
+        track_type = 'video' if i == 0 else 'audio'
+        timescale = SYNTHETIC_VIDEO_TIMESCALE if track_type == 'video' else SYNTHETIC_AUDIO_TIMESCALE
+        tracks.append((i+1, track_type, timescale, int(segment_duration*timescale/samples_per_segment)))
+
+    with open(filename, 'wb') as mp4_file:
+        mp4_file.write(MakeAtom(b'ftyp', b'iso6'+struct.pack('>I', 1)+b'iso6mp41'))
+        mvhd = MakeFullAtom(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, 1000, 0, 0x10000, 0x100)+bytes(10)+
+                                           struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)+bytes(24)+
+                                           struct.pack('>I', track_count+1))
+        traks = b''.join([MakeTrak(track_id, track_type, timescale) for (track_id, track_type, timescale, _) in tracks])
+        mvex = MakeAtom(b'mvex', b''.join([MakeFullAtom(b'trex', 0, 0, struct.pack('>IIIII', track_id, 1, sample_duration, 0,
+                                                                                   0x10000 if track_type == 'video' else 0)) # sample_is_non_sync_sample
+                                           for (track_id, track_type, _, sample_duration) in tracks]))
+        mp4_file.write(MakeAtom(b'moov', mvhd+traks+mvex))
+
+        sequence_number = 1
+        for segment_index in range(segment_count):
+            for (track_id, track_type, _, sample_duration) in tracks:
+                sizes = [generator.randint(sample_size//2, 3*sample_size//2) for _ in range(samples_per_segment)]
+                if track_type == 'video':
+                    # the first sample is a larger sync sample
+                    sizes[0] *= 8
+                    trun_flags = 0x000205 # data-offset, first-sample-flags, sample-size
+                    first_sample_flags = struct.pack('>I', 0x02000000) # sample_depends_on=2
+                else:
+                    trun_flags = 0x000201 # data-offset, sample-size
+                    first_sample_flags = b''
+                tfhd = MakeFullAtom(b'tfhd', 0, 0x020008, struct.pack('>II', track_id, sample_duration)) # default-base-is-moof, default-sample-duration
+                tfdt = MakeFullAtom(b'tfdt', 1, 0, struct.pack('>Q', segment_index*samples_per_segment*sample_duration))
+                trun_size = 12+8+len(first_sample_flags)+4*samples_per_segment
+                moof_size = 8+16+8+len(tfhd)+len(tfdt)+trun_size
+                trun = MakeFullAtom(b'trun', 0, trun_flags, struct.pack('>Ii', samples_per_segment, moof_size+8)+first_sample_flags+
+                                                            struct.pack('>%dI' % samples_per_segment, *sizes))
+                moof = MakeAtom(b'moof', MakeFullAtom(b'mfhd', 0, 0, struct.pack('>I', sequence_number))+MakeAtom(b'traf', tfhd+tfdt+trun))
+                mp4_file.write(moof)
+                mp4_file.write(MakeAtom(b'mdat', bytes(sum(sizes))))
+                sequence_number += 1
+
+#############################################
+# Benchmark suite
+#############################################
+def GetCorpusFilename(options, segment_count, samples_per_segment=None):
+    return path.join(options.corpus_dir, 'synthetic-{}-{}-{}-{}-{}.mp4'.format(segment_count,
+                                                                                options.segment_duration,
+                                                                                options.tracks,
+                                                                                samples_per_segment or options.samples_per_segment,
+                                                                                options.sample_size))
+
+def MakeCorpusFile(options, segment_count, samples_per_segment=None):
+    filename = GetCorpusFilename(options, segment_count, samples_per_segment)
+    if not path.exists(filename):
+        print('Generating', filename)
+        MakeSyntheticMp4(filename, segment_count, options.segment_duration, options.tracks, samples_per_segment or options.samples_per_segment, options.sample_size)
+    return filename
+
+def UseCorpusDir(options):
+    # returns True if the corpus directory is a temporary one
+    if options.corpus_dir is None:
+        options.corpus_dir = tempfile.mkdtemp(prefix='mp4-bench-corpus-')
+        return True
+    if not path.exists(options.corpus_dir):
+        os.makedirs(options.corpus_dir)
+    return False
+
+def RunPackager(options, filename, arguments):
+    # run mp4-dash.py without producing any media, and return the duration of its stages
+    output_dir = tempfile.mkdtemp(prefix='mp4-bench-')
+    trace_filename = path.join(output_dir, 'trace.json')
+    try:
+        subprocess.check_output([sys.executable, path.join(SCRIPT_PATH, 'mp4-dash.py'),
+                                 '--no-media', '--force', '--jobs=1',
+                                 '--exec-dir', options.exec_dir,
+                                 '--trace', trace_filename,
+                                 '--output-dir', path.join(output_dir, 'output')]+arguments+[filename],
+                                stderr=subprocess.STDOUT)
+        with open(trace_filename) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+    except subprocess.CalledProcessError as e:
+        raise Exception('mp4-dash.py failed: '+e.output.decode('utf-8', 'replace'))
+    finally:
+        shutil.rmtree(output_dir)
+
+    durations = {}
+    for event in events:
+        if event['cat'] == 'stage':
+            durations[event['name']] = durations.get(event['name'], 0.0)+event['dur']/1000000.0
+    return durations
+
+def BenchmarkSegmentCount(options, segment_count):
+    filename = MakeCorpusFile(options, segment_count)
+    print('Benchmarking', segment_count, 'segments')
+
+    results = {}
+    def add_result(name, elapsed):
+        results['{}/{}'.format(segment_count, name)] = elapsed
+        print('  {:24}: {:10.3f} ms'.format(name, 1000.0*elapsed))
+
+    (elapsed, _, mp4_file) = RunAnalysis(options, filename, False, measure_memory=False)
+    add_result('Mp4File', elapsed)
+
+    start = time.perf_counter()
+    for i in range(options.iterations):
+        for track in mp4_file.tracks.values():
+            ComputeBandwidth(options.min_buffer_time, track.segment_sizes, track.segment_durations)
+    add_result('ComputeBandwidth', (time.perf_counter()-start)/options.iterations)
+
+    for (configuration, arguments, stages) in SUITE_CONFIGURATIONS:
+        totals = dict([(stage, 0.0) for stage in stages])
+        for i in range(options.iterations):
+            durations = RunPackager(options, filename, arguments)
+            for stage in stages:
+                totals[stage] += durations.get(stage, 0.0)
+        for stage in stages:
+            add_result(stage if stage == 'SelectTracks' else stage+'/'+configuration, totals[stage]/options.iterations)
+
+    return results
+
+def CompareWithBaseline(options, results):
+    with open(options.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get('version') != BENCHMARK_RESULTS_VERSION:
+        raise Exception('unsupported baseline file version')
+    if baseline.get('corpus') != results['corpus']:
+        sys.stderr.write('WARNING: the baseline was measured on a different corpus\n')
+
+    print('Comparing with', options.baseline)
+    regressions = []
+    for (name, elapsed) in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        baseline_elapsed = baseline['results'][name]
+        ratio = elapsed/baseline_elapsed if baseline_elapsed else 1.0
+        # ignore differences that are below the timer noise
+        regression = ratio > 1.0+options.tolerance and elapsed-baseline_elapsed > 0.001
+        print('  {:32}: {:10.3f} ms -> {:10.3f} ms ({:+6.1f}%){}'.format(name, 1000.0*baseline_elapsed, 1000.0*elapsed,
+                                                                       100.0*(ratio-1.0), '  REGRESSION' if regression else ''))
+        if regression:
+            regressions.append(name)
+    return regressions
+
+def RunSuite(options):
+    segment_counts = [int(count) for count in options.segment_counts.split(',')]
+    temporary_corpus = UseCorpusDir(options)
+
+    results = {'version':  BENCHMARK_RESULTS_VERSION,
+               'python':   platform.python_version(),
+               'platform': platform.platform(),
+               'corpus':   {'segment_duration':    options.segment_duration,
+                            'tracks':              options.tracks,
+                            'samples_per_segment': options.samples_per_segment,
+                            'sample_size':         options.sample_size},
+               'results':  {}}
+    try:
+        for segment_count in segment_counts:
+            results['results'].update(BenchmarkSegmentCount(options, segment_count))
+    finally:
+        if temporary_corpus:
+            shutil.rmtree(options.corpus_dir)
+
+    if options.save:
+        with open(options.save, 'w') as results_file:
+            json.dump(results, results_file, indent=1, sort_keys=True)
+
+    if options.baseline:
+        regressions = CompareWithBaseline(options, results)
+        if regressions:
+            PrintErrorAndExit('ERROR: {} benchmark(s) slower than the baseline by more than {:.0f}%'.format(len(regressions), 100.0*options.tolerance))
+
+#############################################
+# Memory check
+#
+# The analysis runs in a new process, so that its peak resident memory is
+# that of the analysis alone. The same file structure is analyzed with more
+# samples per fragment, to check that the memory does not grow with them.
+#############################################
+MEMORY_CHECK_SAMPLE_FACTOR = 8 # the second file has this many times more samples per fragment
+
+def AnalyzeInNewProcess(options, filename, connection):
+    Mp4File(options, MediaSource(options, filename))
+    connection.send(GetPeakRss(resource.getrusage(resource.RUSAGE_SELF)))
+
+def MeasureAnalysisPeakRss(options, filename):
+    context = multiprocessing.get_context('spawn')
+    (connection, sender) = context.Pipe(duplex=False)
+    process = context.Process(target=AnalyzeInNewProcess, args=(options, filename, sender))
+    process.start()
+    sender.close()
+    try:
+        peak_rss = connection.recv()
+    except EOFError:
+        raise Exception('the analysis of '+filename+' failed')
+    finally:
+        process.join()
+    return peak_rss
+
+def RunMemoryCheck(options):
+    if resource is None:
+        raise Exception('--memory-check is not supported on this platform')
+    temporary_corpus = UseCorpusDir(options)
+    peaks = []
+    try:
+        for samples_per_segment in [options.samples_per_segment, MEMORY_CHECK_SAMPLE_FACTOR*options.samples_per_segment]:
+            filename = MakeCorpusFile(options, options.memory_check_segments, samples_per_segment)
+            peak_rss = MeasureAnalysisPeakRss(options, filename)
+            print('  {} segments, {:4} samples per fragment: peak memory {:9.1f} MB'.format(options.memory_check_segments, samples_per_segment, peak_rss/(1024.0*1024.0)))
+            peaks.append(peak_rss)
+    finally:
+        if temporary_corpus:
+            shutil.rmtree(options.corpus_dir)
+
+    if max(peaks) > options.max_rss*1024*1024:
+        PrintErrorAndExit('ERROR: the peak memory of the analysis is above {} MB'.format(options.max_rss))
+    if peaks[1] > peaks[0]*(1.0+options.tolerance):
+        PrintErrorAndExit('ERROR: the peak memory of the analysis grows with the number of samples (by more than {:.0f}%)'.format(100.0*options.tolerance))
+    print('Memory check passed')
+
+#############################################
+# Bandwidth check
+#
+# ComputeBandwidth must give the same result as the original implementation,
+# which checks every window, and ComputeSlidingWindowBandwidth the max of
+# 8*size/(buffer_time+duration) over all the windows.
+#############################################
+BANDWIDTH_CHECK_SEED = 1
+
+def ComputeBaselineBandwidth(buffer_time, sizes, durations):
+    # original implementation of ComputeBandwidth
+    bandwidth = 0.0
+    for i in range(len(sizes)):
+        accu_size     = 0
+        accu_duration = 0
+        buffer_size = (buffer_time*bandwidth)/8.0
+        for j in range(i, len(sizes)):
+            accu_size     += sizes[j]
+            accu_duration += durations[j]
+            max_avail = buffer_size+accu_duration*bandwidth/8.0
+            if accu_size > max_avail and accu_duration != 0:
+                bandwidth = 8.0*(accu_size-buffer_size)/accu_duration
+                break
+    return int(bandwidth)
+
+def ComputeBruteForceSlidingWindowBandwidth(buffer_time, sizes, durations):
+    bandwidth = 0.0
+    for i in range(len(sizes)):
+        accu_size     = 0
+        accu_duration = 0.0
+        for j in range(i, len(sizes)):
+            accu_size     += sizes[j]
+            accu_duration += durations[j]
+            if buffer_time+accu_duration > 0.0:
+                bandwidth = max(bandwidth, 8.0*accu_size/(buffer_time+accu_duration))
+    return int(bandwidth)
+
+def MakeBandwidthCheckInput(rnd):
+    # sizes and durations of segments or samples, with some spikes and some zero durations
+    count = rnd.randint(0, 64)
+    average_size = rnd.choice([10, 1000, 100000])
+    sizes = [int(rnd.expovariate(1.0/average_size)) for _ in range(count)]
+    for _ in range(rnd.randint(0, 3)):
+        if count:
+            sizes[rnd.randrange(count)] *= rnd.randint(2, 20)
+    if rnd.random() < 0.5:
+        duration = rnd.choice([0.02, 1.0/30, 2.0, 6.0])
+        durations = [duration]*count
+    else:
+        durations = [rnd.uniform(0.0, 4.0) for _ in range(count)]
+    for _ in range(rnd.randint(0, 2)):
+        if count:
+            durations[rnd.randrange(count)] = 0.0
+    buffer_time = rnd.choice([0.0, 0.5, 1.0, 2.0, 10.0, rnd.uniform(0.0, 5.0)])
+    return (buffer_time, sizes, durations)
+
+def RunBandwidthCheck(options):
+    rnd = random.Random(BANDWIDTH_CHECK_SEED)
+    failures = 0
+    for i in range(options.bandwidth_check_inputs):
+        (buffer_time, sizes, durations) = MakeBandwidthCheckInput(rnd)
+        for (name, function, reference) in [('ComputeBandwidth', ComputeBandwidth, ComputeBaselineBandwidth),
+                                            ('ComputeSlidingWindowBandwidth', ComputeSlidingWindowBandwidth, ComputeBruteForceSlidingWindowBandwidth)]:
+            result = function(buffer_time, sizes, durations)
+            expected = reference(buffer_time, sizes, durations)
+            if result != expected:
+                failures += 1
+                print('  {} = {} instead of {} for input {}'.format(name, result, expected, i))
+                if options.verbose:
+                    print('    buffer_time={!r} sizes={!r} durations={!r}'.format(buffer_time, sizes, durations))
+    if failures:
+        PrintErrorAndExit('ERROR: {} bandwidth computations differ from the reference'.format(failures))
+    print('Bandwidth check passed ({} inputs)'.format(options.bandwidth_check_inputs))
+
+#############################################
+Options = None
+def main():
+    # determine the platform binary name
+    host_platform = ''
+    if platform.system() == 'Linux':
+        if platform.processor() == 'x86_64':
+            host_platform = 'linux-x86_64'
+        else:
+            host_platform = 'linux-x86'
+    elif platform.system() == 'Darwin':
+        host_platform = 'macosx'
+    elif platform.system() == 'Windows':
+        host_platform = 'win32'
+    default_exec_dir = path.join(SCRIPT_PATH, 'bin', host_platform)
+    if not path.exists(default_exec_dir):
+        default_exec_dir = path.join(SCRIPT_PATH, 'bin')
+    if not path.exists(default_exec_dir):
+        default_exec_dir = path.join(SCRIPT_PATH, '..', 'bin')
+    if not path.exists(default_exec_dir):
+        default_exec_dir = '-'
+
+    # parse options
+    parser = OptionParser(usage="%prog [options] <media-file> [<media-file> ...]\n       %prog [options] --suite\n       %prog [options] --memory-check\n       %prog [options] --check-bandwidth",
+                          description="Each <media-file> is the path to a fragmented MP4 file. Version " + VERSION + " r" + SDK_REVISION)
+    parser.add_option('-v', '--verbose', dest="verbose", action='store_true', default=False,
+                      help="Be verbose")
+    parser.add_option('-d', '--debug', dest="debug", action='store_true', default=False,
+                      help="Print out debugging information")
+    parser.add_option('-n', '--iterations', dest="iterations", type="int", metavar="<count>", default=3,
+                      help="Number of times each measurement is repeated (default: 3)")
+    parser.add_option('', "--exec-dir", metavar="<exec_dir>", dest="exec_dir", default=default_exec_dir,
+                      help="Directory where the Bento4 executables are located (use '-' to look for executable in the current PATH)")
+    parser.add_option('', '--suite', dest="suite", action='store_true', default=False,
+                      help="Run the benchmark suite on a synthetic corpus, instead of comparing the analysis of the <media-file> files")
+    parser.add_option('', '--segment-counts', dest="segment_counts", metavar="<count>[,<count>...]", default='1000,10000,100000',
+                      help="Number of segments of the synthetic files of the suite (default: 1000,10000,100000)")
+    parser.add_option('', '--segment-duration', dest="segment_duration", metavar="<seconds>", type="float", default=2.0,
+                      help="Segment duration of the synthetic files (default: 2)")
+    parser.add_option('', '--tracks', dest="tracks", metavar="<count>", type="int", default=2,
+                      help="Number of tracks of the synthetic files: one video track, and audio tracks for the others (default: 2)")
+    parser.add_option('', '--samples-per-segment', dest="samples_per_segment", metavar="<count>", type="int", default=8,
+                      help="Number of samples in each segment of the synthetic files (default: 8)")
+    parser.add_option('', '--sample-size', dest="sample_size", metavar="<bytes>", type="int", default=32,
+                      help="Average sample size of the synthetic files (default: 32)")
+    parser.add_option('', '--corpus-dir', dest="corpus_dir", metavar="<dir>", default=None,
+                      help="Keep the synthetic files in <dir>, and reuse them on the next runs (default: use a temporary directory)")
+    parser.add_option('', '--save', dest="save", metavar="<filename>", default=None,
+                      help="Save the results of the suite to <filename>, in JSON, to use as a baseline later")
+    parser.add_option('', '--baseline', dest="baseline", metavar="<filename>", default=None,
+                      help="Compare the results of the suite with a baseline saved with --save, and fail if some of them are slower")
+    parser.add_option('', '--tolerance', dest="tolerance", metavar="<fraction>", type="float", default=0.25,
+                      help="Slowdown relative to the baseline above which a result is a regression, or growth of the peak memory above which --memory-check fails (default: 0.25)")
+    parser.add_option('', '--memory-check', dest="memory_check", action='store_true', default=False,
+                      help="Check that the peak memory of the analysis of a synthetic file stays below --max-rss, and does not grow with the number of samples")
+    parser.add_option('', '--memory-check-segments', dest="memory_check_segments", metavar="<count>", type="int", default=50000,
+                      help="Number of segments of the synthetic files of the memory check (default: 50000)")
+    parser.add_option('', '--max-rss', dest="max_rss", metavar="<megabytes>", type="float", default=192,
+                      help="Peak memory above which the memory check fails (default: 192)")
+    parser.add_option('', '--check-bandwidth', dest="bandwidth_check", action='store_true', default=False,
+                      help="Check the bandwidth computations against reference implementations, on random inputs")
+    parser.add_option('', '--check-bandwidth-inputs', dest="bandwidth_check_inputs", metavar="<count>", type="int", default=20000,
+                      help="Number of random inputs of the bandwidth check (default: 20000)")
+    (options, args) = parser.parse_args()
+    if not args and not options.suite and not options.memory_check and not options.bandwidth_check:
+        parser.print_help()
+        sys.exit(1)
+    if options.tracks < 1 or options.samples_per_segment < 1:
+        raise Exception('--tracks and --samples-per-segment must be at least 1')
+    global Options
+    Options = options
+
+    # set some mandatory options that utils rely upon
+    options.min_buffer_time = 0.0
+    options.use_mp4dump = False
+    options.analysis_cache = None
+
+    if options.suite:
+        RunSuite(options)
+    if options.memory_check:
+        RunMemoryCheck(options)
+    if options.bandwidth_check:
+        RunBandwidthCheck(options)
+    for filename in args:
+        BenchmarkAnalysis(options, filename)
+
+###########################
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as err:
+        if Options and Options.debug:
+            raise
+        else:
+            PrintErrorAndExit('ERROR: %s\n' % str(err))
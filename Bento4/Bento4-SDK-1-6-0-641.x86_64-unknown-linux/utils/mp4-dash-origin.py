@@ -0,0 +1,438 @@
+#! /usr/bin/env python3
+
+__author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
+__copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
+
+###
+# Just-in-time DASH/HLS origin: serves the manifests and the segments of
+# titles stored as fragmented MP4 files, without splitting them beforehand.
+#
+# A title is a directory under the root directory, with its fragmented MP4
+# files, and optionally a 'title.json' file with the same format as a job of
+# the mp4-dash.py --batch jobs file (sources relative to the title directory):
+#
+#   {"sources": ["video.mp4", "[type=audio]audio.mp4"], "options": {"hls": true}}
+#
+# Without 'title.json', all the .mp4 files of the directory are the sources.
+#
+# When a title is first requested, it is indexed by running mp4-dash.py with
+# --no-media, which writes the manifests and playlists of the split segment
+# layout ($RepresentationID$/seg-$Number$.m4s) to a cache directory. The
+# init segments are then made from the 'moov' of the source, and each media
+# segment is sent from the byte range of its fragments in the source file
+# (with sendfile), exactly as the built-in splitter would have written it.
+# The indexes of the most recently used titles are kept in memory, and a
+# title is indexed again when one of its sources changes. A title is indexed
+# without blocking the requests for the other titles, and the manifests of a
+# title that is evicted or indexed again are deleted once they are no longer
+# being served.
+
+from optparse import OptionParser
+import collections
+import concurrent.futures
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import os.path as path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mp4packaging import mp4dash, RaisePackagingError
+from mp4utils import ReadFileData, RebaseMoof, MakeSplitInitSegment, PrintErrorAndExit
+
+# setup main options
+VERSION = "1.0.0"
+SDK_REVISION = '641'
+SCRIPT_PATH = path.abspath(path.dirname(__file__))
+sys.path += [SCRIPT_PATH]
+
+DEFAULT_ADDRESS   = '127.0.0.1:8050'
+TITLE_CONFIG_NAME = 'title.json'
+
+# mp4-dash.py options that the origin sets for the titles
+ORIGIN_TITLE_OPTIONS = ['output-dir', 'no-media', 'force', 'batch', 'exec-dir']
+
+CONTENT_TYPES = {
+    '.mpd':  'application/dash+xml',
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.m4s':  'video/iso.segment',
+    '.mp4':  'video/mp4',
+    '.vtt':  'text/vtt'
+}
+
+#############################################
+class OriginRepresentation:
+    def __init__(self, track):
+        self.track    = track
+        self.filename = track.parent.media_source.filename
+
+        # first fragment of each segment, in the fragments of the track
+        self.segment_fragments = []
+        if track.fragment_moofs is None:
+            self.fragment_moofs = track.moofs
+            self.segment_fragments = [(i, 1) for i in range(len(track.moofs))]
+        else:
+            self.fragment_moofs = track.fragment_moofs
+            start = 0
+            for fragment_count in track.segment_fragment_counts:
+                self.segment_fragments.append((start, fragment_count))
+                start += fragment_count
+
+        # the fragments only need to be rewritten when they use absolute data offsets
+        with open(self.filename, 'rb') as source:
+            moof = track.parent.segments[self.fragment_moofs[0]][0] if len(self.fragment_moofs) else None
+            if moof:
+                moof_data = ReadFileData(source, moof.position, moof.size)
+                self.rebase = RebaseMoof(moof_data, 1) != moof_data
+            else:
+                self.rebase = False
+        self.init_segment = None
+
+    def get_init_segment(self):
+        if self.init_segment is None:
+            mp4_file = self.track.parent
+            with open(self.filename, 'rb') as source:
+                ftyp = b''
+                for atom in mp4_file.atoms:
+                    if atom.type == 'ftyp':
+                        ftyp = ReadFileData(source, atom.position, atom.size)
+                        break
+                moov = ReadFileData(source, mp4_file.init_segment.position, mp4_file.init_segment.size)
+            self.init_segment = MakeSplitInitSegment(ftyp, moov, self.track.id)
+        return self.init_segment
+
+    def get_segment_parts(self, number):
+        # the parts of a media segment: (filename, position, size) ranges of the source, or bytes
+        if number < 1 or number > len(self.segment_fragments):
+            return None
+        (start, fragment_count) = self.segment_fragments[number-1]
+        parts = []
+        segment_size = 0
+        with open(self.filename, 'rb') as source:
+            for fragment_index in range(start, start+fragment_count):
+                segment = self.track.parent.segments[self.fragment_moofs[fragment_index]]
+                moof = segment[0]
+                mdats = [atom for atom in segment if atom.type == 'mdat']
+                end = mdats[-1].position+mdats[-1].size if mdats else moof.position+moof.size
+                if self.rebase:
+                    parts.append(bytes(RebaseMoof(ReadFileData(source, moof.position, moof.size), moof.position-segment_size)))
+                    parts.append((self.filename, moof.position+moof.size, end-moof.position-moof.size))
+                elif parts and parts[-1][1]+parts[-1][2] == moof.position:
+                    parts[-1] = (self.filename, parts[-1][1], end-parts[-1][1])
+                else:
+                    parts.append((self.filename, moof.position, end-moof.position))
+                segment_size += end-moof.position
+        return parts
+
+class OriginTitle:
+    def __init__(self, options, title_dir, manifest_dir):
+        self.title_dir    = title_dir
+        self.manifest_dir = manifest_dir
+        self.references   = 0     # requests being served (see TitleCache)
+        self.removed      = False # no longer in the cache
+        config = GetTitleConfig(title_dir)
+        self.sources = [GetSourcePath(title_dir, source) for source in config['sources']]
+        for name in ORIGIN_TITLE_OPTIONS:
+            if name in config['options']:
+                raise Exception('the --'+name+' option is set by the origin')
+
+        # index the sources and write the manifests
+        parser = mp4dash.CreateOptionParser(options.exec_dir or mp4dash.GetDefaultExecDir())
+        parser.error = RaisePackagingError
+        arguments = mp4dash.GetOptionArguments(config['options'])+['--no-media', '--force', '--output-dir='+manifest_dir, '--']+self.sources
+        (title_options, args) = parser.parse_args(arguments)
+        if title_options.encryption_key or title_options.live:
+            raise Exception('encrypted and live titles cannot be served')
+        self.stats = self.get_stats()
+        try:
+            tracks = mp4dash.Package(title_options, args)
+        finally:
+            mp4dash.RemoveTempFiles(title_options)
+        if not title_options.split or title_options.on_demand or title_options.smooth or title_options.hippo or title_options.use_mp4split:
+            raise Exception('only the live profile with split segments can be served')
+
+        self.segment_pattern = re.compile('^'+re.escape(title_options.segment_url_pattern).replace(re.escape('%05d'), '([0-9]+)').replace(re.escape('%d'), '([0-9]+)')+'$')
+        self.representations = dict([(track.representation_id, OriginRepresentation(track)) for track in tracks
+                                     if track.type != 'subtitles' and track.parent.media_source.format == 'mp4'])
+        self.init_segment_name = mp4dash.SPLIT_INIT_SEGMENT_NAME
+
+    def get_stats(self):
+        stats = []
+        for source in self.sources:
+            filename = source.split(']', 1)[1] if source.startswith('[') else source
+            stat = os.stat(filename)
+            stats.append((filename, stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    def is_current(self):
+        try:
+            return self.get_stats() == self.stats
+        except OSError:
+            return False
+
+    def get_parts(self, name):
+        # the parts of a file of the title, or None if it does not exist
+        (representation_id, _, basename) = name.rpartition('/')
+        representation = self.representations.get(representation_id)
+        if representation:
+            if basename == self.init_segment_name:
+                return [representation.get_init_segment()]
+            match = self.segment_pattern.match(basename)
+            if match:
+                return representation.get_segment_parts(int(match.group(1)))
+
+        # manifests and playlists
+        filename = path.normpath(path.join(self.manifest_dir, name))
+        if filename.startswith(self.manifest_dir+os.sep) and path.isfile(filename):
+            return [(filename, 0, path.getsize(filename))]
+        return None
+
+def GetTitleConfig(title_dir):
+    config_filename = path.join(title_dir, TITLE_CONFIG_NAME)
+    if path.exists(config_filename):
+        with open(config_filename) as config_file:
+            config = json.load(config_file)
+        if not isinstance(config, dict) or not isinstance(config.get('sources'), list) or not config['sources']:
+            raise Exception(TITLE_CONFIG_NAME + ' does not have a list of sources')
+        if not isinstance(config.get('options', {}), dict):
+            raise Exception('the options of ' + TITLE_CONFIG_NAME + ' must be an object')
+        return {'sources': config['sources'], 'options': config.get('options', {})}
+    return {'sources': sorted([name for name in os.listdir(title_dir) if name.endswith('.mp4')]), 'options': {}}
+
+def GetSourcePath(title_dir, source):
+    # sources may have a [name=value,...] prefix
+    (prefix, filename) = ('', source)
+    if source.startswith('['):
+        (prefix, filename) = source.split(']', 1)
+        prefix += ']'
+    return prefix+path.join(title_dir, filename)
+
+def IsTitleDir(title_dir):
+    if not path.isdir(title_dir):
+        return False
+    return path.exists(path.join(title_dir, TITLE_CONFIG_NAME)) or any([name.endswith('.mp4') for name in os.listdir(title_dir)])
+
+#############################################
+class TitleCache:
+    # the indexes of the most recently used titles.
+    # The lock only protects the cache itself: a title is indexed outside of it, so only
+    # the requests for that title wait for the index, and each index has its own manifest
+    # directory, which is deleted when the title is removed from the cache and no request
+    # uses it anymore.
+    def __init__(self, options, cache_dir):
+        self.options   = options
+        self.cache_dir = cache_dir
+        self.titles    = collections.OrderedDict()
+        self.indexing  = {} # futures of the titles being indexed, by title directory
+        self.lock      = threading.Lock()
+
+        # remove the manifests left by a previous run
+        for name in os.listdir(cache_dir):
+            if re.match('^[0-9a-f]{40}-', name):
+                shutil.rmtree(path.join(cache_dir, name), ignore_errors=True)
+
+    def acquire(self, title_dir):
+        # the current index of a title, indexing it if needed (release it when done)
+        while True:
+            with self.lock:
+                title = self.titles.get(title_dir)
+                if title and title.is_current():
+                    self.titles.move_to_end(title_dir)
+                    title.references += 1
+                    return title
+                future = self.indexing.get(title_dir)
+                indexer = future is None
+                if indexer:
+                    future = concurrent.futures.Future()
+                    self.indexing[title_dir] = future
+            if indexer:
+                self.index(title_dir, future)
+            title = future.result() # raises the indexing error, if any
+            with self.lock:
+                if not title.removed:
+                    title.references += 1
+                    return title
+            # the title was evicted before it could be used, try again
+
+    def release(self, title):
+        with self.lock:
+            title.references -= 1
+            delete = title.removed and not title.references
+        if delete:
+            shutil.rmtree(title.manifest_dir, ignore_errors=True)
+
+    def index(self, title_dir, future):
+        manifest_dir = tempfile.mkdtemp(prefix=hashlib.sha1(title_dir.encode('utf-8')).hexdigest()+'-', dir=self.cache_dir)
+        if self.options.verbose:
+            print('Indexing', title_dir)
+        try:
+            title = OriginTitle(self.options, title_dir, manifest_dir)
+        except Exception as e:
+            shutil.rmtree(manifest_dir, ignore_errors=True)
+            with self.lock:
+                del self.indexing[title_dir]
+            future.set_exception(e)
+            return
+
+        with self.lock:
+            del self.indexing[title_dir]
+            removed = []
+            if title_dir in self.titles:
+                removed.append(self.titles.pop(title_dir))
+            self.titles[title_dir] = title
+            while len(self.titles) > self.options.cache_size:
+                removed.append(self.titles.popitem(last=False)[1])
+            for removed_title in removed:
+                removed_title.removed = True
+            deleted = [removed_title.manifest_dir for removed_title in removed if not removed_title.references]
+        for manifest_dir in deleted:
+            shutil.rmtree(manifest_dir, ignore_errors=True)
+        future.set_result(title)
+
+class OriginRequestHandler(BaseHTTPRequestHandler):
+    def find_title(self, url_path):
+        # the title is the first directory of the path that has sources
+        names = [name for name in url_path.split('/') if name]
+        if '..' in names:
+            return (None, None)
+        for i in range(1, len(names)):
+            title_dir = path.join(self.server.root_dir, *names[:i])
+            if IsTitleDir(title_dir):
+                return (title_dir, '/'.join(names[i:]))
+        return (None, None)
+
+    def send_parts(self, parts, name, head):
+        size = sum([len(part) if isinstance(part, bytes) else part[2] for part in parts])
+        (first, last) = (0, size-1)
+        range_header = self.headers.get('Range')
+        if range_header:
+            match = re.match(r'^bytes=([0-9]*)-([0-9]*)$', range_header.strip())
+            if match and (match.group(1) or match.group(2)):
+                if not match.group(1):
+                    first = max(0, size-int(match.group(2)))
+                else:
+                    first = int(match.group(1))
+                    if match.group(2):
+                        last = min(last, int(match.group(2)))
+            if not match or first > last:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(206 if range_header else 200)
+        self.send_header('Content-Type', CONTENT_TYPES.get(path.splitext(name)[1], mimetypes.guess_type(name)[0] or 'application/octet-stream'))
+        self.send_header('Content-Length', str(last-first+1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if range_header:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, size))
+        self.end_headers()
+        if head:
+            return
+
+        # send the requested range of each part
+        position = 0
+        for part in parts:
+            part_size = len(part) if isinstance(part, bytes) else part[2]
+            start = max(first, position)-position
+            end = min(last+1, position+part_size)-position
+            if start < end:
+                if isinstance(part, bytes):
+                    self.wfile.write(part[start:end])
+                else:
+                    with open(part[0], 'rb') as source:
+                        self.connection.sendfile(source, part[1]+start, end-start)
+            position += part_size
+
+    def handle_request(self, head):
+        url_path = self.path.split('?', 1)[0]
+        (title_dir, name) = self.find_title(url_path)
+        if title_dir is None:
+            self.send_error(404)
+            return
+        try:
+            title = self.server.titles.acquire(title_dir)
+        except Exception as e:
+            self.send_error(500, 'cannot index the title: '+str(e))
+            return
+        try:
+            parts = title.get_parts(name)
+            if parts is None:
+                self.send_error(404)
+                return
+            self.send_parts(parts, name, head)
+        finally:
+            self.server.titles.release(title)
+
+    def do_GET(self):
+        self.handle_request(False)
+
+    def do_HEAD(self):
+        self.handle_request(True)
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+#############################################
+Options = None
+def main():
+    # parse options
+    parser = OptionParser(usage="%prog [options] <root-dir>",
+                          description="Serves the titles of <root-dir> (one directory of fragmented MP4 files per title) as DASH and HLS. Version " + VERSION + " r" + SDK_REVISION)
+    parser.add_option('-v', '--verbose', dest="verbose", action='store_true', default=False,
+                      help="Be verbose")
+    parser.add_option('-d', '--debug', dest="debug", action='store_true', default=False,
+                      help="Print out debugging information")
+    parser.add_option('-a', '--address', dest="address", metavar="[<host>:]<port>", default=DEFAULT_ADDRESS,
+                      help="Address to listen on (default: "+DEFAULT_ADDRESS+")")
+    parser.add_option('', "--exec-dir", metavar="<exec_dir>", dest="exec_dir", default=None,
+                      help="Directory where the Bento4 executables are located")
+    parser.add_option('', '--cache-size', dest="cache_size", metavar="<count>", type="int", default=64,
+                      help="Number of titles whose index is kept in memory (default: 64)")
+    parser.add_option('', '--cache-dir', dest="cache_dir", metavar="<dir>", default=None,
+                      help="Directory where the manifests of the indexed titles are written (default: a temporary directory)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    global Options
+    Options = options
+
+    if options.cache_size < 1:
+        raise Exception('--cache-size must be at least 1')
+    if not path.isdir(args[0]):
+        raise Exception(args[0] + ' is not a directory')
+    cache_dir = options.cache_dir or tempfile.mkdtemp(prefix='mp4-dash-origin-')
+    if not path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    (host, port) = options.address.rsplit(':', 1) if ':' in options.address else ('127.0.0.1', options.address)
+    server = ThreadingHTTPServer((host, int(port)), OriginRequestHandler)
+    server.daemon_threads = True
+    server.options  = options
+    server.root_dir = path.abspath(args[0])
+    server.titles   = TitleCache(options, path.abspath(cache_dir))
+    print('Serving {} on http://{}:{}/'.format(server.root_dir, server.server_address[0], server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not options.cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+###########################
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as err:
+        if Options and Options.debug:
+            raise
+        else:
+            PrintErrorAndExit('ERROR: %s\n' % str(err))
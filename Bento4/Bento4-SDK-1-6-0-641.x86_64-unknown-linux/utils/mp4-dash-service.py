@@ -0,0 +1,564 @@
+#! /usr/bin/env python3
+
+__author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
+__copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
+
+###
+# Packaging service: a long-running process that packages titles with
+# mp4-dash.py, from a queue of jobs.
+#
+# Jobs are submitted through a small HTTP API on a local port, or by dropping
+# a JSON file in a spool directory, with the same format as a line of the
+# mp4-dash.py --batch jobs file:
+#
+#   {"id": "title-1", "sources": ["video.mp4", "audio.mp4"], "options": {"hls": true}}
+#
+# The queue is kept in a SQLite database, so the jobs survive a restart of the
+# service (the jobs that were running are queued again). Each job is packaged
+# in a process forked from the service, by a pool of workers, with limits on
+# the CPU time, wall time and output size of each job, and on the number of
+# threads it can use.
+#
+# HTTP API (JSON):
+#   POST   /jobs        submit a job, returns its id
+#   GET    /jobs        list the jobs (?status=<status> to filter them)
+#   GET    /jobs/<id>   status of a job, with its report (per-stage timings) when it is done
+#   DELETE /jobs/<id>   cancel a job
+#   GET    /stats       queue depth, workers and limits
+#
+# The same script is the client of the service: submit, status, list, cancel
+# and stats commands.
+
+from optparse import OptionParser
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import resource
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import os.path as path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mp4packaging import mp4dash
+from mp4utils import PrintErrorAndExit
+
+# setup main options
+VERSION = "1.0.0"
+SDK_REVISION = '641'
+SCRIPT_PATH = path.abspath(path.dirname(__file__))
+sys.path += [SCRIPT_PATH]
+
+DEFAULT_ADDRESS       = '127.0.0.1:8040'
+SERVICE_POLL_INTERVAL = 1.0 # seconds between two checks of the spool directory and of the limits of the running jobs
+JOB_ID_PATTERN        = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
+# job options that the service controls
+SERVICE_JOB_OPTIONS = ['output-dir', 'batch', 'batch-workers', 'batch-report', 'force', 'exec-dir']
+
+JOB_STATUSES = ['queued', 'running', 'cancelling', 'success', 'failure', 'cancelled']
+
+#############################################
+# Job queue
+#############################################
+class JobQueue:
+    def __init__(self, filename):
+        # the queue is used from the service loop and from the threads of the HTTP server
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, sources TEXT, options TEXT, origin TEXT, status TEXT, '
+                                    'submitted REAL, started REAL, finished REAL, report TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+    def get_record(self, row):
+        record = {'id':        row['id'],
+                  'sources':   json.loads(row['sources']),
+                  'options':   json.loads(row['options']),
+                  'origin':    row['origin'],
+                  'status':    row['status'],
+                  'submitted': row['submitted'],
+                  'started':   row['started'],
+                  'finished':  row['finished']}
+        if row['report']:
+            record['report'] = json.loads(row['report'])
+        return record
+
+    def add(self, job, origin):
+        with self.lock, self.connection:
+            if self.connection.execute('SELECT id FROM jobs WHERE id=?', (job['id'],)).fetchone():
+                raise ValueError('a job with id "'+job['id']+'" already exists')
+            self.connection.execute('INSERT INTO jobs (id, sources, options, origin, status, submitted) VALUES (?, ?, ?, ?, ?, ?)',
+                                    (job['id'], json.dumps(job['sources']), json.dumps(job['options']), origin, 'queued', time.time()))
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM jobs WHERE id=?', (job_id,)).fetchone()
+        return self.get_record(row) if row else None
+
+    def list(self, status=None):
+        with self.lock:
+            if status:
+                rows = self.connection.execute('SELECT * FROM jobs WHERE status=? ORDER BY rowid', (status,)).fetchall()
+            else:
+                rows = self.connection.execute('SELECT * FROM jobs ORDER BY rowid').fetchall()
+        return [self.get_record(row) for row in rows]
+
+    def get_next(self):
+        # the oldest queued job
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE status='queued' ORDER BY rowid LIMIT 1").fetchone()
+        return self.get_record(row) if row else None
+
+    def get_status(self, job_id):
+        with self.lock:
+            row = self.connection.execute('SELECT status FROM jobs WHERE id=?', (job_id,)).fetchone()
+        return row['status'] if row else None
+
+    def set_running(self, job_id):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE jobs SET status='running', started=? WHERE id=?", (time.time(), job_id))
+
+    def set_finished(self, job_id, status, report):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE jobs SET status=?, finished=?, report=? WHERE id=?', (status, time.time(), json.dumps(report, sort_keys=True), job_id))
+
+    def cancel(self, job_id):
+        # a queued job is cancelled now, a running job is cancelled by the service loop
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE jobs SET status='cancelled', finished=? WHERE id=? AND status='queued'", (time.time(), job_id))
+            self.connection.execute("UPDATE jobs SET status='cancelling' WHERE id=? AND status='running'", (job_id,))
+            row = self.connection.execute('SELECT status FROM jobs WHERE id=?', (job_id,)).fetchone()
+        return row['status'] if row else None
+
+    def requeue(self):
+        # the jobs that were running when the service stopped are packaged again
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE jobs SET status='queued' WHERE status='running'")
+            self.connection.execute("UPDATE jobs SET status='cancelled', finished=? WHERE status='cancelling'", (time.time(),))
+
+    def get_depth(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        depth = dict([(status, 0) for status in JOB_STATUSES])
+        for row in rows:
+            depth[row[0]] = row[1]
+        return depth
+
+def GetJob(job):
+    # check a submitted job, and return it with its defaults
+    if not isinstance(job, dict):
+        raise ValueError('a job must be an object')
+    sources = job.get('sources')
+    if not isinstance(sources, list) or not sources or not all([isinstance(source, str) for source in sources]):
+        raise ValueError('a job must have a list of sources')
+    options = job.get('options', {})
+    if not isinstance(options, dict):
+        raise ValueError('the options must be an object')
+    for name in SERVICE_JOB_OPTIONS:
+        if name in options:
+            raise ValueError('the --'+name+' option is set by the service')
+    if 'jobs' in options:
+        # interpreted by the service (see --job-threads)
+        jobs = options['jobs']
+        if isinstance(jobs, bool) or not (isinstance(jobs, int) or (isinstance(jobs, str) and jobs.isdigit())) or int(jobs) < 1:
+            raise ValueError('the --jobs option must be a positive integer')
+    job_id = str(job.get('id') or uuid.uuid4().hex[:12])
+    if not JOB_ID_PATTERN.match(job_id):
+        raise ValueError('invalid job id "'+job_id+'" (letters, digits, "_", "-" and "." only)')
+    return {'id': job_id, 'sources': sources, 'options': options}
+
+#############################################
+# Workers
+#############################################
+def RunServiceJob(options, default_exec_dir, job, connection):
+    # runs in the worker process: the job and the Bento4 tools it runs are in
+    # their own process group, so that they can be stopped together
+    os.setpgid(0, 0)
+    cpu_time = job['limits'].get('cpu_time')
+    if cpu_time:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time+1))
+    mp4dash.RunBatchJob(options, default_exec_dir, job, connection)
+
+def GetDirectorySize(dir):
+    size = 0
+    for (dir_path, dir_names, file_names) in os.walk(dir):
+        for file_name in file_names:
+            try:
+                size += os.lstat(path.join(dir_path, file_name)).st_size
+            except OSError:
+                pass # removed in the meantime
+    return size
+
+class ServiceWorker(mp4dash.BatchWorker):
+    def __init__(self, context, options, default_exec_dir, job):
+        mp4dash.BatchWorker.__init__(self, context, options, default_exec_dir, job, target=RunServiceJob)
+        self.output_dir = path.join(options.output_dir, job['id'])
+        self.stop_reason = None
+        try:
+            os.setpgid(self.process.pid, self.process.pid)
+        except OSError:
+            pass # already done by the worker process, or it has exited
+
+    def stop(self, reason):
+        if self.stop_reason is None:
+            self.stop_reason = reason
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+#############################################
+# Service
+#############################################
+class PackagingService:
+    def __init__(self, options, default_exec_dir):
+        self.options = options
+        self.default_exec_dir = default_exec_dir
+        self.queue = JobQueue(options.database)
+        self.workers = {}
+        self.start_time = time.time()
+        self.stopping = False
+        if 'fork' in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context('fork')
+        else:
+            self.context = multiprocessing.get_context()
+
+        # the defaults of the jobs are the default options of mp4-dash.py
+        (self.job_defaults, args) = mp4dash.CreateOptionParser(default_exec_dir).parse_args([])
+        self.job_defaults.output_dir = options.output_dir
+
+    def submit(self, job, origin):
+        job = GetJob(job)
+        self.queue.add(job, origin)
+        return job['id']
+
+    def get_stats(self):
+        return {'queue':   self.queue.get_depth(),
+                'workers': {'count': self.options.workers, 'busy': len(self.workers), 'jobs': sorted([worker.job['id'] for worker in self.workers.values()])},
+                'limits':  {'cpu_time':        self.options.job_cpu_time,
+                            'timeout':         self.options.job_timeout,
+                            'max_output_size': self.options.job_max_output_size,
+                            'threads':         self.options.job_threads,
+                            'min_free_space':  self.options.min_free_space},
+                'uptime':  time.time()-self.start_time}
+
+    def read_spool(self):
+        # each JSON file of the spool directory is a job (write it under another name, and rename it)
+        for spool_name in sorted(os.listdir(self.options.spool_dir)):
+            spool_filename = path.join(self.options.spool_dir, spool_name)
+            if not spool_name.endswith('.json') or not path.isfile(spool_filename):
+                continue
+            try:
+                with open(spool_filename) as spool_file:
+                    job = json.load(spool_file)
+                if isinstance(job, dict) and 'id' not in job:
+                    job['id'] = spool_name[:-len('.json')]
+                job_id = self.submit(job, 'spool')
+            except (ValueError, OSError) as e:
+                # invalid, unreadable or removed in the meantime
+                print('{} REJECTED: {}'.format(spool_name, e))
+                try:
+                    os.rename(spool_filename, path.join(self.options.spool_dir, 'rejected', spool_name))
+                    with open(path.join(self.options.spool_dir, 'rejected', spool_name+'.error'), 'w') as error_file:
+                        error_file.write(str(e)+'\n')
+                except OSError:
+                    pass
+                continue
+            print('[{}] submitted from the spool directory'.format(job_id))
+            try:
+                os.rename(spool_filename, path.join(self.options.spool_dir, 'accepted', spool_name))
+            except OSError as e:
+                print('WARNING: cannot move {} to the accepted jobs ({})'.format(spool_name, e))
+
+    def has_free_space(self):
+        if not self.options.min_free_space:
+            return True
+        return shutil.disk_usage(self.options.output_dir).free >= self.options.min_free_space*1024*1024
+
+    def start_jobs(self):
+        while len(self.workers) < self.options.workers and self.has_free_space():
+            job = self.queue.get_next()
+            if job is None:
+                return
+            try:
+                if self.options.job_threads:
+                    job['options']['jobs'] = min(int(job['options'].get('jobs') or self.options.job_threads), self.options.job_threads)
+                if job['started']:
+                    # the service was stopped while packaging it, its output is overwritten
+                    job['options']['force'] = True
+                job['limits'] = {'cpu_time': self.options.job_cpu_time}
+                self.queue.set_running(job['id'])
+                worker = ServiceWorker(self.context, self.job_defaults, self.default_exec_dir, job)
+            except Exception as e:
+                # the job fails, not the service
+                self.queue.set_finished(job['id'], 'failure', {'id': job['id'], 'status': 'failure', 'error': str(e), 'elapsed': 0.0})
+                print('[{}] FAILURE: {}'.format(job['id'], e))
+                continue
+            self.workers[worker.connection] = worker
+            print('[{}] started'.format(job['id']))
+
+    def check_workers(self):
+        for worker in list(self.workers.values()):
+            if self.queue.get_status(worker.job['id']) == 'cancelling':
+                worker.stop('cancelled')
+            elif self.options.job_timeout and time.perf_counter()-worker.start_time > self.options.job_timeout:
+                worker.stop('the job took more than {} seconds'.format(self.options.job_timeout))
+            elif self.options.job_max_output_size and GetDirectorySize(worker.output_dir) > self.options.job_max_output_size*1024*1024:
+                worker.stop('the output of the job is larger than {} MB'.format(self.options.job_max_output_size))
+
+    def finish_job(self, worker):
+        report = worker.finish()
+        if worker.stop_reason:
+            status = 'cancelled' if worker.stop_reason == 'cancelled' else 'failure'
+            report['status'] = status
+            report['error'] = worker.stop_reason
+        else:
+            status = report['status']
+        self.queue.set_finished(worker.job['id'], status, report)
+        if status == 'success':
+            print('[{}] packaged in {:.3f} s'.format(worker.job['id'], report['elapsed']))
+        else:
+            print('[{}] {}: {}'.format(worker.job['id'], status.upper(), report.get('error')))
+
+    def run(self):
+        self.queue.requeue()
+        while not self.stopping:
+            if self.options.spool_dir:
+                self.read_spool()
+            self.start_jobs()
+            for connection in multiprocessing.connection.wait(list(self.workers), timeout=SERVICE_POLL_INTERVAL):
+                self.finish_job(self.workers.pop(connection))
+            self.check_workers()
+            sys.stdout.flush()
+
+        # the running jobs are stopped, they will be packaged again when the service restarts
+        for worker in self.workers.values():
+            worker.stop('stopped')
+            worker.finish()
+        self.queue.requeue()
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, body):
+        content = json.dumps(body, sort_keys=True, indent=2).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def get_job_id(self):
+        match = re.match(r'^/jobs/([^/]+)$', urllib.parse.urlparse(self.path).path)
+        return urllib.parse.unquote(match.group(1)) if match else None
+
+    def do_GET(self):
+        service = self.server.service
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/stats':
+            self.send_json(200, service.get_stats())
+        elif url.path == '/jobs':
+            status = urllib.parse.parse_qs(url.query).get('status', [None])[0]
+            self.send_json(200, service.queue.list(status))
+        elif self.get_job_id():
+            job = service.queue.get(self.get_job_id())
+            if job:
+                self.send_json(200, job)
+            else:
+                self.send_json(404, {'error': 'no such job'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != '/jobs':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self.send_json(201, {'id': self.server.service.submit(job, 'http')})
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+
+    def do_DELETE(self):
+        job_id = self.get_job_id()
+        status = self.server.service.queue.cancel(job_id) if job_id else None
+        if status:
+            self.send_json(200, {'id': job_id, 'status': status})
+        else:
+            self.send_json(404, {'error': 'no such job'})
+
+    def log_message(self, format, *args):
+        if self.server.service.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def GetAddress(address):
+    (host, port) = address.rsplit(':', 1) if ':' in address else ('127.0.0.1', address)
+    return (host, int(port))
+
+def Serve(options, default_exec_dir):
+    if options.workers < 1:
+        raise Exception('--workers must be at least 1')
+    if not path.exists(options.output_dir):
+        os.makedirs(options.output_dir)
+    if options.spool_dir:
+        for spool_dir in [options.spool_dir, path.join(options.spool_dir, 'accepted'), path.join(options.spool_dir, 'rejected')]:
+            if not path.exists(spool_dir):
+                os.makedirs(spool_dir)
+    if not options.database:
+        options.database = path.join(options.output_dir, 'mp4-dash-service.db')
+
+    service = PackagingService(options, default_exec_dir)
+    server = ThreadingHTTPServer(GetAddress(options.address), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Packaging service listening on http://{}:{}/ with {} workers'.format(server.server_address[0], server.server_address[1], options.workers))
+
+    def Stop(signal_number, frame):
+        service.stopping = True
+    signal.signal(signal.SIGTERM, Stop)
+    signal.signal(signal.SIGINT, Stop)
+    try:
+        service.run()
+    finally:
+        server.shutdown()
+
+#############################################
+# Client
+#############################################
+def Request(options, method, url_path, body=None):
+    request = urllib.request.Request('http://{}:{}{}'.format(*GetAddress(options.address)+(url_path,)), method=method,
+                                     data=json.dumps(body).encode('utf-8') if body is not None else None,
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise Exception(json.loads(e.read()).get('error', str(e)))
+    except urllib.error.URLError as e:
+        raise Exception('cannot connect to the service ({})'.format(e.reason))
+
+def GetJobOptions(option_specs):
+    # --job-option <name>[=<value>] arguments to a dictionary of mp4-dash.py options
+    job_options = {}
+    for spec in option_specs:
+        (name, value) = spec.split('=', 1) if '=' in spec else (spec, True)
+        name = name.lstrip('-')
+        if name in job_options:
+            if not isinstance(job_options[name], list):
+                job_options[name] = [job_options[name]]
+            job_options[name].append(value)
+        else:
+            job_options[name] = value
+    return job_options
+
+def PrintJob(job):
+    print(json.dumps(job, sort_keys=True, indent=2))
+
+def RunClientCommand(options, command, args):
+    if command == 'submit':
+        if not args:
+            raise Exception('submit needs at least one <media-file>')
+        job = {'sources': [path.abspath(source) if path.exists(source) else source for source in args], 'options': GetJobOptions(options.job_options)}
+        if options.job_id:
+            job['id'] = options.job_id
+        job_id = Request(options, 'POST', '/jobs', job)['id']
+        print(job_id)
+        if options.wait:
+            while True:
+                job = Request(options, 'GET', '/jobs/'+urllib.parse.quote(job_id))
+                if job['status'] in ['success', 'failure', 'cancelled']:
+                    break
+                time.sleep(SERVICE_POLL_INTERVAL)
+            PrintJob(job)
+            if job['status'] != 'success':
+                sys.exit(1)
+    elif command == 'status':
+        if len(args) != 1:
+            raise Exception('status needs a <job-id>')
+        PrintJob(Request(options, 'GET', '/jobs/'+urllib.parse.quote(args[0])))
+    elif command == 'list':
+        url_path = '/jobs?status='+options.status if options.status else '/jobs'
+        for job in Request(options, 'GET', url_path):
+            print('{:<24} {:<10} {}'.format(job['id'], job['status'], ' '.join(job['sources'])))
+    elif command == 'cancel':
+        if len(args) != 1:
+            raise Exception('cancel needs a <job-id>')
+        PrintJob(Request(options, 'DELETE', '/jobs/'+urllib.parse.quote(args[0])))
+    elif command == 'stats':
+        PrintJob(Request(options, 'GET', '/stats'))
+    else:
+        raise Exception('unknown command "'+command+'"')
+
+#############################################
+Options = None
+def main():
+    # parse options
+    parser = OptionParser(usage="%prog [options] serve\n"
+                                "       %prog [options] submit <media-file> [<media-file> ...]\n"
+                                "       %prog [options] status|cancel <job-id>\n"
+                                "       %prog [options] list|stats",
+                          description="Runs the packaging service (serve), or sends a command to it. Version " + VERSION + " r" + SDK_REVISION)
+    parser.add_option('-v', '--verbose', dest="verbose", action='store_true', default=False,
+                      help="Be verbose")
+    parser.add_option('-d', '--debug', dest="debug", action='store_true', default=False,
+                      help="Print out debugging information")
+    parser.add_option('-a', '--address', dest="address", metavar="[<host>:]<port>", default=DEFAULT_ADDRESS,
+                      help="Address of the HTTP API of the service (default: "+DEFAULT_ADDRESS+")")
+    parser.add_option('', "--exec-dir", metavar="<exec_dir>", dest="exec_dir", default=None,
+                      help="(serve) Directory where the Bento4 executables are located")
+    parser.add_option('-o', '--output-dir', dest="output_dir", metavar="<output-dir>", default='output',
+                      help="(serve) Directory under which each job is packaged, in a sub-directory named after its id (default: output)")
+    parser.add_option('', '--database', dest="database", metavar="<filename>", default=None,
+                      help="(serve) SQLite database of the job queue (default: mp4-dash-service.db in the output directory)")
+    parser.add_option('', '--spool-dir', dest="spool_dir", metavar="<dir>", default=None,
+                      help="(serve) Also accept jobs as JSON files in <dir>. They are moved to <dir>/accepted or <dir>/rejected when they are read")
+    parser.add_option('-w', '--workers', dest="workers", metavar="<count>", type="int", default=os.cpu_count() or 1,
+                      help="(serve) Number of jobs packaged in parallel (default: number of CPUs)")
+    parser.add_option('', '--job-threads', dest="job_threads", metavar="<count>", type="int", default=1,
+                      help="(serve) Maximum number of parallel tasks of a job (its --jobs option) (default: 1)")
+    parser.add_option('', '--job-cpu-time', dest="job_cpu_time", metavar="<seconds>", type="int", default=None,
+                      help="(serve) CPU time limit of each process of a job")
+    parser.add_option('', '--job-timeout', dest="job_timeout", metavar="<seconds>", type="float", default=None,
+                      help="(serve) Stop the jobs that take more than <seconds>")
+    parser.add_option('', '--job-max-output-size', dest="job_max_output_size", metavar="<megabytes>", type="float", default=None,
+                      help="(serve) Stop the jobs whose output is larger than <megabytes>")
+    parser.add_option('', '--min-free-space', dest="min_free_space", metavar="<megabytes>", type="float", default=None,
+                      help="(serve) Do not start new jobs while the free space of the output directory is below <megabytes>")
+    parser.add_option('', '--id', dest="job_id", metavar="<job-id>", default=None,
+                      help="(submit) Id of the job (default: a random id)")
+    parser.add_option('-O', '--job-option', dest="job_options", metavar="<name>[=<value>]", action="append", default=[],
+                      help="(submit) mp4-dash.py option of the job, by long name (ex: -O hls -O encryption-key=...). May be repeated")
+    parser.add_option('', '--wait', dest="wait", action='store_true', default=False,
+                      help="(submit) Wait until the job is done, print its report, and fail if the job failed")
+    parser.add_option('', '--status', dest="status", metavar="<status>", default=None,
+                      help="(list) Only list the jobs with this status (" + ', '.join(JOB_STATUSES) + ")")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+    global Options
+    Options = options
+
+    if args[0] == 'serve':
+        Serve(options, options.exec_dir or mp4dash.GetDefaultExecDir())
+    else:
+        RunClientCommand(options, args[0], args[1:])
+
+###########################
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as err:
+        if Options and Options.debug:
+            raise
+        else:
+            PrintErrorAndExit('ERROR: %s\n' % str(err))
@@ -15,7 +15,6 @@ __copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
 # Windows   --> platform = win32
 
 from optparse import OptionParser
-import shutil
 import xml.etree.ElementTree as xml
 from xml.dom.minidom import parseString
 import tempfile
@@ -28,6 +27,13 @@ import json
 import math
 import operator
 import struct
+import hashlib
+import time
+import copy
+import shutil
+import collections
+import multiprocessing
+import multiprocessing.connection
 from functools import reduce
 from subtitles import SubtitlesFile
 from mp4utils import (
@@ -42,20 +48,31 @@ from mp4utils import (
     ComputeDolbyDigitalPlusAudioChannelConfig,
     ComputeDolbyDigitalPlusSmoothStreamingInfo,
     ComputeMarlinPssh,
-    Mp4IframeIndex,
     Mp4File,
     Mp4Encrypt,
     Mp4Fragment,
     Mp4Split,
+    SplitMp4File,
+    MakeSplitInitSegment,
+    Mp4LiveReader,
+    LiveSegmentIndex,
     MediaSource,
-    WalkAtoms,
+    JobRunner,
+    BuildManifest,
+    BUILD_MANIFEST_NAME,
+    StartTrace,
+    TraceStage,
+    SaveTrace,
     GetEncryptionKey,
     DerivePlayReadyKey,
     LanguageNames,
     LanguageCodeMap,
     XmlDuration,
+    XmlDateTime,
     PrintErrorAndExit,
     MakeNewDir,
+    PlaceFile,
+    LINK_MODES,
     BooleanFromString,
     ReGroupEC3Sets,
     DolbyDigitalWithMPEGDASHScheme,
@@ -85,9 +102,6 @@ PADDED_SEGMENT_URL_TEMPLATE = '$RepresentationID$/seg-$Number%05d$.m4s'
 NOPAD_SEGMENT_PATTERN       = 'seg-%llu.m4s'
 NOPAD_SEGMENT_URL_PATTERN   = 'seg-%d.m4s'
 NOPAD_SEGMENT_URL_TEMPLATE  = '$RepresentationID$/seg-$Number$.m4s'
-SEGMENT_PATTERN             = NOPAD_SEGMENT_PATTERN
-SEGMENT_URL_PATTERN         = NOPAD_SEGMENT_URL_PATTERN
-SEGMENT_URL_TEMPLATE        = NOPAD_SEGMENT_URL_TEMPLATE
 
 MEDIA_FILE_PATTERN          = '%s-%02d.mp4'
 
@@ -118,6 +132,11 @@ CLEARKEY_CKEY_NAMESPACE           = 'http://dashif.org/guidelines/clearKey'
 
 SMOOTH_DEFAULT_TIMESCALE    = 10000000
 
+HLS_DELTA_PLAYLIST_SUFFIX            = '_delta'
+HLS_CAN_SKIP_UNTIL_TARGET_DURATIONS  = 6 # minimum allowed
+HLS_PART_HOLD_BACK_PART_TARGETS      = 3 # recommended
+HLS_PARTS_TARGET_DURATIONS           = 3 # parts are listed for the segments of the last 3 target durations
+
 SMIL_NAMESPACE              = 'http://www.w3.org/2001/SMIL20/Language'
 
 CENC_2013_NAMESPACE         = 'urn:mpeg:cenc:2013'
@@ -150,7 +169,11 @@ ProfileAliases = {
   'hbbtv-1.5': HBBTV_15_ISOFF_LIVE_PROFILE
 }
 
-TempFiles = []
+# options that are left out of the build manifest because they do not affect the output
+# (or are the state of the packaging), and options that are only recorded as a digest because they may hold key material
+BUILD_MANIFEST_EXCLUDED_OPTIONS = ['verbose', 'debug', 'force_output', 'incremental', 'exec_dir', 'trace', 'jobs', 'analysis_cache', 'link_mode', 'key_infos',
+                                   'temp_files', 'file_name_map', 'mpd_segment_elements']
+BUILD_MANIFEST_SECRET_OPTIONS   = ['encryption_key', 'encryption_args']
 
 MpegCencSchemeMap = {
     'cenc': 'MPEG-CENC',
@@ -159,6 +182,42 @@ MpegCencSchemeMap = {
     'cbcs': 'MPEG-CBCS'
 }
 
+#############################################
+# The per-segment elements (SegmentURL, S) are not added to the MPD element tree,
+# because there may be hundreds of thousands of them for long presentations.
+# A placeholder is added instead, and the elements are generated from the segment
+# tables when the MPD is written out.
+MPD_SEGMENT_ELEMENTS_TAG = 'Bento4SegmentElements'
+
+def AddSegmentElements(options, parent, count, elements):
+    if count:
+        xml.SubElement(parent, MPD_SEGMENT_ELEMENTS_TAG, index=str(len(options.mpd_segment_elements)))
+        options.mpd_segment_elements.append(elements)
+
+def EscapeXmlAttribute(value):
+    # same escaping as the minidom pretty printer
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+def WriteMpd(options, mpd, filename):
+    mpd_xml = parseString(xml.tostring(mpd)).toprettyxml("  ")
+    # use a regex to fix a bug in toprettyxml() that inserts newlines in text content
+    mpd_xml = re.sub(r'((?<=>)(\n[\s]*)(?=[^<\s]))|(?<=[^>\s])(\n[\s]*)(?=<)', '', mpd_xml)
+
+    placeholder = re.compile(r'^(\s*)<'+MPD_SEGMENT_ELEMENTS_TAG+r' index="(\d+)"/>\n$')
+    with open(filename+'.tmp', 'w') as mpd_file:
+        for line in mpd_xml.splitlines(True):
+            match = placeholder.match(line)
+            if not match:
+                mpd_file.write(line)
+                continue
+
+            indent = match.group(1)
+            for (tag, attributes) in options.mpd_segment_elements[int(match.group(2))]:
+                mpd_file.write(indent+'<'+tag+''.join([' {}="{}"'.format(name, EscapeXmlAttribute(value)) for (name, value) in attributes])+'/>\n')
+
+    # replace the previous MPD in one step, so that clients polling it (for live presentations) never see a partial file
+    os.replace(filename+'.tmp', filename)
+
 #############################################
 def AddSegmentList(options, container, subdir, track, use_byte_range=False):
     if subdir:
@@ -179,23 +238,63 @@ def AddSegmentList(options, container, subdir, track, use_byte_range=False):
         xml.SubElement(segment_list,
                        'Initialization',
                        sourceURL=prefix + track.init_segment_name)
-    i = 1
-    for segment_index in track.moofs:
-        segment = track.parent.segments[segment_index]
-        segment_offset = segment[0].position
-        segment_length = reduce(operator.add, [atom.size for atom in segment], 0)
+    AddSegmentElements(options, segment_list, len(track.moofs), GetSegmentUrlElements(options, track, prefix, use_byte_range))
+
+def GetSegmentUrlElements(options, track, prefix, use_byte_range):
+    for i in range(1, len(track.moofs)+1):
+        segment_offset = track.segment_offsets[i-1]
+        segment_length = track.segment_lengths[i-1]
         if use_byte_range:
             byte_range = str(segment_offset) + '-' + str(segment_offset + segment_length - 1)
-            xml.SubElement(segment_list,
-                           'SegmentURL',
-                           media=prefix + track.parent.media_name,
-                           mediaRange=byte_range)
+            yield ('SegmentURL', [('media', prefix + track.parent.media_name), ('mediaRange', byte_range)])
         else:
-            xml.SubElement(segment_list,
-                           'SegmentURL',
-                           media=prefix + (SEGMENT_URL_PATTERN % i))
-        i += 1
-
+            yield ('SegmentURL', [('media', prefix + (options.segment_url_pattern % i))])
+
+def GetSegmentTimelineElements(track):
+    repeat_count = 0
+    for i in range(len(track.segment_scaled_durations)):
+        duration = track.segment_scaled_durations[i]
+        if i + 1 < len(track.segment_scaled_durations) and duration == track.segment_scaled_durations[i + 1]:
+            repeat_count += 1
+        else:
+            attributes = [('d', str(duration))]
+            if repeat_count:
+                attributes.append(('r', str(repeat_count)))
+
+            yield ('S', attributes)
+            repeat_count = 0
+
+def GetLiveSegmentTimelineElements(segment_index, open_segment_duration=0):
+    # same as GetSegmentTimelineElements, for the segments in the window of a live track,
+    # with a start time for the first one and for those that do not follow the previous one.
+    # when open_segment_duration is not 0, the segment that is being built is also listed,
+    # with that duration
+    segments = [(start_time, duration) for (_, start_time, duration, _, _) in segment_index.segments]
+    if open_segment_duration and segment_index.parts:
+        segments.append((segment_index.open_time, open_segment_duration))
+    runs = [] # [start time or None, duration, repeat count]
+    end_time = None
+    for (start_time, duration) in segments:
+        if start_time == end_time and duration == runs[-1][1]:
+            runs[-1][2] += 1
+        else:
+            runs.append([None if start_time == end_time else start_time, duration, 0])
+        end_time = start_time+duration
+
+    for (start_time, duration, repeat_count) in runs:
+        attributes = [('d', str(duration))]
+        if start_time is not None:
+            attributes.insert(0, ('t', str(start_time)))
+        if repeat_count:
+            attributes.append(('r', str(repeat_count)))
+        yield ('S', attributes)
+
+def GetTimelineTrack(options, tracks):
+    # the timeline of an adaptation set is the one of its first track, or for live presentations,
+    # the one of the track that is the least advanced, so that all the segments it lists exist
+    if options.live:
+        return min(tracks, key=lambda track: track.live_index.next_number)
+    return tracks[0]
 
 #############################################
 def AddSegmentTemplate(options, container, init_segment_url, media_url_template_prefix, track, stream_name):
@@ -203,7 +302,7 @@ def AddSegmentTemplate(options, container, init_segment_url, media_url_template_
         return
 
     if options.use_segment_timeline or track.type == 'subtitles':
-        url_template = SEGMENT_URL_TEMPLATE
+        url_template = options.segment_url_template
         if options.smooth:
             url_base = path.basename(options.smooth_server_manifest_filename)
             url_template = url_base + DASH_MEDIA_SEGMENT_URL_PATTERN_SMOOTH % stream_name
@@ -216,28 +315,35 @@ def AddSegmentTemplate(options, container, init_segment_url, media_url_template_
                   'media': url_template,
                   'startNumber': '1'} # (keep the @startNumber, even if not needed, because some clients like Silverlight want it)
 
+        open_segment_duration = 0
+        if options.live:
+            kwargs['startNumber'] = str(track.live_index.first_number())
+            kwargs['presentationTimeOffset'] = str(track.live_time_offset)
+            if options.segment_duration and not options.live_ended:
+                # low latency: the segment being built is announced, with the duration of the previous
+                # one, and its chunks can be fetched as soon as they are written
+                segments = track.live_index.segments
+                open_segment_duration = segments[-1][2] if segments else track.live_segment_duration
+                availability_time_offset = float(open_segment_duration)/float(track.timescale)-track.live_part_target
+                kwargs['availabilityTimeOffset'] = '%.3f' % max(availability_time_offset, 0.0)
+                kwargs['availabilityTimeComplete'] = 'false'
+
         segment_template = xml.SubElement(*args, **kwargs)
         segment_timeline = xml.SubElement(segment_template, 'SegmentTimeline')
-        repeat_count = 0
-        for i in range(len(track.segment_scaled_durations)):
-            duration = track.segment_scaled_durations[i]
-            if i + 1 < len(track.segment_scaled_durations) and duration == track.segment_scaled_durations[i + 1]:
-                repeat_count += 1
-            else:
-                args = [segment_timeline, 'S']
-                kwargs = {'d': str(duration)}
-                if repeat_count:
-                    kwargs['r'] = str(repeat_count)
-
-                xml.SubElement(*args, **kwargs)
-                repeat_count = 0
+        if options.live:
+            AddSegmentElements(options,
+                               segment_timeline,
+                               len(track.live_index.segments)+len(track.live_index.parts),
+                               GetLiveSegmentTimelineElements(track.live_index, open_segment_duration))
+        else:
+            AddSegmentElements(options, segment_timeline, len(track.segment_scaled_durations), GetSegmentTimelineElements(track))
     else:
         xml.SubElement(container,
                        'SegmentTemplate',
                        timescale='1000',
                        duration=str(int(round(track.average_segment_duration*1000))),
                        initialization=init_segment_url,
-                       media=SEGMENT_URL_TEMPLATE,
+                       media=options.segment_url_template,
                        startNumber='1') # (keep the @startNumber, even if not needed, because some clients like Silverlight want it)
 
 #############################################
@@ -408,6 +514,17 @@ def AddDescriptor(adaptation_set, set_attributes, set_name, category_name):
             else:
                 sys.stderr.write('WARNING: ignoring ' + descriptor_name + ' descriptor for set "' + set_name + '", the schemeIdUri must be specified\n')
 
+#############################################
+def GetProvisionalNote(tracks):
+    # note for the manifests of tracks analyzed with --estimate, or None if all of them were fully analyzed
+    estimates = [track.estimate for track in tracks if getattr(track, 'estimate', None)]
+    if not estimates:
+        return None
+    return 'Provisional: bitrates estimated from {} of {} fragments, error bound {:.3g}% (to be replaced by a full analysis)'.format(
+           sum([estimate['sampled'] for estimate in estimates]),
+           sum([estimate['fragments'] for estimate in estimates]),
+           100.0*max([estimate['error'] for estimate in estimates]))
+
 #############################################
 def OutputDash(options, set_attributes, audio_sets, video_sets, subtitles_sets, subtitles_files):
     all_audio_tracks     = sum(list(audio_sets.values()),     [])
@@ -423,20 +540,44 @@ def OutputDash(options, set_attributes, audio_sets, video_sets, subtitles_sets,
         presentation_duration = all_subtitles_tracks[0].total_duration
     else:
         return
+    if options.live:
+        presentation_duration = max([track.live_index.end_time/float(track.timescale) for track in all_video_tracks+all_audio_tracks+all_subtitles_tracks])-options.live_time_origin
 
     # create the MPD
     if options.use_compat_namespace:
         mpd_ns = MPD_NS_COMPAT
     else:
         mpd_ns = MPD_NS
-    mpd = xml.Element('MPD',
-                      xmlns=mpd_ns,
-                      profiles=','.join(options.profiles),
-                      minBufferTime="PT%.02fS" % options.min_buffer_time,
-                      mediaPresentationDuration=XmlDuration(presentation_duration),
-                      type='static')
+    if options.live:
+        mpd = xml.Element('MPD',
+                          xmlns=mpd_ns,
+                          profiles=','.join(options.profiles),
+                          minBufferTime="PT%.02fS" % options.min_buffer_time,
+                          type='dynamic',
+                          availabilityStartTime=XmlDateTime(options.live_start_time),
+                          publishTime=XmlDateTime(time.time()))
+        if options.live_ended:
+            # the presentation is over, clients stop polling the MPD
+            mpd.set('mediaPresentationDuration', XmlDuration(presentation_duration))
+        else:
+            mpd.set('minimumUpdatePeriod', XmlDuration(options.min_buffer_time))
+        if options.live_window:
+            mpd.set('timeShiftBufferDepth', XmlDuration(options.live_window))
+    else:
+        mpd = xml.Element('MPD',
+                          xmlns=mpd_ns,
+                          profiles=','.join(options.profiles),
+                          minBufferTime="PT%.02fS" % options.min_buffer_time,
+                          mediaPresentationDuration=XmlDuration(presentation_duration),
+                          type='static')
     mpd.append(xml.Comment(' Created with Bento4 mp4-dash.py, VERSION=' + VERSION + '-' + SDK_REVISION + ' '))
-    period = xml.SubElement(mpd, 'Period')
+    provisional_note = GetProvisionalNote(all_audio_tracks + all_video_tracks)
+    if provisional_note:
+        mpd.append(xml.Comment(' ' + provisional_note + ' '))
+    if options.live:
+        period = xml.SubElement(mpd, 'Period', id='1', start='PT0S')
+    else:
+        period = xml.SubElement(mpd, 'Period')
 
     # process the video tracks
     if video_sets:
@@ -475,7 +616,7 @@ def OutputDash(options, set_attributes, audio_sets, video_sets, subtitles_sets,
                 else:
                     init_segment_url                  = NOSPLIT_INIT_FILE_PATTERN % ('$RepresentationID$')
                     media_segment_url_template_prefix = ''
-                AddSegmentTemplate(options, adaptation_set, init_segment_url, media_segment_url_template_prefix, video_tracks[0], 'video')
+                AddSegmentTemplate(options, adaptation_set, init_segment_url, media_segment_url_template_prefix, GetTimelineTrack(options, video_tracks), 'video')
 
             for video_track in video_tracks:
                 representation = xml.SubElement(adaptation_set,
@@ -534,7 +675,7 @@ def OutputDash(options, set_attributes, audio_sets, video_sets, subtitles_sets,
                     media_segment_url_template_prefix = ''
 
                 stream_name = 'audio_' + language
-                AddSegmentTemplate(options, adaptation_set, init_segment_url, media_segment_url_template_prefix, audio_tracks[0], stream_name)
+                AddSegmentTemplate(options, adaptation_set, init_segment_url, media_segment_url_template_prefix, GetTimelineTrack(options, audio_tracks), stream_name)
 
             for audio_track in audio_tracks:
                 representation = xml.SubElement(adaptation_set,
@@ -664,12 +805,14 @@ def OutputDash(options, set_attributes, audio_sets, video_sets, subtitles_sets,
             base_url = xml.SubElement(representation, 'BaseURL')
             base_url.text = 'subtitles/'+subtitles_file.language+'/'+subtitles_file.media_name
 
+    # live clients need to be in sync with the packager's clock
+    if options.live:
+        xml.SubElement(mpd, 'UTCTiming', schemeIdUri='urn:mpeg:dash:utc:direct:2014', value=mpd.get('publishTime'))
+
     # save the MPD
     if options.mpd_filename:
-        mpd_xml = parseString(xml.tostring(mpd)).toprettyxml("  ")
-        # use a regex to fix a bug in toprettyxml() that inserts newlines in text content
-        mpd_xml = re.sub(r'((?<=>)(\n[\s]*)(?=[^<\s]))|(?<=[^>\s])(\n[\s]*)(?=<)', '', mpd_xml)
-        open(path.join(options.output_dir, options.mpd_filename), 'w').write(mpd_xml)
+        WriteMpd(options, mpd, path.join(options.output_dir, options.mpd_filename))
+    del options.mpd_segment_elements[:]
 
 
 #############################################
@@ -715,6 +858,9 @@ def OutputHlsCommon(options, track, all_tracks, media_subdir, playlist_name, med
     playlist_file = open(path.join(output_dir, playlist_name), 'w', newline='\r\n')
     playlist_file.write('#EXTM3U\n')
     playlist_file.write('# Created with Bento4 mp4-dash.py, VERSION=' + VERSION + '-' + SDK_REVISION+'\n')
+    provisional_note = GetProvisionalNote([track])
+    if provisional_note:
+        playlist_file.write('# ' + provisional_note + '\n')
     playlist_file.write('#\n')
     playlist_file.write('#EXT-X-VERSION:6\n')
     playlist_file.write('#EXT-X-PLAYLIST-TYPE:VOD\n')
@@ -746,17 +892,20 @@ def OutputHlsCommon(options, track, all_tracks, media_subdir, playlist_name, med
 
 #############################################
 def OutputHlsTrack(options, track, all_tracks, media_subdir, media_playlist_name, media_file_name):
+    if options.live:
+        OutputHlsLiveTrack(options, track, media_subdir, media_playlist_name)
+        return
+
     media_playlist_file = OutputHlsCommon(options, track, all_tracks, media_subdir, media_playlist_name, media_file_name)
 
     if options.split:
-        segment_pattern = SEGMENT_PATTERN.replace('ll','')
+        segment_pattern = options.segment_pattern.replace('ll','')
 
     for i in range(len(track.segment_durations)):
         media_playlist_file.write('#EXTINF:{},\n'.format(track.segment_durations[i]))
         if options.on_demand or not options.split:
-            segment          = track.parent.segments[track.moofs[i]]
-            segment_position = segment[0].position
-            segment_size     = reduce(operator.add, [atom.size for atom in segment], 0)
+            segment_position = track.segment_offsets[i]
+            segment_size     = track.segment_lengths[i]
             media_playlist_file.write('#EXT-X-BYTERANGE:{}@{}\n'.format(segment_size, segment_position))
             media_playlist_file.write(media_file_name)
         else:
@@ -765,6 +914,87 @@ def OutputHlsTrack(options, track, all_tracks, media_subdir, media_playlist_name
 
     media_playlist_file.write('#EXT-X-ENDLIST\n')
 
+#############################################
+def GetHlsDeltaPlaylistName(media_playlist_name):
+    (root, extension) = path.splitext(media_playlist_name)
+    return root+HLS_DELTA_PLAYLIST_SUFFIX+extension
+
+def WriteHlsPlaylist(filename, lines):
+    # write to a temporary file first, so that clients polling the playlist never see a partial file
+    with open(filename+'.tmp', 'w', newline='\r\n') as playlist_file:
+        playlist_file.write('\n'.join(lines)+'\n')
+    os.replace(filename+'.tmp', filename)
+
+def GetHlsLivePlaylistLines(options, track, skip_until):
+    segment_index = track.live_index
+    timescale = float(track.timescale)
+    segment_pattern = options.segment_pattern.replace('ll','')
+    use_parts = options.segment_duration > 0
+
+    # the target duration can only grow, since it must not change during the presentation
+    for (_, _, duration, _, _) in segment_index.segments:
+        track.hls_target_duration = max(track.hls_target_duration, int(math.ceil(duration/timescale)))
+    target_duration = max(track.hls_target_duration, 1)
+    edge_time = segment_index.edge_time()
+
+    lines = ['#EXTM3U',
+             '# Created with Bento4 mp4-dash.py, VERSION=' + VERSION + '-' + SDK_REVISION,
+             '#',
+             '#EXT-X-VERSION:9',
+             '#EXT-X-TARGETDURATION:{}'.format(target_duration)]
+    server_control = 'CAN-SKIP-UNTIL={:.1f}'.format(HLS_CAN_SKIP_UNTIL_TARGET_DURATIONS*target_duration)
+    if use_parts:
+        server_control += ',PART-HOLD-BACK={:.3f}'.format(HLS_PART_HOLD_BACK_PART_TARGETS*track.live_part_target)
+    lines.append('#EXT-X-SERVER-CONTROL:'+server_control)
+    if use_parts:
+        lines.append('#EXT-X-PART-INF:PART-TARGET={:.3f}'.format(track.live_part_target))
+    lines.append('#EXT-X-MEDIA-SEQUENCE:{}'.format(segment_index.first_number()))
+    lines.append('#EXT-X-MAP:URI="{}"'.format(SPLIT_INIT_SEGMENT_NAME))
+
+    # in a delta update, the segments that end more than skip_until seconds before the end of the playlist are skipped
+    segments = list(segment_index.segments)
+    skipped_count = 0
+    if skip_until:
+        while skipped_count < len(segments) and segments[skipped_count][1]+segments[skipped_count][2] <= edge_time-skip_until*timescale:
+            skipped_count += 1
+        if skipped_count:
+            lines.append('#EXT-X-SKIP:SKIPPED-SEGMENTS={}'.format(skipped_count))
+            segments = segments[skipped_count:]
+
+    # the parts are only listed for the segments that are close to the live edge
+    parts_start_time = edge_time-HLS_PARTS_TARGET_DURATIONS*target_duration*timescale
+    start_time = segments[0][1] if segments else segment_index.open_time
+    lines.append('#EXT-X-PROGRAM-DATE-TIME:'+XmlDateTime(options.live_start_time+(start_time-track.live_time_offset)/timescale))
+    for (number, start_time, duration, _, parts) in segments:
+        if use_parts and start_time+duration > parts_start_time:
+            lines += GetHlsPartLines(segment_pattern % number, parts, timescale)
+        lines.append('#EXTINF:{},'.format(duration/timescale))
+        lines.append(segment_pattern % number)
+    if use_parts:
+        lines += GetHlsPartLines(segment_pattern % segment_index.next_number, segment_index.parts, timescale)
+
+    if options.live_ended:
+        lines.append('#EXT-X-ENDLIST')
+    return lines
+
+def GetHlsPartLines(segment_name, parts, timescale):
+    # the parts are byte ranges of the segment file
+    return ['#EXT-X-PART:DURATION={:.5f},URI="{}",BYTERANGE="{}@{}"{}'.format(duration/timescale,
+                                                                            segment_name,
+                                                                            size,
+                                                                            offset,
+                                                                            ',INDEPENDENT=YES' if independent else '')
+            for (duration, offset, size, independent) in parts]
+
+def OutputHlsLiveTrack(options, track, media_subdir, media_playlist_name):
+    output_dir = path.join(options.output_dir, media_subdir)
+    os.makedirs(output_dir, exist_ok = True)
+    WriteHlsPlaylist(path.join(output_dir, media_playlist_name), GetHlsLivePlaylistLines(options, track, 0))
+
+    # the delta update is a separate playlist, to be served for requests with _HLS_skip=YES
+    skip_until = HLS_CAN_SKIP_UNTIL_TARGET_DURATIONS*max(track.hls_target_duration, 1)
+    WriteHlsPlaylist(path.join(output_dir, GetHlsDeltaPlaylistName(media_playlist_name)), GetHlsLivePlaylistLines(options, track, skip_until))
+
 #############################################
 def OutputHlsWebvttPlaylist(options, media_subdir, media_playlist_name, media_file_name, total_duration):
     # output a playlist with a single segment that covers the entire WebVTT file
@@ -797,8 +1027,7 @@ def OutputHlsIframeIndex(options, track, all_tracks, media_subdir, iframes_playl
 
     if not options.split:
         # get the I-frame index for a single file
-        json_index = Mp4IframeIndex(options, path.join(options.output_dir, media_file_name))
-        index = json.loads(json_index)
+        index = track.get_iframe_index()
         for i in range(len(track.segment_durations)):
             if i < len(index):
                 index_entry = index[i]
@@ -818,19 +1047,16 @@ def OutputHlsIframeIndex(options, track, all_tracks, media_subdir, iframes_playl
                 index_playlist_file.write('#EXT-X-BYTERANGE:{}@{}\n'.format(iframe_range_size, fragment_start))
                 index_playlist_file.write(media_file_name+'\n')
     else:
-        segment_pattern = SEGMENT_PATTERN.replace('ll','')
+        segment_pattern = options.segment_pattern.replace('ll','')
         for i in range(len(track.segment_durations)):
             fragment_basename = segment_pattern % (i+1)
             fragment_file = path.join(options.output_dir, media_subdir, fragment_basename)
-            init_file = path.join(options.output_dir, media_subdir, options.init_segment)
-            if not path.exists(fragment_file):
+            if not options.no_media and not path.exists(fragment_file):
                 break
-            json_index = Mp4IframeIndex(options, fragment_file, fragments_info=init_file)
-            index = json.loads(json_index)
-            if len(index) < 1:
+            iframe_size       = track.segment_iframe_sizes[i]
+            iframe_offset     = track.segment_iframe_offsets[i]-track.segment_offsets[i] # relative to the start of the segment file
+            if not iframe_size:
                 break
-            iframe_size       = int(index[0]['size'])
-            iframe_offset     = int(index[0]['offset'])
             iframe_range_size = iframe_size + iframe_offset
             iframe_segment_duration = track.segment_durations[i]
             index_playlist_file.write('#EXTINF:{},\n'.format(iframe_segment_duration))
@@ -857,9 +1083,13 @@ def OutputHls(options, set_attributes, audio_sets, video_sets, subtitles_sets, s
     all_video_tracks     = sum(list(video_sets.values()),     [])
     all_subtitles_tracks = sum(list(subtitles_sets.values()), [])
 
-    master_playlist_file = open(path.join(options.output_dir, options.hls_master_playlist_name), 'w', newline='\r\n')
+    master_playlist_filename = path.join(options.output_dir, options.hls_master_playlist_name)
+    master_playlist_file = open(master_playlist_filename+'.tmp', 'w', newline='\r\n')
     master_playlist_file.write('#EXTM3U\n')
     master_playlist_file.write('# Created with Bento4 mp4-dash.py, VERSION=' + VERSION + '-' + SDK_REVISION+'\n')
+    provisional_note = GetProvisionalNote(all_audio_tracks + all_video_tracks)
+    if provisional_note:
+        master_playlist_file.write('# ' + provisional_note + '\n')
     master_playlist_file.write('#\n')
     master_playlist_file.write('#EXT-X-VERSION:6\n')
     master_playlist_file.write('\n')
@@ -1026,6 +1256,12 @@ def OutputHls(options, set_attributes, audio_sets, video_sets, subtitles_sets, s
             master_playlist_file.write(media_playlist_path+'\n')
 
         OutputHlsTrack(options, video_track, all_audio_tracks + all_video_tracks, media_subdir, media_playlist_name, media_file_name)
+        if options.live:
+            # no I-frame playlists for live presentations
+            continue
+        if video_track.estimate:
+            # no I-frame playlists either when only some of the fragments were analyzed
+            continue
         iframe_average_segment_bitrate,iframe_max_bitrate = OutputHlsIframeIndex(options, video_track, all_audio_tracks + all_video_tracks, media_subdir, iframes_playlist_name, media_file_name)
 
         # this will be written later
@@ -1042,8 +1278,9 @@ def OutputHls(options, set_attributes, audio_sets, video_sets, subtitles_sets, s
             iframe_playlist_lines.append(',SUPPLEMENTAL-CODECS="{}"'.format(supplemental_codec_string))
         iframe_playlist_lines.append('\n')
 
-    master_playlist_file.write('\n# I-Frame Playlists\n')
-    master_playlist_file.write(''.join(iframe_playlist_lines))
+    if not options.live:
+        master_playlist_file.write('\n# I-Frame Playlists\n')
+        master_playlist_file.write(''.join(iframe_playlist_lines))
 
     # IMSC1 subtitles
     if all_subtitles_tracks:
@@ -1101,6 +1338,10 @@ def OutputHls(options, set_attributes, audio_sets, video_sets, subtitles_sets, s
                                        media_playlist_name))
             OutputHlsWebvttPlaylist(options, media_subdir, media_playlist_name, subtitles_file.media_name, presentation_duration)
 
+    # replace the previous master playlist in one step
+    master_playlist_file.close()
+    os.replace(master_playlist_filename+'.tmp', master_playlist_filename)
+
 #############################################
 def OutputSmooth(options, audio_tracks, video_tracks):
     # compute the total duration (we take the duration of the video)
@@ -1309,9 +1550,56 @@ def OutputHippo(options, audio_tracks, video_tracks):
     if options.hippo_server_manifest_filename != '':
         open(path.join(options.output_dir, options.hippo_server_manifest_filename), 'w').write(server_manifest)
 
+#############################################
+def OutputManifests(options, set_attributes, audio_sets, video_sets, subtitles_sets, subtitles_files):
+    audio_tracks = sum(list(audio_sets.values()), [])
+    video_tracks = sum(list(video_sets.values()), [])
+
+    # output the DASH MPD
+    with TraceStage('OutputDash'):
+        OutputDash(options, set_attributes, audio_sets, video_sets, subtitles_sets, subtitles_files)
+
+    # output the HLS playlists
+    if options.hls:
+        with TraceStage('OutputHls'):
+            OutputHls(options, set_attributes, audio_sets, video_sets, subtitles_sets, subtitles_files)
+
+    # output the Smooth Manifests
+    if options.smooth:
+        with TraceStage('OutputSmooth'):
+            OutputSmooth(options, audio_tracks, video_tracks)
+
+    # output the Hippo Manifest
+    if options.hippo:
+        with TraceStage('OutputHippo'):
+            OutputHippo(options, audio_tracks, video_tracks)
+
 #############################################
 def SelectTracks(options, media_sources):
-    # parse the media files
+    # parse the media files, concurrently
+    parse_jobs = {}
+    job_runner = JobRunner(options.jobs)
+    for media_source in [x for x in media_sources if x.format == 'mp4']:
+        media_file = media_source.filename
+
+        # check if we have already parsed this file
+        if media_file in parse_jobs:
+            continue
+
+        # parse the file
+        if not path.exists(media_file):
+            raise Exception('media file ' + media_file + ' does not exist')
+
+        # get the file info
+        print('Parsing media file', str(len(parse_jobs)+1)+':', GetMappedFileName(options, media_file))
+        parse_jobs[media_file] = job_runner.add(Mp4File,
+                                                options,
+                                                media_source,
+                                                sample_tables = options.sample_accurate_bandwidth,
+                                                update        = False,
+                                                estimate      = options.estimate)
+    job_runner.run()
+
     file_list_index = 1
     mp4_files = {}
     mp4_media_names = []
@@ -1323,13 +1611,11 @@ def SelectTracks(options, media_sources):
             media_source.mp4_file = mp4_files[media_file]
             continue
 
-        # parse the file
-        if not path.exists(media_file):
-            PrintErrorAndExit('ERROR: media file ' + media_file + ' does not exist')
-
-        # get the file info
-        print('Parsing media file', str(file_list_index)+':', GetMappedFileName(media_file))
-        mp4_file = Mp4File(options, media_source)
+        # compute the track statistics (in order, since this may update the shared options)
+        mp4_file = parse_jobs[media_file].result
+        if options.segment_duration:
+            mp4_file.group_segments(options.segment_duration)
+        mp4_file.update(options)
 
         # set some metadata properties for this file
         mp4_file.file_list_index = file_list_index
@@ -1345,11 +1631,11 @@ def SelectTracks(options, media_sources):
 
         if not options.split:
             if mp4_file.media_name in mp4_media_names:
-                PrintErrorAndExit('ERROR: output media name {} is not unique, consider using --rename-media'.format(mp4_file.media_name))
+                raise Exception('output media name {} is not unique, consider using --rename-media'.format(mp4_file.media_name))
 
         # check the file
         if mp4_file.info['movie']['fragments'] != True:
-            PrintErrorAndExit('ERROR: file '+str(mp4_file.file_list_index)+' is not fragmented (use mp4fragment to fragment it)')
+            raise Exception('file '+str(mp4_file.file_list_index)+' is not fragmented (use mp4fragment to fragment it)')
 
         # set the source property
         media_source.mp4_file = mp4_file
@@ -1369,7 +1655,7 @@ def SelectTracks(options, media_sources):
 
         if media_source.format != 'mp4':
             if track_id or track_type:
-                PrintErrorAndExit('ERROR: track ID and track type selections only apply to MP4 media sources')
+                raise Exception('track ID and track type selections only apply to MP4 media sources')
 
             continue
 
@@ -1377,17 +1663,17 @@ def SelectTracks(options, media_sources):
             sys.stderr.write('WARNING: ignoring source '+media_source.name+', unknown type')
 
         if track_id and track_type:
-            PrintErrorAndExit('ERROR: track ID and track type selections are mutually exclusive')
+            raise Exception('track ID and track type selections are mutually exclusive')
 
         if track_id:
             tracks = [media_source.mp4_file.find_track_by_id(track_id)]
             if not tracks:
-                PrintErrorAndExit('ERROR: track id not found for media file '+media_source.name)
+                raise Exception('track id not found for media file '+media_source.name)
 
         if track_type:
             tracks = media_source.mp4_file.find_tracks_by_type(track_type)
             if not tracks:
-                PrintErrorAndExit('ERROR: no ' + track_type + ' found for media file '+media_source.name)
+                raise Exception('no ' + track_type + ' found for media file '+media_source.name)
 
         if not tracks:
             tracks = list(media_source.mp4_file.tracks.values())
@@ -1501,6 +1787,32 @@ def SelectTracks(options, media_sources):
 
     return (audio_adaptation_sets, video_adaptation_sets, subtitles_adaptation_sets, mp4_files)
 
+#############################################
+def AssignRepresentationIds(options, audio_sets, video_sets, subtitles_sets):
+    for adaptation_sets in [audio_sets, video_sets, subtitles_sets]:
+        for adaptation_set_name, tracks in list(adaptation_sets.items()):
+            for track in tracks:
+                if not hasattr(track, 'representation_id'):
+                    if options.split:
+                        track.representation_id = '/'.join(adaptation_set_name)
+                        if len(tracks) > 1:
+                            track.representation_id += '/'+str(track.order_index)
+                    else:
+                        track.representation_id = '-'.join(adaptation_set_name)
+                        if len(tracks) > 1:
+                            track.representation_id += '-'+str(track.order_index)
+
+                if options.split:
+                    track.init_segment_name = SPLIT_INIT_SEGMENT_NAME
+                elif options.on_demand:
+                    track.parent.media_name = ONDEMAND_MEDIA_FILE_PATTERN % (options.media_prefix, track.representation_id)
+                else:
+                    track.init_segment_name = NOSPLIT_INIT_FILE_PATTERN % (track.representation_id)
+
+                track.stream_id = adaptation_set_name[0]
+                if adaptation_set_name[0] == 'audio':
+                    track.stream_id += '_'+track.language
+
 #############################################
 def SelectSubtitlesFiles(options, media_sources):
     return [SubtitlesFile(options, media_source) for media_source in media_sources if media_source.format in ['ttml', 'webvtt']]
@@ -1582,6 +1894,91 @@ def PrepareSources(options, media_sources):
                 if track['type'].lower() in key_info['filter']:
                     media_source.key_infos[track['id']] = key_info
 
+#############################################
+def WritePsshFile(options, pssh_data, pssh_digests):
+    pssh_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
+    pssh_file.write(pssh_data)
+    options.temp_files.append(pssh_file.name)
+    pssh_file.close() # necessary on Windows
+    pssh_digests[pssh_file.name] = hashlib.sha256(pssh_data).hexdigest()
+    return pssh_file.name
+
+#############################################
+def EncryptSource(options, media_source, media_file, encrypted_filename):
+    # pick a default key
+    default_kid = options.key_infos[0]['kid']
+
+    args = ['--method', MpegCencSchemeMap[options.encryption_cenc_scheme]]
+
+    if options.encryption_args:
+        args += options.encryption_args.split()
+    else:
+        if options.smooth or options.playready:
+            args += ['--global-option', 'mpeg-cenc.piff-compatible:true']
+
+    key_set = {}
+    pssh_digests = {}
+    for track_id in sorted(media_source.key_infos.keys()):
+        key_info = media_source.key_infos[track_id]
+        key_set[key_info['kid']] = key_info['key']
+        args += ['--key', str(track_id)+':'+key_info['key']+':'+key_info['iv'], '--property', str(track_id)+':KID:'+key_info['kid']]
+
+    # EME Common Encryption / Clearkey
+    if options.eme_signaling == 'pssh-v0':
+        args += ['--pssh', EME_COMMON_ENCRYPTION_PSSH_SYSTEM_ID+':']
+    elif options.eme_signaling == 'pssh-v1':
+        args += ['--pssh-v1', EME_COMMON_ENCRYPTION_PSSH_SYSTEM_ID+':']
+
+    # Marlin
+    if options.marlin_add_pssh:
+        marlin_pssh = ComputeMarlinPssh(options)
+        args += ['--pssh', MARLIN_PSSH_SYSTEM_ID+':'+WritePsshFile(options, marlin_pssh, pssh_digests)]
+
+    # PlayReady
+    if options.playready_add_pssh:
+        playready_header = ComputePlayReadyHeader(options.playready_version,
+                                                  options.playready_header,
+                                                  options.encryption_cenc_scheme,
+                                                  list(key_set.items()))
+        args += ['--pssh', PLAYREADY_PSSH_SYSTEM_ID+':'+WritePsshFile(options, playready_header, pssh_digests)]
+
+    # Widevine
+    if options.widevine_header:
+        pssh = ComputeWidevinePssh(options.widevine_header, options.encryption_cenc_scheme, default_kid)
+        pssh_version = pssh[8]
+        if pssh_version == 0:
+            pssh_payload_offset = 32
+        elif pssh_version == 1:
+            kid_count = struct.unpack('>I', pssh[28:32])[0]
+            pssh_payload_offset = 32 + (16 * kid_count) + 4
+            if pssh_payload_offset > len(pssh):
+                raise Exception('invalid pssh format')
+        else:
+            raise Exception('pssh version > 1 is not supported')
+        pssh_payload = pssh[pssh_payload_offset:]
+        args += ['--pssh' if pssh_version == 0 else '--pssh-v1', WIDEVINE_PSSH_SYSTEM_ID+':'+WritePsshFile(options, pssh_payload, pssh_digests)]
+
+    # Primetime
+    if options.primetime_metadata:
+        primetime_metadata = ComputePrimetimeMetaData(options.primetime_metadata, default_kid)
+        args += ['--pssh', PRIMETIME_PSSH_SYSTEM_ID+':'+WritePsshFile(options, primetime_metadata, pssh_digests)]
+
+    # the PSSH files are temporary, so the build parameters refer to their content instead
+    parameters = args[:]
+    for (pssh_filename, pssh_digest) in pssh_digests.items():
+        parameters = [arg.replace(pssh_filename, pssh_digest) for arg in parameters]
+
+    RunBuildTask(options,
+                 'encrypt:'+path.abspath(media_file),
+                 [media_file],
+                 [encrypted_filename],
+                 parameters,
+                 Mp4Encrypt,
+                 options,
+                 media_file,
+                 encrypted_filename,
+                 *args)
+
 #############################################
 def EncryptSources(options, media_sources):
     # check if there's anything to encrypt
@@ -1596,16 +1993,17 @@ def EncryptSources(options, media_sources):
             return
 
     encrypted_files = {}
+    job_runner = JobRunner(options.jobs)
     for media_source in [x for x in media_sources if x.format == 'mp4']:
         media_file = media_source.filename
 
         # check if we have already encrypted this file
         if media_file in encrypted_files:
-            media_source.filename = encrypted_files[media_file].name
+            media_source.filename = encrypted_files[media_file]
             continue
 
         if not media_source.mp4_info['movie']['fragments']:
-            PrintErrorAndExit('ERROR: file ' + media_file + ' is not fragmented (use mp4fragment to fragment it)')
+            raise Exception('file ' + media_file + ' is not fragmented (use mp4fragment to fragment it)')
 
         if not len(media_source.mp4_info['tracks']):
             raise Exception('No track found in input file(s)')
@@ -1618,87 +2016,15 @@ def EncryptSources(options, media_sources):
         if not media_source.key_infos:
             continue
 
-        # pick a default key
-        default_kid = options.key_infos[0]['kid']
+        print('Encrypting track IDs ' + str(sorted(media_source.key_infos.keys()) ) +' in ' + GetMappedFileName(options, media_file))
+        encrypted_filename = GetIntermediateFileName(options, 'encrypt:'+path.abspath(media_file))
+        encrypted_files[media_file] = encrypted_filename
+        MapFileName(options, encrypted_filename, path.basename(encrypted_filename) + ' = Encrypted[' + GetMappedFileName(options, media_file) + ']')
+        job_runner.add(EncryptSource, options, media_source, media_file, encrypted_filename)
+        media_source.filename = encrypted_filename
 
-        print('Encrypting track IDs ' + str(sorted(media_source.key_infos.keys()) ) +' in ' + GetMappedFileName(media_file))
-        encrypted_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
-        encrypted_files[media_file] = encrypted_file
-        TempFiles.append(encrypted_file.name)
-        encrypted_file.close() # necessary on Windows
-        MapFileName(encrypted_file.name, path.basename(encrypted_file.name) + ' = Encrypted[' + GetMappedFileName(media_file) + ']')
-        args = ['--method', MpegCencSchemeMap[options.encryption_cenc_scheme]]
-
-        if options.encryption_args:
-            args += options.encryption_args.split()
-        else:
-            if options.smooth or options.playready:
-                args += ['--global-option', 'mpeg-cenc.piff-compatible:true']
-
-        key_set = {}
-        for track_id in sorted(media_source.key_infos.keys()):
-            key_info = media_source.key_infos[track_id]
-            key_set[key_info['kid']] = key_info['key']
-            args += ['--key', str(track_id)+':'+key_info['key']+':'+key_info['iv'], '--property', str(track_id)+':KID:'+key_info['kid']]
-
-        # EME Common Encryption / Clearkey
-        if options.eme_signaling == 'pssh-v0':
-            args += ['--pssh', EME_COMMON_ENCRYPTION_PSSH_SYSTEM_ID+':']
-        elif options.eme_signaling == 'pssh-v1':
-            args += ['--pssh-v1', EME_COMMON_ENCRYPTION_PSSH_SYSTEM_ID+':']
-
-        # Marlin
-        if options.marlin_add_pssh:
-            marlin_pssh = ComputeMarlinPssh(options)
-            pssh_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
-            pssh_file.write(marlin_pssh)
-            TempFiles.append(pssh_file.name)
-            pssh_file.close() # necessary on Windows
-            args += ['--pssh', MARLIN_PSSH_SYSTEM_ID+':'+pssh_file.name]
-
-        # PlayReady
-        if options.playready_add_pssh:
-            playready_header = ComputePlayReadyHeader(options.playready_version,
-                                                      options.playready_header,
-                                                      options.encryption_cenc_scheme,
-                                                      list(key_set.items()))
-            pssh_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
-            pssh_file.write(playready_header)
-            TempFiles.append(pssh_file.name)
-            pssh_file.close() # necessary on Windows
-            args += ['--pssh', PLAYREADY_PSSH_SYSTEM_ID+':'+pssh_file.name]
-
-        # Widevine
-        if options.widevine_header:
-            pssh = ComputeWidevinePssh(options.widevine_header, options.encryption_cenc_scheme, default_kid)
-            pssh_version = pssh[8]
-            if pssh_version == 0:
-                pssh_payload_offset = 32
-            elif pssh_version == 1:
-                kid_count = struct.unpack('>I', pssh[28:32])[0]
-                pssh_payload_offset = 32 + (16 * kid_count) + 4
-                if pssh_payload_offset > len(pssh):
-                    raise Exception('invalid pssh format')
-            else:
-                raise Exception('pssh version > 1 is not supported')
-            pssh_payload = pssh[pssh_payload_offset:]
-            pssh_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
-            pssh_file.write(pssh_payload)
-            TempFiles.append(pssh_file.name)
-            pssh_file.close() # necessary on Windows
-            args += ['--pssh' if pssh_version == 0 else '--pssh-v1', WIDEVINE_PSSH_SYSTEM_ID+':'+pssh_file.name]
-
-        # Primetime
-        if options.primetime_metadata:
-            primetime_metadata = ComputePrimetimeMetaData(options.primetime_metadata, default_kid)
-            pssh_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
-            pssh_file.write(primetime_metadata)
-            TempFiles.append(pssh_file.name)
-            pssh_file.close() # necessary on Windows
-            args += ['--pssh', PRIMETIME_PSSH_SYSTEM_ID+':'+pssh_file.name]
-
-        Mp4Encrypt(options, media_file, encrypted_file.name, *args)
-        media_source.filename = encrypted_file.name
+    # run all the encryption jobs
+    job_runner.run()
 
 #############################################
 def ComputeWidevinePssh(header_spec, encryption_scheme, kid):
@@ -1723,17 +2049,388 @@ def ComputeWidevinePssh(header_spec, encryption_scheme, kid):
     return MakePsshBox(bytes.fromhex(WIDEVINE_PSSH_SYSTEM_ID), header)
 
 #############################################
-FileNameMap = {}
-def MapFileName(from_name, to_name):
-    global FileNameMap
-    FileNameMap[from_name] = to_name
+def MapFileName(options, from_name, to_name):
+    options.file_name_map[from_name] = to_name
+
+def GetMappedFileName(options, filename):
+    return options.file_name_map.get(filename, filename)
+
+#############################################
+def GetIntermediateFileName(options, task_name):
+    # intermediate files are temporary, unless they are kept for the next incremental build
+    if options.build_manifest:
+        return options.build_manifest.get_work_filename(task_name)
+
+    intermediate_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
+    options.temp_files.append(intermediate_file.name)
+    intermediate_file.close() # necessary on Windows
+    return intermediate_file.name
+
+def PlaceMediaFile(options, media_source, media_filename):
+    temporary = media_source.filename in options.temp_files
+    link_mode = PlaceFile(media_source.filename, media_filename, options.link_mode, temporary)
+    if options.verbose:
+        print('Placed', GetMappedFileName(options, media_source.filename), 'at', media_filename, '('+link_mode+')')
+    if link_mode == 'move':
+        # the file now lives in the output directory
+        options.temp_files.remove(media_source.filename)
+        media_source.filename = media_filename
+
+def RemoveTempFiles(options):
+    for f in getattr(options, 'temp_files', []):
+        if path.exists(f):
+            os.unlink(f)
+
+def RunBuildTask(options, name, inputs, outputs, parameters, function, *args, **kwargs):
+    if options.build_manifest:
+        return options.build_manifest.run(name, inputs, outputs, parameters, function, *args, **kwargs)
+    return function(*args, **kwargs)
+
+#############################################
+# Live packaging
+#
+# The inputs are read as they grow. Each new fragment is written out as a
+# segment, or appended to the current segment when fragments are grouped
+# into segments (they are then the parts of LL-HLS segments), and added to
+# the segment index of its track, which only keeps the segments of the time
+# shift window. The MPD and the HLS playlists are then written again from
+# those indexes, so publishing a fragment costs the same at any point of the
+# presentation.
+#############################################
+LIVE_POLL_INTERVAL = 0.1 # seconds
+
+class LiveSource:
+    def __init__(self, options, name):
+        self.name = name
+        self.spec_prefix = ''
+        filename = name
+        if name.startswith('[') and ']' in name:
+            self.spec_prefix = name[:name.find(']')+1]
+            filename = name[len(self.spec_prefix):]
+        if not path.exists(filename):
+            raise Exception('live input ' + filename + ' does not exist')
+        self.reader = Mp4LiveReader(filename)
+        self.fragments = [] # fragments that have not been packaged yet
+        self.tracks = {}    # selected tracks, by track ID
+
+    def read(self):
+        fragments = self.reader.read_fragments()
+        self.fragments += fragments
+        return len(fragments)
+
+    def is_ready(self):
+        # the tracks can be analyzed once there is an init segment and a fragment for each of them
+        track_ids = set([fragment.track_id for fragment in self.fragments])
+        return self.reader.moov is not None and len(track_ids) > 0 and track_ids.issuperset(self.reader.track_ids)
+
+    def make_media_source(self, options):
+        # analyze the tracks with a file made of the start of the stream
+        probe_filename = GetIntermediateFileName(options, 'live-probe:'+self.name)
+        MapFileName(options, probe_filename, self.reader.source)
+        with open(probe_filename, 'wb') as probe:
+            position = len(self.reader.ftyp)+len(self.reader.moov)
+            probe.write(self.reader.ftyp+self.reader.moov)
+            for fragment in self.fragments:
+                fragment.write(probe, position)
+                position += fragment.size
+        media_source = MediaSource(options, self.spec_prefix+probe_filename)
+        media_source.live_source = self
+        return media_source
+
+def ReadLiveSources(options, live_sources):
+    # wait for new fragments, returns False if there have not been any for too long
+    idle_since = time.time()
+    while sum([live_source.read() for live_source in live_sources]) == 0:
+        if time.time()-idle_since > options.live_idle_timeout:
+            return False
+        time.sleep(LIVE_POLL_INTERVAL)
+    return True
+
+def PackageLive(options, set_attributes, sources):
+    live_sources = [LiveSource(options, name) for name in sources]
+
+    # wait until the tracks of all the inputs can be analyzed
+    print('Waiting for the live inputs')
+    while not all([live_source.is_ready() for live_source in live_sources]):
+        if not ReadLiveSources(options, live_sources):
+            raise Exception('no complete fragment for all the tracks of the live inputs after ' + str(options.live_idle_timeout) + ' seconds')
+
+    # select the tracks
+    media_sources = [live_source.make_media_source(options) for live_source in live_sources]
+    with TraceStage('SelectTracks'):
+        (audio_sets, video_sets, subtitles_sets, mp4_files) = SelectTracks(options, media_sources)
+    all_tracks = sum(list(audio_sets.values()) + list(video_sets.values()) + list(subtitles_sets.values()), [])
+    if not all_tracks:
+        raise Exception('no track selected')
+    AssignRepresentationIds(options, audio_sets, video_sets, subtitles_sets)
+
+    # write the init segments and start the segment indexes
+    for track in all_tracks:
+        live_source = track.parent.media_source.live_source
+        live_source.tracks[track.id] = track
+        out_dir = path.join(options.output_dir, track.representation_id)
+        MakeNewDir(out_dir, recursive=True)
+        with open(path.join(out_dir, track.init_segment_name), 'wb') as init_segment:
+            init_segment.write(MakeSplitInitSegment(live_source.reader.ftyp, live_source.reader.moov, track.id))
+        track.live_index = LiveSegmentIndex(track.timescale, options.live_window)
+        track.live_segment_pattern = path.join(out_dir, options.segment_url_pattern)
+        track.live_segment_duration = int(options.segment_duration*track.timescale)
+        track.live_part_target = 0.0 # longest fragment duration, in seconds
+        track.hls_target_duration = 0
+
+    # the presentation starts with the earliest fragment of the selected tracks
+    start_times = []
+    for live_source in live_sources:
+        for fragment in live_source.fragments:
+            track = live_source.tracks.get(fragment.track_id)
+            if track:
+                start_times.append(float(fragment.decode_time or 0)/float(track.timescale))
+    options.live_time_origin = min(start_times)
+    for track in all_tracks:
+        track.live_time_offset = int(round(options.live_time_origin*track.timescale))
+    options.live_start_time = None
+    options.live_ended = False
+
+    while True:
+        # package the new fragments
+        segment_count = 0
+        for live_source in live_sources:
+            for fragment in live_source.fragments:
+                track = live_source.tracks.get(fragment.track_id)
+                if track is None:
+                    continue
+                segment_index = track.live_index
+                independent = fragment.starts_with_sync_sample or track.type != 'video'
+                if independent and segment_index.open_duration+fragment.duration/2 >= track.live_segment_duration:
+                    # start a new segment
+                    segment_index.close()
+                with open(track.live_segment_pattern % segment_index.next_number, 'ab' if segment_index.parts else 'wb') as segment:
+                    fragment.write(segment, segment_index.open_size)
+                segment_index.add_part(fragment.decode_time, fragment.duration, fragment.size, independent)
+                track.live_part_target = max(track.live_part_target, fragment.duration/float(track.timescale))
+                if not options.segment_duration:
+                    # one segment per fragment
+                    segment_index.close()
+                segment_count += 1
+            live_source.fragments = []
+
+        # publish them
+        if segment_count:
+            if options.live_start_time is None:
+                # the most recent segment becomes available now
+                live_edge = max([track.live_index.edge_time()/float(track.timescale) for track in all_tracks])
+                options.live_start_time = time.time()-(live_edge-options.live_time_origin)
+            with TraceStage('OutputManifests'):
+                OutputManifests(options, set_attributes, audio_sets, video_sets, subtitles_sets, [])
+            if options.verbose:
+                print('Published', segment_count, 'new fragment(s)')
+
+        if not ReadLiveSources(options, live_sources):
+            break
 
-def GetMappedFileName(filename):
-    return FileNameMap.get(filename, filename)
+    # the inputs have stopped growing, end the presentation
+    print('End of the live inputs')
+    for track in all_tracks:
+        track.live_index.close()
+    options.live_ended = True
+    OutputManifests(options, set_attributes, audio_sets, video_sets, subtitles_sets, [])
+
+    return all_tracks
+
+#############################################
+# Batch packaging
+#
+# The titles of a jobs file are packaged by a pool of worker processes. Each
+# title is packaged in a new process, forked from the batch process when the
+# platform supports it, so the interpreter start-up, the imports and the
+# discovery of the Bento4 binaries are only paid once, while each title starts
+# from a clean state (options, temporary files, file names). A title that
+# fails, or whose process dies, is reported and does not stop the others.
+#############################################
+BATCH_REPORT_OUTPUT_LINES = 20 # number of lines of output kept in the report of a failed title
+
+def GetBatchJobs(filename):
+    # the jobs that are not valid get an 'error', and are reported as failed
+    jobs = []
+    ids = set()
+    with open(filename) as jobs_file:
+        for (line_number, line) in enumerate(jobs_file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                jobs.append({'id': str(line_number), 'error': 'invalid JSON on line {}: {}'.format(line_number, e)})
+                continue
+            if not isinstance(job, dict) or not isinstance(job.get('sources'), list) or not job['sources']:
+                jobs.append({'id': str(line_number), 'error': 'line {} does not have a list of sources'.format(line_number)})
+                continue
+            job['id'] = str(job.get('id', line_number))
+            if not isinstance(job.get('options', {}), dict):
+                job['error'] = 'the options must be an object'
+            elif job['id'] in ids:
+                job['error'] = 'duplicate id'
+            ids.add(job['id'])
+            jobs.append(job)
+    return jobs
+
+def GetOptionArguments(option_values):
+    # the command line arguments for a dictionary of options, keyed by long option name
+    # (True for a flag, a list for an option that can be repeated, False or None to leave it out)
+    arguments = []
+    for (name, value) in option_values.items():
+        if value is True:
+            arguments.append('--'+name)
+        elif isinstance(value, list):
+            arguments += ['--'+name+'='+str(item) for item in value]
+        elif value is not False and value is not None:
+            arguments.append('--'+name+'='+str(value))
+    return arguments
+
+def GetBatchJobArguments(options, job):
+    # the command line arguments of a job, from its options and sources
+    job_options = job.get('options', {})
+    arguments = GetOptionArguments(job_options)
+    if 'output-dir' not in job_options:
+        arguments.append('--output-dir='+path.join(options.output_dir, job['id']))
+    return arguments+['--']+job['sources']
+
+def RunBatchJob(options, default_exec_dir, job, connection):
+    # package a title, in its worker process, and send its report to the batch process
+    global Options
+    report = {'id': job['id'], 'status': 'failure'}
+    start_time = time.perf_counter()
+    trace = StartTrace()
+
+    # everything the job prints, including the output of the Bento4 tools, goes to a log
+    log = tempfile.TemporaryFile('w+')
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = log
+
+    job_options = None
+    created_output_dir = False
+    try:
+        parser = CreateOptionParser(default_exec_dir)
+        (job_options, args) = parser.parse_args(GetBatchJobArguments(options, job), values=copy.deepcopy(options))
+        job_options.batch = None
+        Options = job_options
+        report['output_dir'] = job_options.output_dir
+        created_output_dir = not path.exists(job_options.output_dir)
+        Package(job_options, args)
+        report['status'] = 'success'
+        if job_options.trace:
+            SaveTrace(job_options.trace)
+    except SystemExit:
+        # PrintErrorAndExit or an invalid option, the error has been printed
+        report['error'] = None
+    except Exception as e:
+        report['error'] = str(e)
+    finally:
+        if job_options is not None:
+            RemoveTempFiles(job_options)
+
+    # do not leave a partial output behind, unless the directory was there before the job
+    if report['status'] != 'success' and created_output_dir:
+        shutil.rmtree(job_options.output_dir, ignore_errors=True)
+
+    log.flush()
+    log.seek(0)
+    output = [line for line in log.read().splitlines() if line.strip()]
+    if report['status'] != 'success':
+        if report['error'] is None:
+            report['error'] = output[-1] if output else 'exited'
+        report['output'] = output[-BATCH_REPORT_OUTPUT_LINES:]
+    report['elapsed'] = time.perf_counter()-start_time
+    report['stages'] = {}
+    report['tools'] = 0.0
+    for event in trace.events:
+        if event['cat'] == 'stage':
+            report['stages'][event['name']] = report['stages'].get(event['name'], 0.0)+event['dur']/1000000.0
+        else:
+            report['tools'] += event['dur']/1000000.0
+    connection.send(report)
+    connection.close()
+
+class BatchWorker:
+    def __init__(self, context, options, default_exec_dir, job, target=RunBatchJob):
+        self.job = job
+        self.start_time = time.perf_counter()
+        (self.connection, sender) = context.Pipe(duplex=False)
+        sys.stdout.flush() # so that a forked process does not print it again
+        self.process = context.Process(target=target, args=(options, default_exec_dir, job, sender))
+        self.process.start()
+        sender.close()
+
+    def finish(self):
+        # called when the report is ready, or when the process has died without sending it
+        try:
+            report = self.connection.recv()
+        except EOFError:
+            report = None
+        self.process.join()
+        self.connection.close()
+        if report is None:
+            report = {'id':      self.job['id'],
+                      'status':  'failure',
+                      'error':   'the worker process exited with code {}'.format(self.process.exitcode),
+                      'elapsed': time.perf_counter()-self.start_time}
+        return report
+
+def RunBatch(options, default_exec_dir):
+    jobs = collections.deque(GetBatchJobs(options.batch))
+    worker_count = options.batch_workers or os.cpu_count() or 1
+    if worker_count < 1:
+        raise Exception('--batch-workers must be at least 1')
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    print('Packaging', len(jobs), 'titles with', worker_count, 'workers')
+
+    # the titles are packaged in sub-directories of the output directory by default
+    if not path.exists(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    report_file = open(options.batch_report, 'w') if options.batch_report else None
+    job_count = len(jobs)
+    failure_count = 0
+    workers = {}
+    try:
+        while jobs or workers:
+            reports = []
+            while jobs and len(workers) < worker_count:
+                job = jobs.popleft()
+                if 'error' in job:
+                    reports.append({'id': job['id'], 'status': 'failure', 'error': job['error'], 'elapsed': 0.0})
+                    continue
+                worker = BatchWorker(context, options, default_exec_dir, job)
+                workers[worker.connection] = worker
+            if workers and not reports:
+                for connection in multiprocessing.connection.wait(list(workers)):
+                    reports.append(workers.pop(connection).finish())
+
+            for report in reports:
+                if report['status'] == 'success':
+                    print('[{}] packaged in {:.3f} s'.format(report['id'], report['elapsed']))
+                else:
+                    failure_count += 1
+                    print('[{}] FAILED: {}'.format(report['id'], report['error']))
+                if report_file:
+                    report_file.write(json.dumps(report, sort_keys=True)+'\n')
+                    report_file.flush()
+    finally:
+        if report_file:
+            report_file.close()
+
+    if failure_count:
+        raise Exception('{} of {} titles failed'.format(failure_count, job_count))
+    print('All', job_count, 'titles packaged')
 
 #############################################
 Options = None
-def main():
+def GetDefaultExecDir():
     # determine the platform binary name
     host_platform = ''
     if platform.system() == 'Linux':
@@ -1752,9 +2449,10 @@ def main():
         default_exec_dir = path.join(SCRIPT_PATH, '..', 'bin')
     if not path.exists(default_exec_dir):
         default_exec_dir = '-'
+    return default_exec_dir
 
-    # parse options
-    parser = OptionParser(usage="%prog [options] <media-file> [<media-file> ...]",
+def CreateOptionParser(default_exec_dir):
+    parser = OptionParser(usage="%prog [options] <media-file> [<media-file> ...]\n       %prog [options] --batch <jobs.jsonl>",
                           description="Each <media-file> is the path to a fragmented MP4 file, optionally prefixed with a stream selector delimited by [ and ]. The same input MP4 file may be repeated, provided that the stream selector prefixes select different streams. Version " + VERSION + " r" + SDK_REVISION)
     parser.add_option('-v', '--verbose', dest="verbose", action='store_true', default=False,
                       help="Be verbose")
@@ -1764,6 +2462,14 @@ def main():
                       help="Output directory", metavar="<output-dir>", default='output')
     parser.add_option('-f', '--force', dest="force_output", action="store_true",
                       help="Allow output to an existing directory", default=False)
+    parser.add_option('', '--link-mode', dest="link_mode", metavar="<mode>", choices=LINK_MODES, default='auto',
+                      help="How media and subtitles files are placed in the output directory when they are not split: "+
+                           "'copy' copies them, 'move' moves temporary files (encrypted or extracted tracks) and copies the others, "+
+                           "'hardlink' and 'reflink' also move temporary files, and hard-link or clone (on filesystems that support it) the others, "+
+                           "falling back to a copy. 'auto' is like 'reflink', with an in-kernel copy as the fallback (default: auto). "+
+                           "With --incremental, hard-linked files keep the modification time of their input instead of the one of the previous build")
+    parser.add_option('', '--incremental', dest="incremental", action="store_true", default=False,
+                      help="Record the inputs, options and outputs of the packaging in a build manifest in the output directory, and when the output directory already has one, only redo the work for outputs whose inputs or options have changed")
     parser.add_option('', '--mpd-name', dest="mpd_filename",
                       help="MPD file name", metavar="<filename>", default='stream.mpd')
     parser.add_option('', '--profiles', dest='profiles',
@@ -1787,6 +2493,11 @@ def main():
                       help="Use segment timelines (necessary if segment durations vary)")
     parser.add_option('', "--min-buffer-time", metavar='<duration>', dest="min_buffer_time", type="float", default=0.0,
                       help="Minimum buffer time (in seconds)")
+    parser.add_option('', "--sample-accurate-bandwidth", dest="sample_accurate_bandwidth", action="store_true", default=False,
+                      help="Compute the required bandwidth of each track from the sizes and durations of its samples, instead of its segments")
+    parser.add_option('', "--estimate", metavar='<fragments>', dest="estimate", type="int", default=0,
+                      help="Only analyze <fragments> fragments of each track (at least 2) and estimate the bitrates from them, "+
+                           "for a quick output that is marked as provisional")
     parser.add_option('', "--max-playout-rate", metavar='<strategy>', dest='max_playout_rate_strategy',
                       help="Max Playout Rate setting strategy for trick-play support. Supported strategies: lowest:X"),
     parser.add_option('', "--language-map", dest="language_map", metavar="<lang_from>:<lang_to>[,...]",
@@ -1873,20 +2584,54 @@ def main():
                       help="Add Clear Key signaling to the MPD (requires an encrypted input, or the --encryption-key option))")
     parser.add_option('', "--clearkey-license-uri", dest="clearkey_license_uri",
                       help="Specify the license/key URI to use for Clear Key (only valid with --clearkey option)")
+    parser.add_option('', "--live", dest="live", action="store_true", default=False,
+                      help="Package live inputs: each <media-file> is a fragmented MP4 file that is still being written, or a directory where the stream is written as a sequence of files (an init segment followed by media segments or CMAF chunks, in name order). "+
+                           "The MPD is dynamic and the HLS playlists (with --hls) are sliding-window live playlists, with delta updates in '*"+HLS_DELTA_PLAYLIST_SUFFIX+".m3u8' playlists (to serve for requests with _HLS_skip=YES). "+
+                           "They are updated as new fragments arrive, until none of the inputs grows any more")
+    parser.add_option('', "--live-window", dest="live_window", metavar="<seconds>", type="float", default=60.0,
+                      help="Duration of the time shift buffer of live presentations (0 for no limit) (default: 60)")
+    parser.add_option('', "--segment-duration", dest="segment_duration", metavar="<seconds>", type="float", default=0.0,
+                      help="Group the fragments of the inputs (CMAF chunks) into segments of about <seconds>, each starting with a sync sample (requires split segments). "+
+                           "With --live, the MPD is a low-latency MPD where the chunks of a segment are available as soon as they are written, "+
+                           "and the chunks are listed as the parts of the segments in the HLS playlists (default: 0, one segment per fragment)")
+    parser.add_option('', "--live-idle-timeout", dest="live_idle_timeout", metavar="<seconds>", type="float", default=10.0,
+                      help="End the live presentation when none of the inputs has grown for <seconds> (default: 10)")
     parser.add_option('', "--exec-dir", metavar="<exec_dir>", dest="exec_dir", default=default_exec_dir,
                       help="Directory where the Bento4 executables are located (use '-' to look for executable in the current PATH)")
-    (options, args) = parser.parse_args()
-    if not args:
-        parser.print_help()
-        sys.exit(1)
-    global Options
-    Options = options
-
+    parser.add_option('', "--trace", dest="trace", metavar="<filename>", default=None,
+                      help="Record the time and resources used by each processing stage and each Bento4 tool, save them to <filename> in the Chrome trace event format, and print a summary at the end")
+    parser.add_option('-j', "--jobs", dest="jobs", metavar="<n>", type="int", default=None,
+                      help="Maximum number of Bento4 tools to run in parallel (default: number of CPUs)")
+    parser.add_option('', "--use-mp4split", dest="use_mp4split", action="store_true", default=False,
+                      help="Split the media files with mp4split, once per track, instead of the built-in splitter, which splits all the tracks of a file in a single pass")
+    parser.add_option('', "--use-mp4dump", dest="use_mp4dump", action="store_true", default=False,
+                      help="Analyze the media files with mp4dump instead of the built-in parser (slower, uses more memory)")
+    parser.add_option('', "--analysis-cache", dest="analysis_cache", metavar="<dir>", default=None,
+                      help="Keep the results of the analysis of the media files in <dir>, and reuse them when the same files are used again")
+    parser.add_option('', "--batch", dest="batch", metavar="<jobs.jsonl>", default=None,
+                      help="Package many titles in one run: each line of <jobs.jsonl> is a JSON object with the 'sources' of a title (a list of <media-file> arguments), "+
+                           "and optionally an 'id' and 'options' (an object mapping long option names to values, true for flags and a list for repeatable options). "+
+                           "The options of the command line apply to all the titles, and each title is packaged in <output-dir>/<id> unless it has an 'output-dir' option")
+    parser.add_option('', "--batch-workers", dest="batch_workers", metavar="<n>", type="int", default=None,
+                      help="Number of titles packaged in parallel in batch mode (default: number of CPUs)")
+    parser.add_option('', "--batch-report", dest="batch_report", metavar="<filename>", default=None,
+                      help="Write a JSON report for each title of the batch (status, error, timings) to <filename>, one per line")
+    return parser
+
+def Package(options, args):
     # set some synthetic (not from command line) options
     options.on_demand = False
     options.key_infos = []
 
+    # the state of the packaging, kept in the options so that each packaging has its own
+    options.temp_files = []           # intermediate files to remove at the end (see RemoveTempFiles)
+    options.file_name_map = {}        # names to print for intermediate files
+    options.mpd_segment_elements = [] # see AddSegmentElements
+
     # check the consistency of the options
+    if options.jobs is not None and options.jobs < 1:
+        raise Exception('--jobs must be at least 1')
+
     if options.smooth:
         options.split = False
         options.use_segment_timeline = True
@@ -1901,18 +2646,21 @@ def main():
 
     if options.exec_dir != "-":
         if not path.exists(options.exec_dir):
-            PrintErrorAndExit('Executable directory does not exist ('+Options.exec_dir+'), use --exec-dir')
+            raise Exception('Executable directory does not exist ('+options.exec_dir+'), use --exec-dir')
 
     if options.max_playout_rate_strategy:
         if not options.max_playout_rate_strategy.startswith('lowest:'):
-            PrintErrorAndExit('Max Playout Rate strategy '+options.max_playout_rate_strategy+' is not supported')
+            raise Exception('Max Playout Rate strategy '+options.max_playout_rate_strategy+' is not supported')
 
     # switch variables
     if options.segment_template_padding:
-        global SEGMENT_PATTERN, SEGMENT_URL_PATTERN, SEGMENT_URL_TEMPLATE
-        SEGMENT_PATTERN      = PADDED_SEGMENT_PATTERN
-        SEGMENT_URL_PATTERN  = PADDED_SEGMENT_URL_PATTERN
-        SEGMENT_URL_TEMPLATE = PADDED_SEGMENT_URL_TEMPLATE
+        options.segment_pattern      = PADDED_SEGMENT_PATTERN
+        options.segment_url_pattern  = PADDED_SEGMENT_URL_PATTERN
+        options.segment_url_template = PADDED_SEGMENT_URL_TEMPLATE
+    else:
+        options.segment_pattern      = NOPAD_SEGMENT_PATTERN
+        options.segment_url_pattern  = NOPAD_SEGMENT_URL_PATTERN
+        options.segment_url_template = NOPAD_SEGMENT_URL_TEMPLATE
 
     # post-process some of the options
     if not options.profiles:
@@ -1955,6 +2703,23 @@ def main():
         if ISOFF_LIVE_PROFILE not in options.profiles:
             raise Exception('--hippo requires the live profile')
 
+    if options.live:
+        if options.on_demand or not options.split or options.use_segment_list or options.smooth or options.hippo:
+            raise Exception('--live only supports DASH and HLS output with split segments and segment templates')
+        if options.encryption_key or options.incremental or options.no_media:
+            raise Exception('--live cannot be used with --encryption-key, --incremental or --no-media')
+        options.use_segment_timeline = True
+
+    if options.segment_duration:
+        if not options.split or options.use_mp4split:
+            raise Exception('--segment-duration requires split segments with the built-in splitter')
+
+    if options.estimate:
+        if options.estimate < 2:
+            raise Exception('--estimate requires at least 2 fragments')
+        if options.live or options.smooth or options.hippo or options.segment_duration or options.sample_accurate_bandwidth:
+            raise Exception('--estimate cannot be used with --live, --smooth, --hippo, --segment-duration or --sample-accurate-bandwidth')
+
     if options.verbose:
         print('Profiles:', ','.join(options.profiles))
 
@@ -2009,31 +2774,60 @@ def main():
     severity = 'ERROR'
     if options.no_media: severity = 'WARNING'
     if options.force_output: severity = None
-    MakeNewDir(dir=options.output_dir, exit_if_exists = not (options.no_media or options.force_output), severity=severity)
-
-    # parse media sources syntax
-    media_sources = [MediaSource(options, source) for source in args]
+    if options.incremental and path.exists(path.join(options.output_dir, BUILD_MANIFEST_NAME)): severity = None
+    MakeNewDir(dir=options.output_dir, exit_if_exists = severity == 'ERROR', severity=severity)
+
+    # live inputs are packaged as they grow
+    if options.live:
+        options.build_manifest = None
+        return PackageLive(options, set_attributes, args)
+
+    # parse media sources syntax and get the info for each of them
+    job_runner = JobRunner(options.jobs)
+    for source in args:
+        job_runner.add(MediaSource, options, source)
+    media_sources = job_runner.run()
+
+    # load the manifest of the previous build, if any
+    options.build_manifest = None
+    if options.incremental:
+        options.build_manifest = BuildManifest(options.output_dir)
+        options.build_manifest.set_options(options,
+                                           excluded = BUILD_MANIFEST_EXCLUDED_OPTIONS,
+                                           secret   = BUILD_MANIFEST_SECRET_OPTIONS)
+        options.build_manifest.set_inputs([media_source.filename for media_source in media_sources])
 
     # for on-demand, we need to first extract tracks into individual media files
     if options.on_demand:
-        (audio_sets, video_sets, subtitles_sets, mp4_files) = SelectTracks(options, media_sources)
+        with TraceStage('SelectTracks'):
+            (audio_sets, video_sets, subtitles_sets, mp4_files) = SelectTracks(options, media_sources)
         media_sources = [x for x in media_sources if x.format == "webvtt"] # Keep subtitles
+        job_runner = JobRunner(options.jobs)
+        extraction_jobs = []
         for track in sum(list(audio_sets.values()) + list(video_sets.values()), []):
-            print('Extracting track', track.id, 'from', GetMappedFileName(track.parent.media_source.filename))
-            track_file = tempfile.NamedTemporaryFile(dir=options.output_dir, delete=False)
-            TempFiles.append(track_file.name)
-            track_file.close() # necessary on Windows
-            MapFileName(track_file.name, path.basename(track_file.name) + ' = Extracted[track '+str(track.id) + ' from '+GetMappedFileName(track.parent.media_source.filename)+']')
-
-            Mp4Fragment(options,
-                        track.parent.media_source.filename,
-                        track_file.name,
-                        track = str(track.id),
-                        index = True,
-                        copy_udta = True,
-                        quiet = True)
-
-            media_source = MediaSource(options, track_file.name)
+            print('Extracting track', track.id, 'from', GetMappedFileName(options, track.parent.media_source.filename))
+            task_name = 'extract:'+path.abspath(track.parent.media_source.filename)+'#'+str(track.id)
+            track_filename = GetIntermediateFileName(options, task_name)
+            MapFileName(options, track_filename, path.basename(track_filename) + ' = Extracted[track '+str(track.id) + ' from '+GetMappedFileName(options, track.parent.media_source.filename)+']')
+
+            fragment_args = dict(track = str(track.id), index = True, copy_udta = True, quiet = True)
+            fragment_job = job_runner.add(RunBuildTask,
+                                          options,
+                                          task_name,
+                                          [track.parent.media_source.filename],
+                                          [track_filename],
+                                          fragment_args,
+                                          Mp4Fragment,
+                                          options,
+                                          track.parent.media_source.filename,
+                                          track_filename,
+                                          **fragment_args)
+            media_source_job = job_runner.add(MediaSource, options, track_filename, depends_on=[fragment_job])
+            extraction_jobs.append((track, media_source_job))
+        job_runner.run()
+
+        for (track, media_source_job) in extraction_jobs:
+            media_source = media_source_job.result
             media_source.spec = track.parent.media_source.spec
             media_sources.append(media_source)
 
@@ -2043,10 +2837,12 @@ def main():
     PrepareSources(options, media_sources)
 
     # encrypt the input files if needed
-    EncryptSources(options, media_sources)
+    with TraceStage('EncryptSources'):
+        EncryptSources(options, media_sources)
 
     # parse the media sources and select the audio and video tracks
-    (audio_sets, video_sets, subtitles_sets, mp4_files) = SelectTracks(options, media_sources)
+    with TraceStage('SelectTracks'):
+        (audio_sets, video_sets, subtitles_sets, mp4_files) = SelectTracks(options, media_sources)
     subtitles_files = SelectSubtitlesFiles(options, media_sources)
 
     # store lists of all tracks by type
@@ -2056,13 +2852,13 @@ def main():
 
     # check that we have at least one audio and one video
     if not audio_tracks and not video_tracks and not subtitles_tracks:
-        PrintErrorAndExit('ERROR: no track selected')
+        raise Exception('no track selected')
 
     # assign key info to tracks
     for track in audio_tracks + video_tracks + subtitles_tracks:
         track.key_info = track.parent.media_source.key_infos.get(track.id, track.key_info)
 
-    if Options.verbose:
+    if options.verbose:
         print('Audio:',     audio_sets)
         print('Video:',     video_sets)
         print('Subtitles:', subtitles_sets)
@@ -2096,7 +2892,7 @@ def main():
             anchor = tracks[0]
             for track in tracks[1:]:
                 if track.segment_scaled_durations[:-1] != anchor.segment_scaled_durations[:-1]:
-                    PrintErrorAndExit('ERROR: video tracks are not aligned ("'+str(track)+'" differs from '+str(anchor)+')')
+                    raise Exception('video tracks are not aligned ("'+str(track)+'" differs from '+str(anchor)+')')
 
     # check that the video segment durations are almost all equal
     if not options.use_segment_timeline:
@@ -2124,34 +2920,12 @@ def main():
                 audio_track.average_segment_duration = video_tracks[0].average_segment_duration
 
     # compute the representation id and init segment name for each track
-    for adaptation_sets in [audio_sets, video_sets, subtitles_sets]:
-        for adaptation_set_name, tracks in list(adaptation_sets.items()):
-            for track in tracks:
-                if not hasattr(track, 'representation_id'):
-                    if options.split:
-                        track.representation_id = '/'.join(adaptation_set_name)
-                        if len(tracks) > 1:
-                            track.representation_id += '/'+str(track.order_index)
-                    else:
-                        track.representation_id = '-'.join(adaptation_set_name)
-                        if len(tracks) > 1:
-                            track.representation_id += '-'+str(track.order_index)
-
-                if options.split:
-                    track.init_segment_name = SPLIT_INIT_SEGMENT_NAME
-                elif options.on_demand:
-                    track.parent.media_name = ONDEMAND_MEDIA_FILE_PATTERN % (options.media_prefix, track.representation_id)
-                else:
-                    track.init_segment_name = NOSPLIT_INIT_FILE_PATTERN % (track.representation_id)
-
-                track.stream_id = adaptation_set_name[0]
-                if adaptation_set_name[0] == 'audio':
-                    track.stream_id += '_'+track.language
+    AssignRepresentationIds(options, audio_sets, video_sets, subtitles_sets)
 
     # compute index and init offsets for the on-demand profile
     if options.on_demand:
         for track in audio_tracks+video_tracks+subtitles_tracks:
-            atoms = WalkAtoms(track.parent.media_source.filename, 'moof')
+            atoms = track.parent.atom_index.atoms('moof')
             for atom in atoms:
                 if atom.type == 'sidx' and not hasattr(track, 'sidx_atom'):
                     track.sidx_atom = atom
@@ -2176,6 +2950,14 @@ def main():
                   track.average_segment_bitrate,
                   track.bandwidth,
                   track.codec))
+    for track in audio_tracks+video_tracks:
+        if track.estimate:
+            print('Estimated {} track {} from {} of {} fragments, bitrate error bound {:.3g}%'.format(
+                  track.type,
+                  str(track),
+                  track.estimate['sampled'],
+                  track.estimate['fragments'],
+                  100.0*track.estimate['error']))
 
     # deal with the max playout strategy if set
     if options.max_playout_rate_strategy:
@@ -2190,61 +2972,146 @@ def main():
             lowest_bandwidth_track.max_playout_rate = max_playout_rate
 
     # create the directories and split/copy/process the media if needed
-    if not options.no_media:
-        if options.split:
-            for adaptation_sets in [audio_sets, video_sets, subtitles_sets]:
-                for adaptation_set_name, tracks in list(adaptation_sets.items()):
-                    for track in tracks:
-                        out_dir = path.join(options.output_dir, track.representation_id)
-                        MakeNewDir(out_dir, recursive=True)
-                        print('Splitting media file ('+adaptation_set_name[0]+')', GetMappedFileName(track.parent.media_source.filename))
-                        Mp4Split(options,
-                                 track.parent.media_source.filename,
-                                 track_id               = str(track.id),
-                                 pattern_parameters     = 'N',
-                                 start_number           = '1',
-                                 init_segment           = path.join(out_dir, track.init_segment_name),
-                                 media_segment          = path.join(out_dir, SEGMENT_PATTERN))
+    with TraceStage('ProcessMedia'):
+        if not options.no_media:
+            job_runner = JobRunner(options.jobs)
+            if options.split:
+                splits = {} # tracks to split with the built-in splitter, by media file
+                for adaptation_sets in [audio_sets, video_sets, subtitles_sets]:
+                    for adaptation_set_name, tracks in list(adaptation_sets.items()):
+                        for track in tracks:
+                            out_dir = path.join(options.output_dir, track.representation_id)
+                            MakeNewDir(out_dir, recursive=True)
+                            print('Splitting media file ('+adaptation_set_name[0]+')', GetMappedFileName(options, track.parent.media_source.filename))
+                            if not options.use_mp4split:
+                                splits.setdefault(track.parent, []).append((track, out_dir))
+                                continue
+
+                            split_args = dict(track_id               = str(track.id),
+                                              pattern_parameters     = 'N',
+                                              start_number           = '1',
+                                              init_segment           = path.join(out_dir, track.init_segment_name),
+                                              media_segment          = path.join(out_dir, options.segment_pattern))
+                            job_runner.add(RunBuildTask,
+                                           options,
+                                           'split:'+track.representation_id,
+                                           [track.parent.media_source.filename],
+                                           [out_dir],
+                                           split_args,
+                                           Mp4Split,
+                                           options,
+                                           track.parent.media_source.filename,
+                                           **split_args)
+
+                # split all the tracks of each media file in a single pass
+                for (mp4_file, split_tracks) in splits.items():
+                    track_splits = dict([(track.id, (path.join(out_dir, track.init_segment_name), path.join(out_dir, options.segment_url_pattern)))
+                                         for (track, out_dir) in split_tracks])
+                    job_runner.add(RunBuildTask,
+                                   options,
+                                   'split:'+','.join([track.representation_id for (track, _) in split_tracks]),
+                                   [mp4_file.media_source.filename],
+                                   [out_dir for (_, out_dir) in split_tracks],
+                                   sorted(track_splits.items()),
+                                   SplitMp4File,
+                                   mp4_file,
+                                   track_splits)
 
-        else:
-            for mp4_file in list(mp4_files.values()):
-                print('Processing and Copying media file', GetMappedFileName(mp4_file.media_source.filename))
-                media_filename = path.join(options.output_dir, mp4_file.media_name)
-                if not options.force_output and path.exists(media_filename):
-                    PrintErrorAndExit('ERROR: file ' + media_filename + ' already exists')
-
-                shutil.copyfile(mp4_file.media_source.filename, media_filename)
-            if options.smooth or options.hippo:
-                for track in audio_tracks+video_tracks+subtitles_tracks:
-                    Mp4Split(options,
-                             track.parent.media_source.filename,
-                             track_id     = str(track.id),
-                             init_only    = True,
-                             init_segment = path.join(options.output_dir, track.init_segment_name))
-
-        if subtitles_files:
-            MakeNewDir(path.join(options.output_dir, 'subtitles'))
-            for subtitles_file in subtitles_files:
-                print('Processing and Copying subtitles file', GetMappedFileName(subtitles_file.media_source.filename))
-                out_dir = path.join(options.output_dir, 'subtitles', subtitles_file.language)
-                MakeNewDir(out_dir)
-                media_filename = path.join(out_dir, subtitles_file.media_name)
-                shutil.copyfile(subtitles_file.media_source.filename, media_filename)
+            else:
+                for mp4_file in list(mp4_files.values()):
+                    print('Processing and Copying media file', GetMappedFileName(options, mp4_file.media_source.filename))
+                    media_filename = path.join(options.output_dir, mp4_file.media_name)
+                    if not (options.force_output or options.build_manifest) and path.exists(media_filename):
+                        raise Exception('file ' + media_filename + ' already exists')
+
+                    RunBuildTask(options,
+                                 'copy:'+mp4_file.media_name,
+                                 [mp4_file.media_source.filename],
+                                 [media_filename],
+                                 [],
+                                 PlaceMediaFile,
+                                 options,
+                                 mp4_file.media_source,
+                                 media_filename)
+                if options.smooth or options.hippo:
+                    for track in audio_tracks+video_tracks+subtitles_tracks:
+                        split_args = dict(track_id     = str(track.id),
+                                          init_only    = True,
+                                          init_segment = path.join(options.output_dir, track.init_segment_name))
+                        job_runner.add(RunBuildTask,
+                                       options,
+                                       'split-init:'+track.init_segment_name,
+                                       [track.parent.media_source.filename],
+                                       [split_args['init_segment']],
+                                       split_args,
+                                       Mp4Split,
+                                       options,
+                                       track.parent.media_source.filename,
+                                       **split_args)
+
+            # run all the split jobs
+            job_runner.run()
+
+            if subtitles_files:
+                MakeNewDir(path.join(options.output_dir, 'subtitles'))
+                for subtitles_file in subtitles_files:
+                    print('Processing and Copying subtitles file', GetMappedFileName(options, subtitles_file.media_source.filename))
+                    out_dir = path.join(options.output_dir, 'subtitles', subtitles_file.language)
+                    MakeNewDir(out_dir)
+                    media_filename = path.join(out_dir, subtitles_file.media_name)
+                    RunBuildTask(options,
+                                 'copy:subtitles/'+subtitles_file.language+'/'+subtitles_file.media_name,
+                                 [subtitles_file.media_source.filename],
+                                 [media_filename],
+                                 [],
+                                 PlaceMediaFile,
+                                 options,
+                                 subtitles_file.media_source,
+                                 media_filename)
+
+    # output the manifests and playlists (they are cheap to compute, so they are always rewritten)
+    RunBuildTask(options,
+                 'manifests',
+                 [],
+                 [options.output_dir],
+                 None,
+                 OutputManifests,
+                 options,
+                 set_attributes,
+                 audio_sets,
+                 video_sets,
+                 subtitles_sets,
+                 subtitles_files)
+
+    # remove the outputs of the previous build that are now obsolete
+    if options.build_manifest:
+        options.build_manifest.finish()
+
+    return audio_tracks + video_tracks + subtitles_tracks
 
-    # output the DASH MPD
-    OutputDash(options, set_attributes, audio_sets, video_sets, subtitles_sets, subtitles_files)
+def main():
+    default_exec_dir = GetDefaultExecDir()
+    parser = CreateOptionParser(default_exec_dir)
+    (options, args) = parser.parse_args()
+    if not args and not options.batch:
+        parser.print_help()
+        sys.exit(1)
+    global Options
+    Options = options
 
-    # output the HLS playlists
-    if options.hls:
-        OutputHls(options, set_attributes, audio_sets, video_sets, subtitles_sets, subtitles_files)
+    if options.batch:
+        if args:
+            raise Exception('<media-file> arguments cannot be used with --batch, the sources are in the jobs file')
+        if options.trace:
+            raise Exception('--trace cannot be used with --batch (it can be set for each job)')
+        RunBatch(options, default_exec_dir)
+        return
 
-    # output the Smooth Manifests
-    if options.smooth:
-        OutputSmooth(options, audio_tracks, video_tracks)
+    # start tracing if requested
+    if options.trace:
+        StartTrace()
 
-    # output the Hippo Manifest
-    if options.hippo:
-        OutputHippo(options, audio_tracks, video_tracks)
+    Package(options, args)
 
 ###########################
 if sys.version_info < (3,7,0):
@@ -2261,5 +3128,7 @@ if __name__ == '__main__':
         else:
             PrintErrorAndExit('ERROR: {}\n'.format(str(err)))
     finally:
-        for f in TempFiles:
-            os.unlink(f)
+        if Options:
+            RemoveTempFiles(Options)
+        if Options and Options.trace:
+            SaveTrace(Options.trace)
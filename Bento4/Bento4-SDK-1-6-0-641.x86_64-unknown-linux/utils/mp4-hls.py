@@ -14,7 +14,6 @@ __copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
 # Windows   --> platform = win32
 
 from optparse import OptionParser
-import shutil
 import platform
 import sys
 import os.path as path
@@ -27,7 +26,12 @@ from mp4utils import Base64Encode,\
                      LanguageNames,\
                      LanguageCodeMap,\
                      PrintErrorAndExit,\
-                     MakeNewDir
+                     MakeNewDir,\
+                     PlaceFile,\
+                     LINK_MODES,\
+                     StartTrace,\
+                     TraceStage,\
+                     SaveTrace
 
 # setup main options
 VERSION = "1.2.0"
@@ -104,11 +108,11 @@ def AnalyzeSources(options, media_sources):
 
         # parse the file
         if not path.exists(media_file):
-            PrintErrorAndExit('ERROR: media file ' + media_file + ' does not exist')
+            raise Exception('media file ' + media_file + ' does not exist')
 
         # get the file info
         print('Parsing media file', media_file)
-        mp4_file = Mp4File(Options, media_source)
+        mp4_file = Mp4File(options, media_source)
         media_source.mp4_file = mp4_file
 
         # remember we have parsed this file
@@ -123,21 +127,21 @@ def AnalyzeSources(options, media_sources):
 
         if media_source.format != 'mp4':
             if track_id or track_type:
-                PrintErrorAndExit('ERROR: track ID and track type selections only apply to MP4 media sources')
+                raise Exception('track ID and track type selections only apply to MP4 media sources')
             continue
 
         if track_id and track_type:
-            PrintErrorAndExit('ERROR: track ID and track type selections are mutually exclusive')
+            raise Exception('track ID and track type selections are mutually exclusive')
 
         if track_id:
             tracks = [media_source.mp4_file.find_track_by_id(track_id)]
             if not tracks:
-                PrintErrorAndExit('ERROR: track id not found for media file '+media_source.name)
+                raise Exception('track id not found for media file '+media_source.name)
 
         if track_type:
             tracks = media_source.mp4_file.find_tracks_by_type(track_type)
             if not tracks:
-                PrintErrorAndExit('ERROR: no ' + track_type + ' found for media file '+media_source.name)
+                raise Exception('no ' + track_type + ' found for media file '+media_source.name)
 
         if not tracks:
             for track in list(media_source.mp4_file.tracks.values()):
@@ -334,7 +338,7 @@ def OutputHls(options, media_sources):
         for audios in audio_tracks.values():
             for audio in audios:
                 if audio.codec_family in ['ec-3'] and audio.dolby_ddp_atmos == 'Yes':
-                    PrintErrorAndExit('ERROR: For Dolby Digital Plus with Dolby Atmos, the format of segment audio cannot be MPEG2TS, please add "--audio-format packed"')
+                    raise Exception('For Dolby Digital Plus with Dolby Atmos, the format of segment audio cannot be MPEG2TS, please add "--audio-format packed"')
     for group_id in audio_tracks:
         group = audio_tracks[group_id]
         MakeNewDir(path.join(options.output_dir, 'audio', group_id))
@@ -384,7 +388,7 @@ def OutputHls(options, media_sources):
             out_dir = path.join(options.output_dir, 'subtitles', subtitles_file.language)
             MakeNewDir(out_dir)
             media_filename = path.join(out_dir, subtitles_file.media_name)
-            shutil.copyfile(subtitles_file.media_source.filename, media_filename)
+            PlaceFile(subtitles_file.media_source.filename, media_filename, options.link_mode)
             relative_url = 'subtitles/'+subtitles_file.language+'/subtitles.m3u8'
             playlist_filename = path.join(out_dir, 'subtitles.m3u8')
             CreateSubtitlesPlaylist(playlist_filename, subtitles_file.media_name, total_duration)
@@ -570,6 +574,14 @@ def main():
                       help="Directory where the Bento4 executables are located")
     parser.add_option('', "--base-url", metavar="<base_url>", dest="base_url", default="",
                       help="The base URL for the Media Playlists and TS files listed in the playlists. This is the prefix for the files.")
+    parser.add_option('', "--link-mode", dest="link_mode", metavar="<mode>", choices=LINK_MODES, default='auto',
+                      help="How subtitles files are placed in the output directory: 'copy' copies them, 'hardlink' and 'reflink' hard-link or clone them (on filesystems that support it), falling back to a copy. 'auto' is like 'reflink', with an in-kernel copy as the fallback (default: auto)")
+    parser.add_option('', "--trace", dest="trace", metavar="<filename>", default=None,
+                      help="Record the time and resources used by each processing stage and each Bento4 tool, save them to <filename> in the Chrome trace event format, and print a summary at the end")
+    parser.add_option('', "--use-mp4dump", dest="use_mp4dump", action="store_true", default=False,
+                      help="Analyze the media files with mp4dump instead of the built-in parser (slower, uses more memory)")
+    parser.add_option('', "--analysis-cache", dest="analysis_cache", metavar="<dir>", default=None,
+                      help="Keep the results of the analysis of the media files in <dir>, and reuse them when the same files are used again")
     (options, args) = parser.parse_args()
     if len(args) == 0:
         parser.print_help()
@@ -580,6 +592,10 @@ def main():
     # set some mandatory options that utils rely upon
     options.min_buffer_time = 0.0
 
+    # start tracing if requested
+    if options.trace:
+        StartTrace()
+
     if options.exec_dir != "-":
         if not path.exists(Options.exec_dir):
             print(Options.exec_dir)
@@ -675,7 +691,8 @@ def main():
     MakeNewDir(dir=options.output_dir, exit_if_exists = not options.force_output, severity=severity)
 
     # output the media playlists
-    OutputHls(options, media_sources)
+    with TraceStage('OutputHls'):
+        OutputHls(options, media_sources)
 
 ###########################
 if sys.version_info[0] != 3:
@@ -691,3 +708,6 @@ if __name__ == '__main__':
             raise
         else:
             PrintErrorAndExit('ERROR: %s\n' % str(err))
+    finally:
+        if Options and Options.trace:
+            SaveTrace(Options.trace)
@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+
+__author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
+__copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
+
+###
+# Replays a recorded fragmented MP4 file as if it was produced by a live
+# encoder: each fragment is written out when the wall clock reaches the end
+# of its media time, either appended to a growing file or as the next file
+# of a directory of chunks. This can be used as the input of
+# 'mp4-dash.py --live' to test live packaging offline.
+
+from optparse import OptionParser
+import os
+import sys
+import time
+import os.path as path
+from mp4utils import Mp4LiveReader, MakeNewDir, PrintErrorAndExit
+
+# setup main options
+VERSION = "1.0.0"
+SDK_REVISION = '641'
+SCRIPT_PATH = path.abspath(path.dirname(__file__))
+sys.path += [SCRIPT_PATH]
+
+INIT_SEGMENT_NAME  = 'init.mp4'
+CHUNK_NAME_PATTERN = 'media-%06d.m4s' # (after the init segment in name order)
+
+#############################################
+def Replay(options, input_filename, output):
+    reader = Mp4LiveReader(input_filename)
+    fragments = reader.read_fragments()
+    if reader.moov is None:
+        PrintErrorAndExit('ERROR: no init segment in ' + input_filename)
+
+    if options.chunks:
+        MakeNewDir(output)
+        with open(path.join(output, INIT_SEGMENT_NAME), 'wb') as init_segment:
+            init_segment.write(reader.ftyp+reader.moov)
+    else:
+        stream = open(output, 'wb')
+        stream.write(reader.ftyp+reader.moov)
+        stream.flush()
+        position = len(reader.ftyp)+len(reader.moov)
+
+    # media times are relative to the start of each track
+    start_times = {}
+    end_times   = {}
+    start = time.time()
+    for (chunk_index, fragment) in enumerate(fragments):
+        timescale = float(reader.timescales[fragment.track_id])
+        decode_time = fragment.decode_time
+        if decode_time is None:
+            decode_time = end_times.get(fragment.track_id, 0)
+        start_times.setdefault(fragment.track_id, decode_time)
+        end_times[fragment.track_id] = decode_time+fragment.duration
+
+        # wait until the fragment would be complete
+        delay = start+(end_times[fragment.track_id]-start_times[fragment.track_id])/timescale/options.speed-time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        if options.chunks:
+            with open(path.join(output, CHUNK_NAME_PATTERN % (chunk_index+1)), 'wb') as chunk:
+                fragment.write(chunk)
+        else:
+            fragment.write(stream, position)
+            stream.flush()
+            position += fragment.size
+        if options.verbose:
+            print('Wrote fragment', chunk_index+1, 'of track', fragment.track_id, '(%d bytes)' % fragment.size)
+
+    if not options.chunks:
+        stream.close()
+
+#############################################
+Options = None
+def main():
+    # parse options
+    parser = OptionParser(usage="%prog [options] <fragmented-mp4-file> <output>",
+                          description="<output> is the file to write, or with --chunks, the directory to write the chunks to. Version " + VERSION + " r" + SDK_REVISION)
+    parser.add_option('-v', '--verbose', dest="verbose", action='store_true', default=False,
+                      help="Be verbose")
+    parser.add_option('-d', '--debug', dest="debug", action='store_true', default=False,
+                      help="Print out debugging information")
+    parser.add_option('', '--speed', dest="speed", metavar="<factor>", type="float", default=1.0,
+                      help="Replay speed, relative to real time (default: 1)")
+    parser.add_option('', '--chunks', dest="chunks", action='store_true', default=False,
+                      help="Write an init segment and one file per fragment to the <output> directory, instead of appending to a single file")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(1)
+    global Options
+    Options = options
+
+    if options.speed <= 0:
+        PrintErrorAndExit('ERROR: --speed must be positive')
+    if path.exists(args[1]):
+        PrintErrorAndExit('ERROR: ' + args[1] + ' already exists')
+
+    Replay(options, args[0], args[1])
+
+###########################
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as err:
+        if Options and Options.debug:
+            raise
+        else:
+            PrintErrorAndExit('ERROR: %s\n' % str(err))
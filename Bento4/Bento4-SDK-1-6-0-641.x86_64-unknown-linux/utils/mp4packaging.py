@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+
+__author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
+__copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
+
+###
+# Library entry point of the packager, for applications that package titles
+# in a long-running process instead of running mp4-dash.py for each of them.
+#
+#   from mp4packaging import PackageDash, PackagingError
+#   result = PackageDash(['video.mp4', 'audio.mp4'], {'output-dir': 'out', 'hls': True})
+#   print(result.mpd, [track['bandwidth'] for track in result.tracks])
+#
+# The options are the long options of mp4-dash.py, without the leading '--'
+# (True for a flag, a list for an option that can be repeated). Each call
+# has its own state (options, temporary files), errors are raised as
+# PackagingError instead of exiting, and the result describes the packaged
+# tracks and the output files.
+# Note that the trace (--trace) is the same for the whole process, so calls
+# that use it should not run concurrently in threads.
+
+import importlib.util
+import os
+import sys
+import time
+import os.path as path
+
+# setup main options
+SCRIPT_PATH = path.abspath(path.dirname(__file__))
+sys.path += [SCRIPT_PATH]
+
+# mp4-dash.py is not a valid module name, so it is loaded from its path
+_spec = importlib.util.spec_from_file_location('mp4dash', path.join(SCRIPT_PATH, 'mp4-dash.py'))
+mp4dash = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(mp4dash)
+
+#############################################
+class PackagingError(Exception):
+    pass
+
+#############################################
+def GetTrackStats(track):
+    stats = {
+        'id':                track.id,
+        'type':              track.type,
+        'codec':             track.codec,
+        'language':          track.language,
+        'representation_id': getattr(track, 'representation_id', None),
+        'bandwidth':         track.bandwidth,
+        'average_bitrate':   track.average_segment_bitrate,
+        'max_bitrate':       track.max_segment_bitrate,
+        'duration':          track.total_duration,
+        'segment_count':     len(track.segment_durations),
+        'media_size':        track.media_size,
+        'estimate':          track.estimate
+    }
+    if track.type == 'video':
+        stats['width']      = track.width
+        stats['height']     = track.height
+        stats['frame_rate'] = getattr(track, 'frame_rate', None)
+    elif track.type == 'audio':
+        stats['sample_rate'] = track.sample_rate
+        stats['channels']    = track.channels
+    return stats
+
+class PackagingResult:
+    def __init__(self, options, tracks, elapsed):
+        self.output_dir = options.output_dir
+        self.mpd        = self.get_output(options.mpd_filename)
+        self.hls        = self.get_output(options.hls_master_playlist_name) if options.hls else None
+        self.smooth     = self.get_output(options.smooth_client_manifest_filename) if options.smooth else None
+        self.tracks     = [GetTrackStats(track) for track in tracks]
+        self.elapsed    = elapsed
+
+        # all the output files, relative to the output directory
+        self.files = []
+        for (dir_path, dir_names, file_names) in os.walk(self.output_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                self.files.append(path.relpath(path.join(dir_path, file_name), self.output_dir))
+
+    def get_output(self, filename):
+        if filename and path.exists(path.join(self.output_dir, filename)):
+            return path.join(self.output_dir, filename)
+        return None
+
+    def __repr__(self):
+        return 'PackagingResult(output_dir={!r}, tracks={}, files={})'.format(self.output_dir, len(self.tracks), len(self.files))
+
+#############################################
+def RaisePackagingError(message):
+    raise PackagingError(message)
+
+def PackageDash(sources, options=None, exec_dir=None):
+    """Package the media sources like mp4-dash.py, and return a PackagingResult.
+
+    sources  -- list of media sources, with the same syntax as on the command line
+    options  -- dictionary of mp4-dash.py options, keyed by long option name
+    exec_dir -- directory of the Bento4 binaries (found like mp4-dash.py does by default)
+    """
+    parser = mp4dash.CreateOptionParser(exec_dir or mp4dash.GetDefaultExecDir())
+    parser.error = RaisePackagingError
+    try:
+        (package_options, args) = parser.parse_args(mp4dash.GetOptionArguments(options or {})+['--']+list(sources))
+    except SystemExit:
+        # --help or --version
+        raise PackagingError('invalid options')
+    if package_options.batch:
+        raise PackagingError('--batch cannot be used with PackageDash')
+    if not args:
+        raise PackagingError('no media source')
+    if package_options.trace:
+        mp4dash.StartTrace()
+
+    start_time = time.perf_counter()
+    try:
+        tracks = mp4dash.Package(package_options, args)
+    except PackagingError:
+        raise
+    except Exception as e:
+        message = str(e)
+        if message.startswith('ERROR: '):
+            message = message[len('ERROR: '):]
+        raise PackagingError(message) from e
+    finally:
+        mp4dash.RemoveTempFiles(package_options)
+        if package_options.trace:
+            mp4dash.SaveTrace(package_options.trace)
+
+    return PackagingResult(package_options, tracks, time.perf_counter()-start_time)
@@ -1,5 +1,5 @@
 import collections
-from functools import reduce
+from functools import reduce, lru_cache
 
 __author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
 __copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
@@ -7,15 +7,30 @@ __copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
 import sys
 import os
 import os.path as path
-from subprocess import check_output, CalledProcessError
+from subprocess import check_output, CalledProcessError, Popen, PIPE
 import json
-import io
 import struct
+import array
+import mmap
+import tempfile
+import concurrent.futures
+import contextlib
+import threading
+import time
 import operator
 import hashlib
 import fractions
 import xml.sax.saxutils as saxutils
 import base64
+import shutil
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # not available on Windows
 
 LanguageCodeMap = {
     'aar': 'aa', 'abk': 'ab', 'afr': 'af', 'aka': 'ak', 'alb': 'sq', 'amh': 'am', 'ara': 'ar', 'arg': 'an',
@@ -249,6 +264,10 @@ def XmlDuration(d):
         xsd += ('%.3fS' % (s))
     return xsd
 
+def XmlDateTime(t):
+    # t is a number of seconds since the epoch
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t))+('.%03dZ' % (int(t*1000) % 1000))
+
 def BooleanFromString(string):
     if string is None:
         return False
@@ -260,6 +279,145 @@ def Base64Encode(x):
 def Base64Decode(x):
     return base64.b64decode(x)
 
+#############################################
+# Tracing
+#
+# When a trace is started, every Bento4 command and every stage wrapped in a
+# TraceStage block is recorded with its wall time, CPU time, peak RSS and the
+# number of bytes it has read and written. The trace can be saved in the
+# Chrome trace event format (for chrome://tracing or Perfetto).
+#############################################
+CurrentTrace = None
+
+class Trace:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.events     = []
+        self.lock       = threading.Lock()
+
+    def add_event(self, category, name, start_time, end_time, cpu_time, peak_rss, bytes_read, bytes_written, **args):
+        args.update({'cpu_time': cpu_time,
+                     'peak_rss': peak_rss,
+                     'bytes_read': bytes_read,
+                     'bytes_written': bytes_written})
+        event = {'name': name,
+                 'cat':  category,
+                 'ph':   'X',
+                 'ts':   int(1000000*(start_time-self.start_time)),
+                 'dur':  int(1000000*(end_time-start_time)),
+                 'pid':  os.getpid(),
+                 'tid':  threading.get_ident(),
+                 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, filename):
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, trace_file, indent=1)
+
+    def print_summary(self):
+        if not self.events:
+            return
+        totals = collections.OrderedDict()
+        for event in sorted(self.events, key=lambda event: event['ts']):
+            total = totals.setdefault((event['cat'], event['name']), [0, 0, 0.0, 0, 0, 0])
+            total[0] += 1
+            total[1] += event['dur']
+            total[2] += event['args']['cpu_time']
+            total[3] = max(total[3], event['args']['peak_rss'])
+            total[4] += event['args']['bytes_read']
+            total[5] += event['args']['bytes_written']
+
+        print('{:<8} {:<24} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('TYPE', 'NAME', 'COUNT', 'WALL (s)', 'CPU (s)', 'RSS (MB)', 'READ (MB)', 'WRITE (MB)'))
+        for ((category, name), total) in totals.items():
+            print('{:<8} {:<24} {:>6} {:>10.3f} {:>10.3f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                  category, name, total[0], total[1]/1000000.0, total[2], total[3]/1048576.0, total[4]/1048576.0, total[5]/1048576.0))
+
+def StartTrace():
+    global CurrentTrace
+    CurrentTrace = Trace()
+    return CurrentTrace
+
+def SaveTrace(filename):
+    # save the trace and print a summary of where the time was spent
+    if CurrentTrace is None:
+        return
+    CurrentTrace.save(filename)
+    CurrentTrace.print_summary()
+
+def GetIoCounters(pid='self'):
+    # number of bytes read and written by a process (only available on Linux)
+    counters = {}
+    try:
+        with open('/proc/'+str(pid)+'/io') as io_file:
+            for line in io_file:
+                (name, value) = line.split(':')
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return (counters.get('rchar', 0), counters.get('wchar', 0))
+
+def GetPeakRss(usage):
+    # NOTE: on Linux, the peak RSS of a child process is at least the RSS
+    # of its parent when it was started
+    if usage is None:
+        return 0
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss # already in bytes
+    return 1024*usage.ru_maxrss
+
+@contextlib.contextmanager
+def TraceStage(name, **args):
+    if CurrentTrace is None:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    (start_bytes_read, start_bytes_written) = GetIoCounters()
+    try:
+        yield
+    finally:
+        (bytes_read, bytes_written) = GetIoCounters()
+        usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+        CurrentTrace.add_event('stage', name, start_time, time.perf_counter(),
+                               time.process_time()-start_cpu_time,
+                               GetPeakRss(usage),
+                               bytes_read-start_bytes_read,
+                               bytes_written-start_bytes_written,
+                               **args)
+
+def RunCommand(cmd):
+    if CurrentTrace is None or not hasattr(os, 'wait4'):
+        start_time = time.perf_counter()
+        output = check_output(cmd)
+        if CurrentTrace:
+            CurrentTrace.add_event('command', path.basename(cmd[0]), start_time, time.perf_counter(), 0.0, 0, 0, 0, command=' '.join(cmd))
+        return output
+
+    # run the command and get its resource usage when it exits
+    start_time = time.perf_counter()
+    process = Popen(cmd, stdout=PIPE)
+    output = process.stdout.read()
+    process.stdout.close()
+    (bytes_read, bytes_written) = (0, 0)
+    if hasattr(os, 'waitid'):
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT) # wait for the exit, but keep the process around
+        (bytes_read, bytes_written) = GetIoCounters(process.pid)
+    (_, status, usage) = os.wait4(process.pid, 0)
+    end_time = time.perf_counter()
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    CurrentTrace.add_event('command', path.basename(cmd[0]), start_time, end_time,
+                           usage.ru_utime+usage.ru_stime,
+                           GetPeakRss(usage),
+                           bytes_read,
+                           bytes_written,
+                           command=' '.join(cmd))
+    if process.returncode:
+        raise CalledProcessError(process.returncode, cmd, output)
+    return output
+
 def Bento4Command(options, name, *args, **kwargs):
     executable = path.join(options.exec_dir, name) if options.exec_dir != '-' else name
     cmd = [executable]
@@ -281,12 +439,12 @@ def Bento4Command(options, name, *args, **kwargs):
         print('COMMAND: ', " ".join(cmd), cmd)
     try:
         try:
-            return check_output(cmd)
+            return RunCommand(cmd)
         except OSError as e:
             if options.debug:
                 print('executable ' + executable + ' not found in exec_dir, trying with PATH')
             cmd[0] = path.basename(cmd[0])
-            return check_output(cmd)
+            return RunCommand(cmd)
     except CalledProcessError as e:
         message = "binary tool failed with error %d" % e.returncode
         if options.verbose:
@@ -317,7 +475,76 @@ def Mp42Hls(options, input_filename, *args, **kwargs):
 def Mp4IframeIndex(options, input_filename, *args, **kwargs):
     return Bento4Command(options, 'mp4iframeindex', input_filename, *args, **kwargs)
 
+#############################################
+class Job:
+    def __init__(self, index, function, args, kwargs, dependencies):
+        self.index        = index
+        self.function     = function
+        self.args         = args
+        self.kwargs       = kwargs
+        self.dependencies = dependencies
+        self.dependents   = []
+        self.result       = None
+        self.exception    = None
+        self.done         = False
+
+class JobRunner:
+    """
+    Runs a graph of jobs (typically functions that invoke Bento4 commands) on a
+    pool of worker threads. A job is started when all the jobs it depends on
+    have completed. The results are returned in the order in which the jobs
+    were added, and if a job fails, no new job is started and the error of the
+    first failed job (in the order in which they were added) is raised.
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.jobs = []
+
+    def add(self, function, *args, depends_on=None, **kwargs):
+        # dependencies must be jobs that have already been added, so there can't be any cycle
+        job = Job(len(self.jobs), function, args, kwargs, [dependency for dependency in (depends_on or []) if not dependency.done])
+        for dependency in job.dependencies:
+            dependency.dependents.append(job)
+        self.jobs.append(job)
+        return job
+
+    def run(self):
+        jobs = self.jobs
+        self.jobs = []
+        waiting_count = dict([(job, len(job.dependencies)) for job in jobs])
+        ready = collections.deque([job for job in jobs if not job.dependencies])
+        running = {}
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            while ready or running:
+                while ready and not failed:
+                    job = ready.popleft()
+                    running[executor.submit(job.function, *job.args, **job.kwargs)] = job
+                if not running:
+                    break
+                (completed, _) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in sorted(completed, key=lambda future: running[future].index):
+                    job = running.pop(future)
+                    try:
+                        job.result = future.result()
+                        job.done = True
+                    except Exception as e:
+                        job.exception = e
+                        failed.append(job)
+                        continue
+                    for dependent in job.dependents:
+                        waiting_count[dependent] -= 1
+                        if waiting_count[dependent] == 0:
+                            ready.append(dependent)
+
+        if failed:
+            raise min(failed, key=lambda job: job.index).exception
+
+        return [job.result for job in jobs]
+
 class Mp4Atom:
+    __slots__ = ['type', 'size', 'position'] # there is one for each top-level atom of a file
+
     def __init__(self, type, size, position):
         self.type     = type
         self.size     = size
@@ -327,27 +554,389 @@ class Mp4Atom:
         return 'ATOM: ' + self.type + ',' + str(self.size) + '@' + str(self.position)
 
 
-def WalkAtoms(filename, until=None):
-    cursor = 0
-    atoms = []
-    file = io.FileIO(filename, "rb")
-    while True:
-        try:
-            size = struct.unpack('>I', file.read(4))[0]
-            type = file.read(4).decode('ascii')
+def FourCC(type):
+    return struct.unpack('>I', type.encode('latin-1'))[0]
+
+@lru_cache(maxsize=None) # the same string object is shared by all the atoms of a type
+def FourCCString(value):
+    return struct.pack('>I', value).decode('latin-1')
+
+# the pages of the memory-mapped file that have been read are released in chunks of this size,
+# so that the resident memory does not grow with the size of the file
+MP4_ATOM_INDEX_RELEASE_SIZE = 16*1024*1024
+
+# atoms that the index descends into
+MP4_INDEXED_CONTAINER_ATOMS = set([FourCC(x) for x in ['moov', 'trak', 'mdia', 'minf', 'stbl', 'mvex', 'moof', 'traf',
+                                                        'mfra', 'edts', 'dinf', 'udta', 'sinf', 'schi', 'tref']])
+
+# atoms that the index descends into for an estimated analysis, which does not look
+# into most of the fragments
+MP4_ESTIMATE_INDEXED_CONTAINER_ATOMS = MP4_INDEXED_CONTAINER_ATOMS - set([FourCC('moof'), FourCC('traf')])
+
+class Mp4AtomIndex:
+    """
+    Index of all the atoms of a file (top-level atoms and the children of container atoms),
+    built once from a memory-mapped view of the file.
+    Atoms are stored in depth-first order, in compact arrays, and identified by their
+    position in those arrays.
+    """
+    def __init__(self, filename, container_atoms=MP4_INDEXED_CONTAINER_ATOMS):
+        self.filename     = filename
+        self.containers   = container_atoms # types of the atoms to descend into
+        self.types        = array.array('I')
+        self.positions    = array.array('Q')
+        self.sizes        = array.array('Q')
+        self.header_sizes = array.array('B')
+        self.parents      = array.array('i') # -1 for top-level atoms
+        self.data         = None
+        self.released     = 0 # end of the pages that have been released
+
+        with open(filename, 'rb') as file:
+            self.file_size = os.fstat(file.fileno()).st_size
+            if self.file_size:
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data is not None:
+            self.index_atoms(0, self.file_size, -1)
+
+    def index_atoms(self, start, end, parent):
+        position = start
+        while position+8 <= end:
+            (size, type) = struct.unpack_from('>II', self.data, position)
+            header_size = 8
+            if size == 1:
+                if position+16 > end:
+                    break
+                size = struct.unpack_from('>Q', self.data, position+8)[0]
+                header_size = 16
+            elif size == 0:
+                # the atom extends to the end of its container
+                size = end-position
+            if size < header_size or position+size > end:
+                # invalid or truncated atom, stop here
+                break
+
+            index = len(self.types)
+            self.types.append(type)
+            self.positions.append(position)
+            self.sizes.append(size)
+            self.header_sizes.append(header_size)
+            self.parents.append(parent)
+            if type in self.containers:
+                self.index_atoms(position+header_size, position+size, index)
+
+            position += size
+            if parent == -1:
+                self.release(position)
+
+        if parent == -1:
+            self.released = 0 # the atoms may be read again
+
+    def release(self, end):
+        # release the pages of the mapping before end (they are read again from the file if needed)
+        if end-self.released < MP4_ATOM_INDEX_RELEASE_SIZE or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        end -= end % mmap.PAGESIZE
+        self.data.madvise(mmap.MADV_DONTNEED, self.released, end-self.released)
+        self.released = end
+
+    def close(self):
+        # release the mapping (the index itself remains usable)
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    def __len__(self):
+        return len(self.types)
+
+    def type(self, index):
+        return FourCCString(self.types[index])
+
+    def atom(self, index):
+        return Mp4Atom(self.type(index), self.sizes[index], self.positions[index])
+
+    def children(self, parent=-1):
+        return [i for i in range(len(self.types)) if self.parents[i] == parent]
+
+    def find(self, type, parent=-1):
+        value = FourCC(type)
+        for i in range(len(self.types)):
+            if self.types[i] == value and self.parents[i] == parent:
+                return i
+        return None
+
+    def atoms(self, until=None):
+        # list of the top-level atoms, optionally stopping at the first atom of a given type
+        atoms = []
+        for i in self.children():
+            type = self.type(i)
             if type == until:
                 break
-            if size == 1:
-                size = struct.unpack('>Q', file.read(8))[0]
-            atoms.append(Mp4Atom(type, size, cursor))
-            cursor += size
-            file.seek(cursor)
-        except Exception:
-            break
+            atoms.append(Mp4Atom(type, self.sizes[i], self.positions[i]))
+        return atoms
 
-    return atoms
+def WalkAtoms(filename, until=None):
+    atom_index = Mp4AtomIndex(filename)
+    atom_index.close()
+    return atom_index.atoms(until)
 
 
+#############################################
+# Native atom parser
+#
+# Builds a tree with the same shape and field names as the one obtained
+# from 'mp4dump --format json --verbosity 1', but only for the atoms that
+# the tools actually use. All other atoms are only listed with their name
+# and size.
+#############################################
+MP4_CONTAINER_ATOMS   = ['moov', 'trak', 'mdia', 'minf', 'stbl', 'mvex', 'moof', 'traf', 'mfra', 'sinf', 'schi']
+MP4_TOP_LEVEL_PARSED  = ['moov', 'moof', 'mfra', 'sidx']
+MP4_FRAGMENT_ATOMS    = ['moof', 'mdat']
+
+def ParseAtomHeader(data, offset, available):
+    if available < 8:
+        raise Exception('truncated atom header')
+    (size, type) = struct.unpack_from('>I4s', data, offset)
+    header_size = 8
+    if size == 1:
+        if available < 16:
+            raise Exception('truncated atom header')
+        size = struct.unpack_from('>Q', data, offset+8)[0]
+        header_size = 16
+    elif size == 0:
+        size = available
+    if size < header_size or size > available:
+        raise Exception('invalid atom size')
+    return (type.decode('latin-1'), size, header_size)
+
+def ParseTkhdFields(atom, data, offset, version, flags):
+    atom['id'] = struct.unpack_from('>I', data, offset+(16 if version == 1 else 8))[0]
+
+def ParseMdhdFields(atom, data, offset, version, flags):
+    atom['timescale'] = struct.unpack_from('>I', data, offset+(16 if version == 1 else 8))[0]
+
+def ParseTrexFields(atom, data, offset, version, flags):
+    (atom['track id'],
+     _,
+     atom['default sample duration'],
+     atom['default sample size'],
+     atom['default sample flags']) = struct.unpack_from('>IIIII', data, offset)
+
+def ParseTfhdFields(atom, data, offset, version, flags):
+    atom['flags'] = flags
+    atom['track ID'] = struct.unpack_from('>I', data, offset)[0]
+    offset += 4
+    if flags & 0x01:
+        atom['base data offset'] = struct.unpack_from('>Q', data, offset)[0]
+        offset += 8
+    if flags & 0x02: offset += 4 # sample description index
+    for (flag, name) in [(0x08, 'default sample duration'), (0x10, 'default sample size'), (0x20, 'default sample flags')]:
+        if flags & flag:
+            atom[name] = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+
+def ParseTfdtFields(atom, data, offset, version, flags):
+    atom['base media decode time'] = struct.unpack_from('>Q' if version == 1 else '>I', data, offset)[0]
+
+def ParseTrunFields(atom, data, offset, version, flags):
+    atom['flags'] = flags
+    sample_count = struct.unpack_from('>I', data, offset)[0]
+    atom['sample count'] = sample_count
+    offset += 4
+    if flags & 0x001:
+        atom['data offset'] = struct.unpack_from('>i', data, offset)[0]
+        offset += 4
+    if flags & 0x004:
+        atom['first sample flags'] = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+
+    # keep the sample durations, sizes and flags (but not the composition time offsets)
+    entry_fields = bin(flags & 0xF00).count('1')
+    if entry_fields and flags & 0x700:
+        values = struct.unpack_from('>'+str(sample_count*entry_fields)+'I', data, offset)
+        field_index = 0
+        for (flag, name) in [(0x100, 'sample durations'), (0x200, 'sample sizes'), (0x400, 'sample flags')]:
+            if flags & flag:
+                atom[name] = values[field_index::entry_fields]
+                field_index += 1
+
+def ParseTencFields(atom, data, offset, version, flags):
+    kid = data[offset+4:offset+20]
+    atom['default_KID'] = '[' + ' '.join(['%02x' % x for x in kid]) + ']'
+
+def ParseTfraFields(atom, data, offset, version, flags):
+    (track_id, lengths, entry_count) = struct.unpack_from('>III', data, offset)
+    offset += 12
+    atom['track_ID'] = track_id
+    number_sizes = [((lengths >> 4) & 3)+1, ((lengths >> 2) & 3)+1, (lengths & 3)+1]
+    entries = []
+    for i in range(entry_count):
+        if version == 1:
+            (time, moof_offset) = struct.unpack_from('>QQ', data, offset)
+            offset += 16
+        else:
+            (time, moof_offset) = struct.unpack_from('>II', data, offset)
+            offset += 8
+        numbers = []
+        for number_size in number_sizes:
+            numbers.append(int.from_bytes(data[offset:offset+number_size], 'big'))
+            offset += number_size
+        entries.append({
+            'time':          time,
+            'moof_offset':   moof_offset,
+            'traf_number':   numbers[0],
+            'trun_number':   numbers[1],
+            'sample_number': numbers[2]
+        })
+    atom['entries'] = entries
+
+def ParseSidxFields(atom, data, offset, version, flags):
+    (atom['reference_ID'], atom['timescale']) = struct.unpack_from('>II', data, offset)
+    offset += 8
+    if version == 0:
+        (atom['earliest_presentation_time'], atom['first_offset']) = struct.unpack_from('>II', data, offset)
+        offset += 8
+    else:
+        (atom['earliest_presentation_time'], atom['first_offset']) = struct.unpack_from('>QQ', data, offset)
+        offset += 16
+    reference_count = struct.unpack_from('>H', data, offset+2)[0]
+    offset += 4
+    entries = []
+    for i in range(reference_count):
+        (reference, duration, sap) = struct.unpack_from('>III', data, offset)
+        offset += 12
+        entries.append({
+            'reference_type':      reference >> 31,
+            'referenced_size':     reference & 0x7FFFFFFF,
+            'subsegment_duration': duration,
+            'starts_with_SAP':     sap >> 31,
+            'SAP_type':            (sap >> 28) & 7,
+            'SAP_delta_time':      sap & 0x0FFFFFFF
+        })
+    atom['entries'] = entries
+
+Mp4AtomFieldParsers = {
+    'tkhd': ParseTkhdFields,
+    'mdhd': ParseMdhdFields,
+    'trex': ParseTrexFields,
+    'tfhd': ParseTfhdFields,
+    'tfdt': ParseTfdtFields,
+    'trun': ParseTrunFields,
+    'tenc': ParseTencFields,
+    'tfra': ParseTfraFields,
+    'sidx': ParseSidxFields
+}
+
+# offset from the start of the payload to the first child, for atoms that have children after some fields
+Mp4SampleEntryChildrenOffsets = {
+    'stsd': 8,      # full atom header + entry count
+    'encv': 8+70,   # sample entry header + visual sample entry fields
+    'enca': 8+20    # sample entry header + audio sample entry fields
+}
+
+def ParseAtomChildren(data, offset, end):
+    children = []
+    while offset+8 <= end:
+        child = ParseAtom(data, offset, end-offset)
+        children.append(child)
+        offset += child['size']
+    return children
+
+def ParseAtom(data, offset, available):
+    (type, size, header_size) = ParseAtomHeader(data, offset, available)
+    atom = {'name': type, 'size': size}
+    payload_offset = offset+header_size
+    end = offset+size
+    if type in Mp4AtomFieldParsers:
+        (version_and_flags,) = struct.unpack_from('>I', data, payload_offset)
+        Mp4AtomFieldParsers[type](atom, data, payload_offset+4, version_and_flags >> 24, version_and_flags & 0xFFFFFF)
+    elif type in MP4_CONTAINER_ATOMS:
+        atom['children'] = ParseAtomChildren(data, payload_offset, end)
+    elif type in Mp4SampleEntryChildrenOffsets:
+        atom['children'] = ParseAtomChildren(data, payload_offset+Mp4SampleEntryChildrenOffsets[type], end)
+    return atom
+
+def IterMp4Atoms(atom_index, parsed_types=MP4_TOP_LEVEL_PARSED):
+    # the top-level atoms, parsed one at a time (only those of the parsed types, the
+    # others are only listed with their name and size), so that a caller that processes
+    # them in order does not need to keep them all in memory
+    for i in atom_index.children():
+        type = atom_index.type(i)
+        size = atom_index.sizes[i]
+        if type in parsed_types:
+            yield ParseAtom(atom_index.data, atom_index.positions[i], size)
+            atom_index.release(atom_index.positions[i]+size)
+        else:
+            yield {'name': type, 'size': size}
+    atom_index.released = 0
+
+def ParseMp4Atoms(filename, atom_index=None, parsed_types=MP4_TOP_LEVEL_PARSED):
+    if atom_index is None:
+        atom_index = Mp4AtomIndex(filename)
+    return list(IterMp4Atoms(atom_index, parsed_types))
+
+def ComputeTrunDuration(trun, default_sample_duration):
+    if 'entries' in trun:
+        # tree obtained from mp4dump
+        return sum([int(entry.get('d', default_sample_duration)) for entry in trun['entries']])
+    if 'sample durations' in trun:
+        return sum(trun['sample durations'])
+    return trun['sample count']*default_sample_duration
+
+def GetTfraEntries(tfra):
+    if 'entries' in tfra:
+        return tfra['entries']
+
+    # tree obtained from mp4dump
+    entries = []
+    for (name, value) in list(tfra.items()):
+        if name.startswith('['):
+            entry = {}
+            for attribute in value.split(','):
+                (attribute_name, attribute_value) = attribute.strip().split('=')
+                entry[attribute_name] = int(attribute_value)
+            entries.append(entry)
+    return entries
+
+def GetMoofTrackInfo(data, position, size):
+    # (track ID, base media decode time or None) of a 'moof' atom, without parsing its 'trun' atoms
+    (_, size, header_size) = ParseAtomHeader(data, position, size)
+    track_ids = []
+    decode_time = None
+    for (type, traf_position, traf_size, traf_header_size) in IterAtoms(data, position+header_size, position+size):
+        if type != 'traf':
+            continue
+        for (type, child_position, child_size, child_header_size) in IterAtoms(data, traf_position+traf_header_size, traf_position+traf_size):
+            if type == 'tfhd':
+                track_ids.append(struct.unpack_from('>I', data, child_position+child_header_size+4)[0])
+            elif type == 'tfdt':
+                version = data[child_position+child_header_size]
+                decode_time = struct.unpack_from('>Q' if version == 1 else '>I', data, child_position+child_header_size+4)[0]
+            elif type == 'trun':
+                # the 'tfhd' and 'tfdt' atoms come first
+                break
+    if len(track_ids) != 1:
+        raise Exception('unsupported input file, more than one "traf" box in fragment')
+    return (track_ids[0], decode_time)
+
+def GetTrunSamples(trun, default_sample_duration, default_sample_size, default_sample_flags):
+    # returns the (durations, sizes, flags) sample columns of a 'trun'
+    sample_count = trun['sample count']
+    if 'entries' in trun:
+        # tree obtained from mp4dump
+        entries   = trun['entries']
+        durations = [int(entry.get('d', default_sample_duration)) for entry in entries]
+        sizes     = [int(entry.get('s', default_sample_size)) for entry in entries]
+        flags     = [int(entry.get('f', default_sample_flags)) for entry in entries]
+    else:
+        durations = trun.get('sample durations', [default_sample_duration]*sample_count)
+        sizes     = trun.get('sample sizes', [default_sample_size]*sample_count)
+        flags     = trun.get('sample flags', [default_sample_flags]*sample_count)
+    if 'first sample flags' in trun and sample_count:
+        # this overrides the default flags for the first sample only
+        flags = [trun['first sample flags']]+list(flags[1:])
+    return (durations, sizes, flags)
+
 def FilterChildren(parent, type):
     if isinstance(parent, list):
         children = parent
@@ -367,15 +956,35 @@ class Mp4Track:
         self.parent                   = parent
         self.info                     = info
         self.default_sample_duration  = 0
+        self.default_sample_size      = 0
+        self.default_sample_flags     = 0
         self.timescale                = 0
-        self.moofs                    = []
-        self.sample_counts            = []
-        self.segment_sizes            = []
-        self.segment_durations        = []
-        self.segment_scaled_durations = []
-        self.segment_bitrates         = []
+
+        # per-segment tables (one entry per fragment, except for sample_counts which has one entry per 'trun')
+        self.moofs                    = array.array('I') # index of the fragment in the parent's segments
+        self.sample_counts            = array.array('I')
+        self.segment_offsets          = array.array('Q') # position of the 'moof'
+        self.segment_lengths          = array.array('Q') # number of bytes from the 'moof' to the next fragment
+        self.segment_sizes            = array.array('Q') # size of the 'moof' and 'mdat' and anything in between
+        self.segment_sample_counts    = array.array('I')
+        self.segment_durations        = array.array('d')
+        self.segment_scaled_durations = array.array('Q')
+        self.segment_bitrates         = array.array('Q')
+        self.segment_iframe_offsets   = array.array('Q') # position of the first sample, for video tracks
+        self.segment_iframe_sizes     = array.array('Q') # size of the first sample if it is a sync sample, 0 otherwise
+
+        # fragments of each segment, when segments are made of several fragments (CMAF chunks)
+        self.fragment_moofs           = None # index of each fragment in the parent's segments
+        self.segment_fragment_counts  = None
+
+        # per-sample tables (only set when the file is analyzed with sample_tables=True)
+        self.sample_durations         = None
+        self.sample_sizes             = None
+        self.sample_sync_flags        = None
+
         self.total_sample_count       = 0
         self.total_duration           = 0
+        self.estimate                 = None # sampled fragments and error bound, for an estimated analysis
         self.total_scaled_duration    = 0
         self.media_size               = 0
         self.average_segment_duration = 0
@@ -439,9 +1048,9 @@ class Mp4Track:
                         elif 'db4h' in self.parent.info['file']['compatible_brands']:
                             self.dv_brand = 'db4h'
                     else:
-                        PrintErrorAndExit('ERROR: unsupported ccid for Dolby Vision profile 8/9.')
+                        raise Exception('unsupported ccid for Dolby Vision profile 8/9.')
                 else:
-                    PrintErrorAndExit('ERROR: unsupported Dolby Vision profile.')
+                    raise Exception('unsupported Dolby Vision profile.')
 
         if self.type == 'audio':
             self.sample_rate = sample_desc['sample_rate']
@@ -477,13 +1086,78 @@ class Mp4Track:
         self.language = info['language']
         self.language_name = LanguageNames.get(LanguageCodeMap.get(self.language, 'und'), '')
 
+    def add_segment_size(self, segment_size, segment_duration):
+        self.segment_sizes.append(segment_size)
+        if segment_duration > 0.0:
+            segment_bitrate = int((8.0 * float(segment_size)) / segment_duration)
+        else:
+            segment_bitrate = 0
+        self.segment_bitrates.append(segment_bitrate)
+
+    def add_samples(self, durations, sizes, flags):
+        self.sample_durations.extend(durations)
+        self.sample_sizes.extend(sizes)
+        self.sample_sync_flags.extend([0 if sample_flags & 0x10000 else 1 for sample_flags in flags]) # sample_is_non_sync_sample
+
+    def get_iframe_index(self):
+        # same entries as the output of mp4iframeindex for the track: one for each
+        # fragment that starts with a sync sample
+        return [{'size': size, 'offset': offset, 'fragmentStart': fragment_start}
+                for (size, offset, fragment_start) in zip(self.segment_iframe_sizes, self.segment_iframe_offsets, self.segment_offsets)
+                if size]
+
+    def group_segments(self, segment_duration):
+        # merge consecutive fragments into segments of about segment_duration seconds,
+        # starting a new segment only on a fragment that starts with a sync sample
+        target_duration = segment_duration*self.timescale
+        segment_starts = []
+        duration = 0
+        for (i, fragment_duration) in enumerate(self.segment_scaled_durations):
+            independent = self.type != 'video' or self.segment_iframe_sizes[i]
+            if not segment_starts or (independent and duration+fragment_duration/2 >= target_duration):
+                segment_starts.append(i)
+                duration = 0
+            duration += fragment_duration
+        if len(segment_starts) == len(self.moofs):
+            return
+        segments = list(zip(segment_starts, segment_starts[1:]+[len(self.moofs)])) # (first fragment, end) of each segment
+
+        self.fragment_moofs           = self.moofs
+        self.segment_fragment_counts  = array.array('I', [end-start for (start, end) in segments])
+        self.moofs                    = array.array('I', [self.moofs[start] for (start, _) in segments])
+        self.segment_lengths          = array.array('Q', [self.segment_offsets[end-1]+self.segment_lengths[end-1]-self.segment_offsets[start]
+                                                          for (start, end) in segments])
+        self.segment_offsets          = array.array('Q', [self.segment_offsets[start] for (start, _) in segments])
+        self.segment_sizes            = array.array('Q', [sum(self.segment_sizes[start:end]) for (start, end) in segments])
+        self.segment_sample_counts    = array.array('I', [sum(self.segment_sample_counts[start:end]) for (start, end) in segments])
+        self.segment_scaled_durations = array.array('Q', [sum(self.segment_scaled_durations[start:end]) for (start, end) in segments])
+        self.segment_durations        = array.array('d', [float(duration)/float(self.timescale) for duration in self.segment_scaled_durations])
+        self.segment_bitrates         = array.array('Q', [int(8.0*float(size)/duration) if duration > 0.0 else 0
+                                                          for (size, duration) in zip(self.segment_sizes, self.segment_durations)])
+        if self.type == 'video':
+            self.segment_iframe_offsets = array.array('Q', [self.segment_iframe_offsets[start] for (start, _) in segments])
+            self.segment_iframe_sizes   = array.array('Q', [self.segment_iframe_sizes[start] for (start, _) in segments])
+
+    def get_sample_sizes_and_durations(self):
+        # sample sizes, with the overhead of each fragment (the 'moof' and 'mdat' headers)
+        # counted in the size of its first sample, and sample durations in seconds
+        sizes = array.array('Q', self.sample_sizes)
+        sample_index = 0
+        for (segment_size, sample_count) in zip(self.segment_sizes, self.segment_sample_counts):
+            overhead = segment_size-sum(self.sample_sizes[sample_index:sample_index+sample_count])
+            if sample_count and overhead > 0:
+                sizes[sample_index] += overhead
+            sample_index += sample_count
+        durations = [float(duration)/float(self.timescale) for duration in self.sample_durations]
+        return (sizes, durations)
+
     def update(self, options):
         # compute the total number of samples
-        self.total_sample_count = reduce(operator.add, self.sample_counts, 0)
+        self.total_sample_count = sum(self.sample_counts)
 
         # compute the total duration
         self.total_duration = reduce(operator.add, self.segment_durations, 0)
-        self.total_scaled_duration = reduce(operator.add, self.segment_scaled_durations, 0)
+        self.total_scaled_duration = sum(self.segment_scaled_durations)
 
         # compute the average segment durations
         segment_count = len(self.segment_durations)
@@ -496,7 +1170,7 @@ class Mp4Track:
             self.average_segment_duration = 0
 
         # compute the average segment bitrates
-        self.media_size = reduce(operator.add, self.segment_sizes, 0)
+        self.media_size = sum(self.segment_sizes)
         if self.total_duration:
             self.average_segment_bitrate = int(8.0*float(self.media_size)/self.total_duration)
 
@@ -509,7 +1183,10 @@ class Mp4Track:
         # compute the bandwidth
         if options.min_buffer_time == 0.0:
             options.min_buffer_time = self.average_segment_duration
-        self.bandwidth = ComputeBandwidth(options.min_buffer_time, self.segment_sizes, self.segment_durations)
+        if self.sample_sizes is not None and self.timescale:
+            self.bandwidth = ComputeSlidingWindowBandwidth(options.min_buffer_time, *self.get_sample_sizes_and_durations())
+        else:
+            self.bandwidth = ComputeBandwidth(options.min_buffer_time, self.segment_sizes, self.segment_durations)
 
         if self.type == 'video':
             # compute the frame rate
@@ -537,7 +1214,8 @@ class Mp4Track:
         return 'File '+str(self.parent.file_list_index)+'#'+str(self.id)
 
 class Mp4File:
-    def __init__(self, options, media_source):
+    def __init__(self, options, media_source, sample_tables=False, update=True, estimate=0):
+        # with estimate > 0, only that many fragments of each track are parsed (see estimate_track)
         self.media_source    = media_source
         self.info            = media_source.mp4_info
         self.tracks          = {}
@@ -550,8 +1228,13 @@ class Mp4File:
         # by default, the media name is the basename of the source file
         self.media_name = path.basename(filename)
 
-        # walk the atom structure
-        self.atoms = WalkAtoms(filename)
+        # index the atom structure
+        if estimate:
+            sample_tables = False
+            self.atom_index = Mp4AtomIndex(filename, MP4_ESTIMATE_INDEXED_CONTAINER_ATOMS)
+        else:
+            self.atom_index = Mp4AtomIndex(filename)
+        self.atoms = self.atom_index.atoms()
         self.segments = []
         for atom in self.atoms:
             if atom.type == 'moov':
@@ -565,13 +1248,119 @@ class Mp4File:
         if options.debug:
             print('  found', len(self.segments), 'segments')
 
+        self.create_tracks(sample_tables)
+
+        # get the segment tables from a previous run if possible, or parse the file
+        # (estimated tables are not cached, so that a full analysis replaces them)
+        analysis_cache = None
+        if options.analysis_cache and not estimate:
+            analysis_cache = AnalysisCache(options.analysis_cache)
+        self.tree = None
+        with TraceStage('Mp4File', file=filename):
+            if analysis_cache and analysis_cache.load_analysis(self, sample_tables):
+                if options.debug:
+                    print('  using cached analysis')
+            elif estimate:
+                self.parse_estimate(options, filename, estimate)
+            else:
+                self.parse(options, filename, sample_tables)
+                if analysis_cache:
+                    analysis_cache.store_analysis(self)
+            self.atom_index.close()
+
+        # compute the track statistics, unless the caller wants to do that later
+        # (this may update the min buffer time option, so callers that analyze
+        # several files concurrently do it afterwards, in a deterministic order)
+        if update:
+            self.update(options)
+
+    def create_tracks(self, sample_tables):
         for track in self.info['tracks']:
             self.tracks[track['id']] = Mp4Track(self, track)
+            if sample_tables:
+                self.tracks[track['id']].sample_durations  = array.array('I')
+                self.tracks[track['id']].sample_sizes      = array.array('I')
+                self.tracks[track['id']].sample_sync_flags = array.array('B')
+
+    def update(self, options):
+        # compute the total numer of samples for each track
+        for track_id in self.tracks:
+            self.tracks[track_id].update(options)
 
-        # get a complete file dump
+        # print debug info if requested
+        if options.debug:
+            for track in self.tracks.values():
+                print('Track ID                     =', track.id)
+                print('    Segment Count            =', len(track.segment_durations))
+                print('    Type                     =', track.type)
+                print('    Sample Count             =', track.total_sample_count)
+                print('    Average segment bitrate  =', track.average_segment_bitrate)
+                print('    Max segment bitrate      =', track.max_segment_bitrate)
+                print('    Required bandwidth       =', int(track.bandwidth))
+                print('    Average segment duration =', track.average_segment_duration)
+
+    def parse(self, options, filename, sample_tables):
+        # parse the atoms we need, or get a complete file dump if that fails or if requested.
+        # The built-in parser streams the fragments: the tree only has the atoms that are not
+        # part of a fragment, and each 'moof' is parsed when its segment is added to the tables,
+        # then dropped, so the memory used does not grow with the number of samples.
+        if not options.use_mp4dump:
+            try:
+                self.tree = [atom for atom in IterMp4Atoms(self.atom_index, [type for type in MP4_TOP_LEVEL_PARSED if type not in MP4_FRAGMENT_ATOMS])
+                             if atom['name'] not in MP4_FRAGMENT_ATOMS]
+                self.parse_segments(IterMp4Atoms(self.atom_index, MP4_FRAGMENT_ATOMS), sample_tables)
+                self.atom_index.close()
+                return
+            except Exception as e:
+                if options.debug:
+                    print('  native parsing failed (' + str(e) + '), falling back to mp4dump')
+                self.tree = None
+                self.create_tracks(sample_tables)
+        self.atom_index.close()
         json_dump = Mp4Dump(options, filename, format='json', verbosity='1')
         self.tree = json.loads(json_dump, strict=False, object_pairs_hook=collections.OrderedDict)
+        self.parse_segments(self.tree, sample_tables)
+
+    def parse_estimate(self, options, filename, sample_count):
+        # like parse, but only the moov and sample_count fragments of each track are parsed,
+        # or the whole file if it cannot be analyzed that way
+        if not options.use_mp4dump:
+            try:
+                self.tree = [atom for atom in IterMp4Atoms(self.atom_index, [type for type in MP4_TOP_LEVEL_PARSED if type not in MP4_FRAGMENT_ATOMS])
+                             if atom['name'] not in MP4_FRAGMENT_ATOMS]
+                self.estimate_segments(sample_count)
+                self.atom_index.close()
+                return
+            except Exception as e:
+                if options.debug:
+                    print('  estimated analysis failed (' + str(e) + '), doing a full analysis')
+                self.tree = None
+                self.create_tracks(False)
+        self.parse(options, filename, False)
+
+    def parse_segments(self, atoms, sample_tables):
+        # atoms are the top-level atoms, in order, with the 'moof' atoms parsed
+        self.parse_track_defaults()
+
+        # partition the segments
+        segment_index = 0
+        track = None
+        segment_size = 0
+        for atom in atoms:
+            segment_size += atom['size']
+            if atom['name'] == 'moof':
+                segment_size = atom['size']
+                track = self.add_fragment(atom, segment_index, sample_tables)
+                segment_index += 1
+            elif atom['name'] == 'mdat':
+                # end of fragment on 'mdat' atom
+                if track:
+                    track.add_segment_size(segment_size, track.segment_durations[-1])
+                segment_size = 0
+
+        self.index_segments()
 
+    def parse_track_defaults(self):
         # look for KIDs
         for track in self.tracks.values():
             track.compute_kid()
@@ -584,6 +1373,8 @@ class Mp4File:
                         for c2 in c1['children']:
                             if c2['name'] == 'trex':
                                 self.tracks[c2['track id']].default_sample_duration = c2['default sample duration']
+                                self.tracks[c2['track id']].default_sample_size     = c2['default sample size']
+                                self.tracks[c2['track id']].default_sample_flags    = c2['default sample flags']
                     elif c1['name'] == 'trak':
                         track_id = 0
                         for c2 in c1['children']:
@@ -595,99 +1386,254 @@ class Mp4File:
                                     if c3['name'] == 'mdhd':
                                         self.tracks[track_id].timescale = c3['timescale']
 
-        # partition the segments
-        segment_index = 0
-        track = None
-        segment_size = 0
-        segment_duration_sec = 0.0
-        for atom in self.tree:
-            segment_size += atom['size']
-            if atom['name'] == 'moof':
-                segment_size = atom['size']
-                trafs = FilterChildren(atom, 'traf')
-                if len(trafs) != 1:
-                    PrintErrorAndExit('ERROR: unsupported input file, more than one "traf" box in fragment')
-                tfhd = FilterChildren(trafs[0], 'tfhd')[0]
-                track = self.tracks[tfhd['track ID']]
-                track.moofs.append(segment_index)
-                segment_duration = 0
-                default_sample_duration = tfhd.get('default sample duration', track.default_sample_duration)
-                for trun in FilterChildren(trafs[0], 'trun'):
-                    track.sample_counts.append(trun['sample count'])
-                    for entry in trun['entries']:
-                        sample_duration = int(entry.get('d', default_sample_duration))
-                        segment_duration += sample_duration
-                track.segment_scaled_durations.append(segment_duration)
-                segment_duration_sec = float(segment_duration) / float(track.timescale)
-                track.segment_durations.append(segment_duration_sec)
-                segment_index += 1
-
-                # remove the 'trun' entries to save some memory
-                for traf in trafs:
-                    traf['children'] = [x for x in traf['children'] if x['name'] != 'trun']
-            elif atom['name'] == 'mdat':
-                # end of fragment on 'mdat' atom
-                if track:
-                    track.segment_sizes.append(segment_size)
-                    if segment_duration_sec > 0.0:
-                        segment_bitrate = int((8.0 * float(segment_size)) / segment_duration_sec)
-                    else:
-                        segment_bitrate = 0
-                    track.segment_bitrates.append(segment_bitrate)
-                segment_size = 0
+    def add_fragment(self, moof, segment_index, sample_tables):
+        # add a parsed 'moof' to the segment tables of its track, and return the track
+        trafs = FilterChildren(moof, 'traf')
+        if len(trafs) != 1:
+            raise Exception('unsupported input file, more than one "traf" box in fragment')
+        tfhd = FilterChildren(trafs[0], 'tfhd')[0]
+        track = self.tracks[tfhd['track ID']]
+        track.moofs.append(segment_index)
+        segment_duration = 0
+        segment_sample_count = 0
+        default_sample_duration = tfhd.get('default sample duration', track.default_sample_duration)
+        base_data_offset = tfhd.get('base data offset', self.segments[segment_index][0].position)
+        iframe = None # (offset, size) of the I-frame
+        for trun in FilterChildren(trafs[0], 'trun'):
+            track.sample_counts.append(trun['sample count'])
+            segment_sample_count += trun['sample count']
+            if sample_tables or (track.type == 'video' and iframe is None):
+                (durations, sizes, flags) = GetTrunSamples(trun,
+                                                           default_sample_duration,
+                                                           tfhd.get('default sample size', track.default_sample_size),
+                                                           tfhd.get('default sample flags', track.default_sample_flags))
+                if sample_tables:
+                    track.add_samples(durations, sizes, flags)
+
+                # the I-frame of the fragment (for I-frame playlists) is its first
+                # sample, if it is a sync sample (this is what mp4iframeindex does)
+                if track.type == 'video' and iframe is None and flags:
+                    iframe = (base_data_offset+trun.get('data offset', 0),
+                              sizes[0] if not flags[0] & 0x10000 else 0) # sample_is_non_sync_sample
+                segment_duration += sum(durations)
+            else:
+                segment_duration += ComputeTrunDuration(trun, default_sample_duration)
+        if track.type == 'video':
+            (iframe_offset, iframe_size) = iframe or (0, 0)
+            track.segment_iframe_offsets.append(iframe_offset)
+            track.segment_iframe_sizes.append(iframe_size)
+        track.segment_sample_counts.append(segment_sample_count)
+        track.segment_scaled_durations.append(segment_duration)
+        track.segment_durations.append(float(segment_duration) / float(track.timescale))
+
+        # remove the 'trun' entries to save some memory
+        for traf in trafs:
+            traf['children'] = [x for x in traf['children'] if x['name'] != 'trun']
+
+        return track
+
+    def index_segments(self):
+        # compute the byte range of each fragment
+        for track in self.tracks.values():
+            for segment_index in track.moofs:
+                segment = self.segments[segment_index]
+                track.segment_offsets.append(segment[0].position)
+                track.segment_lengths.append(sum([atom.size for atom in segment]))
 
         # parse the 'mfra' index if there is one and update segment durations.
         # this is needed to deal with input files that have an 'mfra' index that
         # does not exactly match the sample durations (because of rounding errors),
         # which will make the Smooth Streaming URL mapping fail since the IIS Smooth Streaming
         # server uses the 'mfra' index to locate the segments in the source .ismv file
+        for (track_id, durations) in self.get_mfra_durations().items():
+            track = self.tracks[track_id]
+            for (i, moof_duration) in durations.items():
+                track.segment_durations[i] = float(moof_duration) / float(track.timescale)
+                track.segment_scaled_durations[i] = moof_duration
+
+    def get_mfra_durations(self):
+        # durations of the fragments of each track that are between two consecutive
+        # 'moof' pointers of the 'mfra' index, by track ID and fragment index
+        mfra_durations = {}
+        mfra = FindChild(self.tree, ['mfra'])
+        if not mfra:
+            return mfra_durations
+        for tfra in FilterChildren(mfra, 'tfra'):
+            track_id = tfra['track_ID']
+            if track_id not in self.tracks:
+                continue
+            track = self.tracks[track_id]
+
+            # pointers to the first sample of the first trun of the first traf, used as start time indications
+            moof_pointers = [entry for entry in GetTfraEntries(tfra)
+                             if entry['traf_number'] == 1 and entry['trun_number'] == 1 and entry['sample_number'] == 1]
+            durations = mfra_durations.setdefault(track_id, {})
+            for i in range(len(moof_pointers)-1):
+                if i+1 >= len(track.moofs):
+                    break
+
+                moof1 = self.segments[track.moofs[i]][0]
+                moof2 = self.segments[track.moofs[i+1]][0]
+                if moof1.position == moof_pointers[i]['moof_offset'] and moof2.position == moof_pointers[i+1]['moof_offset']:
+                    # pointers match two consecutive moofs
+                    durations[i] = moof_pointers[i+1]['time'] - moof_pointers[i]['time']
+        return mfra_durations
+
+    def get_sidx_durations(self, track):
+        # durations of the fragments of a track from its 'sidx' index, if it has one
+        durations = []
+        for sidx in FilterChildren(self.tree, 'sidx'):
+            if sidx['reference_ID'] != track.id:
+                continue
+            for entry in sidx['entries']:
+                if entry['reference_type']:
+                    # hierarchical index
+                    return None
+                durations.append(entry['subsegment_duration']*track.timescale//sidx['timescale'])
+        return durations
+
+    def get_fragment_tracks(self):
+        # (track ID, decode time or None) of the fragments by 'moof' position, from the 'mfra'
+        # index, or None if it does not point to every fragment. (The 'sidx' index is not used
+        # here, its subsegments can have fragments of other tracks than the reference one)
+        fragment_tracks = {}
         mfra = FindChild(self.tree, ['mfra'])
         if mfra:
             for tfra in FilterChildren(mfra, 'tfra'):
-                track_id = tfra['track_ID']
-                if track_id not in self.tracks:
-                    continue
-                track = self.tracks[track_id]
-                moof_pointers = []
-                for (name, value) in list(tfra.items()):
-                    if name.startswith('['):
-                        attributes = value.split(',')
-                        attribute_dict = {}
-                        for attribute in attributes:
-                            (attribute_name, attribute_value) = attribute.strip().split('=')
-                            attribute_dict[attribute_name] = int(attribute_value)
-                        if attribute_dict['traf_number'] == 1 and attribute_dict['trun_number'] == 1 and attribute_dict['sample_number'] == 1:
-                            # this points to the first sample of the first trun of the first traf, use it as a start time indication
-                            moof_pointers.append(attribute_dict)
-                if len(moof_pointers) > 1:
-                    for i in range(len(moof_pointers)-1):
-                        if i+1 >= len(track.moofs):
-                            break
+                for entry in GetTfraEntries(tfra):
+                    if entry['traf_number'] == 1 and entry['trun_number'] == 1 and entry['sample_number'] == 1:
+                        fragment_tracks[entry['moof_offset']] = (tfra['track_ID'], entry['time'])
+                    else:
+                        fragment_tracks.setdefault(entry['moof_offset'], (tfra['track_ID'], None))
+        if all([segment[0].position in fragment_tracks for segment in self.segments]):
+            return fragment_tracks
 
-                        moof1 = self.segments[track.moofs[i]][0]
-                        moof2 = self.segments[track.moofs[i+1]][0]
-                        if moof1.position == moof_pointers[i]['moof_offset'] and moof2.position == moof_pointers[i+1]['moof_offset']:
-                            # pointers match two consecutive moofs
-                            moof_duration = moof_pointers[i+1]['time'] - moof_pointers[i]['time']
-                            moof_duration_sec = float(moof_duration) / float(track.timescale)
-                            track.segment_durations[i] = moof_duration_sec
-                            track.segment_scaled_durations[i] = moof_duration
+        if len(self.tracks) == 1:
+            track_id = list(self.tracks)[0]
+            return dict([(segment[0].position, (track_id, None)) for segment in self.segments])
+        return None
 
-        # compute the total numer of samples for each track
-        for track_id in self.tracks:
-            self.tracks[track_id].update(options)
+    def estimate_segments(self, sample_count):
+        # find the track and size of each fragment from the index, or else from the 'moof'
+        # headers, without parsing their 'trun' atoms
+        data = self.atom_index.data
+        fragment_tracks = self.get_fragment_tracks()
+        fragments = dict([(track_id, []) for track_id in self.tracks])
+        segment_tracks = []
+        for (segment_index, segment) in enumerate(self.segments):
+            moof = segment[0]
+            if fragment_tracks is None:
+                (track_id, decode_time) = GetMoofTrackInfo(data, moof.position, moof.size)
+                self.atom_index.release(moof.position+moof.size)
+            else:
+                (track_id, decode_time) = fragment_tracks[moof.position]
+            segment_size = 0
+            for atom in segment:
+                segment_size += atom.size
+                if atom.type == 'mdat':
+                    break
+            else:
+                raise Exception('unsupported input file, no "mdat" box in fragment')
+            segment_tracks.append((track_id, len(fragments[track_id])))
+            fragments[track_id].append((segment_index, segment_size, decode_time))
+        self.atom_index.released = 0
+
+        # parse sample_count fragments of each track, evenly spaced and including the first
+        # and the last one, in file order so that the pages can be released as we go
+        sampled = {}
+        for (track_id, track_fragments) in fragments.items():
+            fragment_count = len(track_fragments)
+            if fragment_count > sample_count:
+                sampled[track_id] = set([(i*(fragment_count-1))//(sample_count-1) for i in range(sample_count)])
+            else:
+                sampled[track_id] = set(range(fragment_count))
+        self.parse_track_defaults()
+        for (segment_index, (track_id, i)) in enumerate(segment_tracks):
+            track = self.tracks[track_id]
+            if i in sampled[track_id]:
+                moof = self.segments[segment_index][0]
+                if self.add_fragment(ParseAtom(data, moof.position, moof.size), segment_index, False) is not track:
+                    raise Exception('fragment is not in the track given by the index')
+                self.atom_index.release(moof.position+moof.size)
+            else:
+                # filled in by estimate_track (there is no I-frame information for the fragments that are not sampled)
+                track.moofs.append(segment_index)
+                if track.type == 'video':
+                    track.segment_iframe_offsets.append(0)
+                    track.segment_iframe_sizes.append(0)
+                track.segment_sample_counts.append(0)
+                track.segment_scaled_durations.append(0)
+                track.segment_durations.append(0.0)
+        self.atom_index.released = 0
+
+        estimated = {}
+        for (track_id, track_fragments) in fragments.items():
+            if track_fragments:
+                estimated[track_id] = self.estimate_track(self.tracks[track_id], track_fragments, sampled[track_id])
+        self.index_segments()
+
+        # the durations that are corrected with the 'mfra' index are exact
+        for (track_id, durations) in self.get_mfra_durations().items():
+            if track_id in estimated and all([i in durations for i in estimated[track_id]]):
+                self.tracks[track_id].estimate['error'] = 0.0
+
+    def estimate_track(self, track, fragments, sampled):
+        # the durations of the fragments that are not sampled are taken from the 'sidx' index
+        # or the decode times when they agree with the sampled fragments, or else extrapolated
+        # from the sampled fragments, and so are the sample counts.
+        # Returns the indices of the fragments with an extrapolated duration.
+        fragment_count = len(fragments)
+
+        # find a timeline that agrees with the sampled fragments
+        decode_times = [decode_time for (_, _, decode_time) in fragments]
+        timelines = [self.get_sidx_durations(track)]
+        if None not in decode_times:
+            timelines.append([decode_times[i+1]-decode_times[i] for i in range(fragment_count-1)])
+        timeline = None
+        for durations in timelines:
+            if durations and len(durations) >= fragment_count-1 and \
+               all([durations[i] == track.segment_scaled_durations[i] for i in sampled if i < len(durations)]):
+                timeline = durations
+                break
 
-        # print debug info if requested
-        if options.debug:
-            for track in self.tracks.values():
-                print('Track ID                     =', track.id)
-                print('    Segment Count            =', len(track.segment_durations))
-                print('    Type                     =', track.type)
-                print('    Sample Count             =', track.total_sample_count)
-                print('    Average segment bitrate  =', track.average_segment_bitrate)
-                print('    Max segment bitrate      =', track.max_segment_bitrate)
-                print('    Required bandwidth       =', int(track.bandwidth))
-                print('    Average segment duration =', track.average_segment_duration)
+        # the average duration of the sampled fragments, not counting the last one, which could be shorter
+        sampled_durations = [track.segment_scaled_durations[i] for i in sorted(sampled) if i < fragment_count-1]
+        if not sampled_durations:
+            sampled_durations = [track.segment_scaled_durations[-1]]
+        average_duration = float(sum(sampled_durations))/len(sampled_durations)
+        sampled_duration     = sum([track.segment_scaled_durations[i] for i in sampled])
+        sampled_sample_count = sum([track.segment_sample_counts[i] for i in sampled])
+
+        estimated = []
+        for i in range(fragment_count):
+            if i in sampled:
+                continue
+            if timeline:
+                segment_duration = timeline[i]
+            else:
+                segment_duration = int(round(average_duration))
+                estimated.append(i)
+            segment_sample_count = int(round(float(segment_duration)*sampled_sample_count/sampled_duration)) if sampled_duration else 0
+            track.sample_counts.append(segment_sample_count)
+            track.segment_sample_counts[i]    = segment_sample_count
+            track.segment_scaled_durations[i] = segment_duration
+            track.segment_durations[i]        = float(segment_duration) / float(track.timescale)
+
+        for (i, (segment_index, segment_size, decode_time)) in enumerate(fragments):
+            track.add_segment_size(segment_size, track.segment_durations[i])
+
+        # relative error bound of the bitrates, assuming that the durations of the fragments
+        # that are not sampled are in the range of the sampled ones
+        error = 0.0
+        if estimated and average_duration:
+            error = max(1.0-min(sampled_durations)/average_duration, max(sampled_durations)/average_duration-1.0)
+        track.estimate = {'sampled': len(sampled), 'fragments': fragment_count, 'error': error}
+        return estimated
+
+    def group_segments(self, segment_duration):
+        # group the fragments of each track (CMAF chunks) into segments
+        for track in self.tracks.values():
+            track.group_segments(segment_duration)
 
     def find_track_by_id(self, track_id_to_find):
         for track_id in self.tracks:
@@ -727,10 +1673,18 @@ class MediaSource:
         else:
             self.format = 'mp4'
 
-        # if the file is an mp4 file, get the mp4 info now
+        # if the file is an mp4 file, get the mp4 info now (or reuse the one from a previous run)
         if self.format == 'mp4':
-            json_info = Mp4Info(options, self.filename, format='json', fast=True)
-            self.mp4_info = json.loads(json_info, strict=False)
+            with TraceStage('MediaSource', file=self.filename):
+                json_info = None
+                if options.analysis_cache:
+                    analysis_cache = AnalysisCache(options.analysis_cache)
+                    json_info = analysis_cache.load_info(self.filename)
+                if json_info is None:
+                    json_info = Mp4Info(options, self.filename, format='json', fast=True)
+                    if options.analysis_cache:
+                        analysis_cache.store_info(self.filename, json_info)
+                self.mp4_info = json.loads(json_info, strict=False)
 
         # keep a record of our original filename in case it gets changed later
         self.original_filename = self.filename
@@ -738,28 +1692,883 @@ class MediaSource:
     def __repr__(self):
         return self.name
 
+#############################################
+# Built-in splitter
+#
+# Splits a fragmented MP4 file into an init segment and media segments for
+# each of its tracks, in one sequential pass over the file, using the atom
+# index of an Mp4File. The init segments are the 'ftyp' and 'moov' atoms,
+# keeping only the 'trak' and 'trex' atoms of the track. The media segments
+# are the 'moof' atoms with the 'mdat' atoms that follow them, copied as-is,
+# except for absolute base data offsets in 'tfhd' atoms, which are made
+# relative to the start of the segment.
+#############################################
+def IterAtoms(data, start, end):
+    position = start
+    while position < end:
+        (type, size, header_size) = ParseAtomHeader(data, position, end-position)
+        yield (type, position, size, header_size)
+        position += size
+
+def SetAtomSize(data, position, header_size, size):
+    if header_size == 16:
+        struct.pack_into('>Q', data, position+8, size)
+    else:
+        struct.pack_into('>I', data, position, size)
+
+def MakeAtom(header, children):
+    # header is the original header of the atom, with a size to update
+    atom = bytearray(header)+b''.join(children)
+    SetAtomSize(atom, 0, len(header), len(atom))
+    return bytes(atom)
+
+def GetTrakTrackId(trak):
+    (_, trak_size, trak_header_size) = ParseAtomHeader(trak, 0, len(trak))
+    for (type, position, size, header_size) in IterAtoms(trak, trak_header_size, trak_size):
+        if type == 'tkhd':
+            version = trak[position+header_size]
+            return struct.unpack_from('>I', trak, position+header_size+(20 if version == 1 else 12))[0]
+    return None
+
+def MakeSplitInitSegment(ftyp, moov, track_id):
+    (_, moov_size, moov_header_size) = ParseAtomHeader(moov, 0, len(moov))
+    children = []
+    for (type, position, size, header_size) in IterAtoms(moov, moov_header_size, moov_size):
+        child = moov[position:position+size]
+        if type == 'trak':
+            if GetTrakTrackId(child) != track_id:
+                continue
+        elif type == 'mvex':
+            mvex_children = []
+            for (mvex_child_type, mvex_child_position, mvex_child_size, _) in IterAtoms(child, header_size, size):
+                mvex_child = child[mvex_child_position:mvex_child_position+mvex_child_size]
+                if mvex_child_type == 'trex' and struct.unpack_from('>I', mvex_child, 12)[0] != track_id:
+                    continue
+                mvex_children.append(mvex_child)
+            child = MakeAtom(child[:header_size], mvex_children)
+        children.append(child)
+
+    return ftyp+MakeAtom(moov[:moov_header_size], children)
+
+def RebaseMoof(moof, moof_position):
+    moof = bytearray(moof)
+    (_, moof_size, moof_header_size) = ParseAtomHeader(moof, 0, len(moof))
+    for (type, position, size, header_size) in IterAtoms(moof, moof_header_size, moof_size):
+        if type != 'traf':
+            continue
+        for (traf_child_type, traf_child_position, _, traf_child_header_size) in IterAtoms(moof, position+header_size, position+size):
+            if traf_child_type != 'tfhd':
+                continue
+            flags = struct.unpack_from('>I', moof, traf_child_position+traf_child_header_size)[0] & 0xFFFFFF
+            if flags & 0x01: # base-data-offset-present
+                offset = traf_child_position+traf_child_header_size+8
+                base_data_offset = struct.unpack_from('>Q', moof, offset)[0]
+                struct.pack_into('>Q', moof, offset, base_data_offset-moof_position)
+    return moof
+
+def ReadFileData(file, position, size):
+    file.seek(position)
+    return file.read(size)
+
+def CopyFileData(source, destination, position, size):
+    # copy a range of a file without going through user space when possible
+    destination.flush()
+    while size > 0:
+        try:
+            if hasattr(os, 'copy_file_range'):
+                count = os.copy_file_range(source.fileno(), destination.fileno(), size, position)
+            else:
+                count = os.sendfile(destination.fileno(), source.fileno(), position, size)
+        except (OSError, AttributeError):
+            # not supported for these files or on this platform
+            count = destination.write(ReadFileData(source, position, min(size, 1024*1024)))
+            destination.flush()
+        if count == 0:
+            raise Exception('unexpected end of file')
+        position += count
+        size -= count
+
+def SplitMp4File(mp4_file, splits):
+    # splits maps track IDs to (init segment filename, media segment filename pattern) tuples,
+    # the pattern having a placeholder for the segment number, starting at 1
+    with open(mp4_file.media_source.filename, 'rb') as source:
+        ftyp = b''
+        for atom in mp4_file.atoms:
+            if atom.type == 'ftyp':
+                ftyp = ReadFileData(source, atom.position, atom.size)
+                break
+        moov = ReadFileData(source, mp4_file.init_segment.position, mp4_file.init_segment.size)
+        for (track_id, (init_segment_filename, _)) in splits.items():
+            with open(init_segment_filename, 'wb') as init_segment:
+                init_segment.write(MakeSplitInitSegment(ftyp, moov, track_id))
+
+        # map each fragment to its track and segment number
+        fragment_segments = {}
+        for track_id in splits:
+            track = mp4_file.tracks[track_id]
+            if track.fragment_moofs is None:
+                for (segment_number, segment_index) in enumerate(track.moofs, start=1):
+                    fragment_segments[segment_index] = (track_id, segment_number)
+            else:
+                fragments = iter(track.fragment_moofs)
+                for (segment_number, fragment_count) in enumerate(track.segment_fragment_counts, start=1):
+                    for _ in range(fragment_count):
+                        fragment_segments[next(fragments)] = (track_id, segment_number)
+
+        # the fragments of a segment are appended to its file in order (the fragments
+        # of different tracks may be interleaved)
+        segment_positions = {} # track ID -> (segment number, number of bytes written)
+        for (segment_index, segment) in enumerate(mp4_file.segments):
+            if segment_index not in fragment_segments:
+                continue
+            (track_id, segment_number) = fragment_segments[segment_index]
+            moof = segment[0]
+            mdats = [atom for atom in segment if atom.type == 'mdat']
+            end = mdats[-1].position+mdats[-1].size if mdats else moof.position+moof.size
+
+            (current_segment_number, position) = segment_positions.get(track_id, (0, 0))
+            if segment_number != current_segment_number:
+                position = 0
+            media_segment_filename = splits[track_id][1] % segment_number
+            with open(media_segment_filename, 'ab' if position else 'wb') as media_segment:
+                media_segment.write(RebaseMoof(ReadFileData(source, moof.position, moof.size), moof.position-position))
+                CopyFileData(source, media_segment, moof.position+moof.size, end-moof.position-moof.size)
+            segment_positions[track_id] = (segment_number, position+end-moof.position)
+
+#############################################
+# Live sources
+#
+# A live source is a fragmented MP4 stream that is still being written: either
+# a file that grows, or a directory where the stream is written as a sequence
+# of files (an init segment followed by media segments or CMAF chunks), in
+# name order. The reader only returns complete atoms and fragments, and picks
+# up where it left off on the next call, so each part of the stream is only
+# read once, however long it gets.
+#############################################
+class Mp4LiveFragment:
+    def __init__(self, track_id, decode_time, duration, sample_count, starts_with_sync_sample, moof, moof_position, atoms):
+        self.track_id                = track_id
+        self.decode_time             = decode_time # None when the fragment has no 'tfdt'
+        self.duration                = duration
+        self.sample_count            = sample_count
+        self.starts_with_sync_sample = starts_with_sync_sample
+        self.moof                    = moof
+        self.moof_position           = moof_position
+        self.atoms                   = atoms # (filename, position, size) of the atoms that follow the 'moof'
+        self.size                    = len(moof)+sum([size for (_, _, size) in atoms])
+
+    def write(self, destination, position=0):
+        # write the fragment at a given position in a new file
+        destination.write(RebaseMoof(self.moof, self.moof_position-position))
+        for (filename, atom_position, atom_size) in self.atoms:
+            with open(filename, 'rb') as source:
+                CopyFileData(source, destination, atom_position, atom_size)
+
+class Mp4LiveReader:
+    def __init__(self, source):
+        self.source       = source
+        self.is_directory = path.isdir(source)
+        self.filename     = None if self.is_directory else source
+        self.position     = 0
+        self.ftyp         = b''
+        self.moov         = None
+        self.track_ids    = []
+        self.timescales   = {} # by track ID
+        self.trex         = {} # default sample duration, size and flags, by track ID
+        self.moof         = None
+        self.moof_atoms   = []
+
+    def next_file(self):
+        # the files of a directory are read in name order, skipping hidden files
+        names = sorted([name for name in os.listdir(self.source) if not name.startswith('.')])
+        current = path.basename(self.filename) if self.filename else None
+        for name in names:
+            if current is None or name > current:
+                self.filename = path.join(self.source, name)
+                self.position = 0
+                return True
+        return False
+
+    def read_atoms(self):
+        # returns the (filename, type, position, size) of the complete top-level atoms that were
+        # added to the stream since the last call
+        atoms = []
+        while self.filename is not None or self.next_file():
+            with open(self.filename, 'rb') as file:
+                file_size = os.fstat(file.fileno()).st_size
+                while self.position+8 <= file_size:
+                    header = ReadFileData(file, self.position, 16)
+                    (size, type) = struct.unpack_from('>I4s', header)
+                    if size == 1:
+                        if len(header) < 16:
+                            break
+                        size = struct.unpack_from('>Q', header, 8)[0]
+                    elif size == 0:
+                        # the atom extends to the end of the stream, which is not known yet
+                        break
+                    if size < 8:
+                        raise Exception('invalid atom size in '+self.filename)
+                    if self.position+size > file_size:
+                        break
+                    atoms.append((self.filename, type.decode('latin-1'), self.position, size))
+                    self.position += size
+
+            # a file of a directory is complete once the next one exists
+            if not self.is_directory or self.position < file_size or not self.next_file():
+                break
+        return atoms
+
+    def parse_moov(self):
+        moov = ParseAtom(self.moov, 0, len(self.moov))
+        for trak in FilterChildren(moov, 'trak'):
+            track_id = FindChild(trak, ['tkhd'])['id']
+            self.track_ids.append(track_id)
+            self.timescales[track_id] = FindChild(trak, ['mdia', 'mdhd'])['timescale']
+        for trex in FilterChildren(FindChild(moov, ['mvex']) or [], 'trex'):
+            self.trex[trex['track id']] = (trex['default sample duration'], trex['default sample size'], trex['default sample flags'])
+
+    def make_fragment(self):
+        (filename, moof, moof_position) = self.moof
+        trafs = FilterChildren(ParseAtom(moof, 0, len(moof)), 'traf')
+        if len(trafs) != 1:
+            raise Exception('unsupported live input, more than one "traf" box in fragment')
+        tfhd = FindChild(trafs[0], ['tfhd'])
+        tfdt = FindChild(trafs[0], ['tfdt'])
+        track_id = tfhd['track ID']
+        (default_sample_duration, default_sample_size, default_sample_flags) = self.trex.get(track_id, (0, 0, 0))
+        default_sample_duration = tfhd.get('default sample duration', default_sample_duration)
+        duration = 0
+        sample_count = 0
+        starts_with_sync_sample = False
+        for trun in FilterChildren(trafs[0], 'trun'):
+            if not sample_count and trun['sample count']:
+                (_, _, flags) = GetTrunSamples(trun,
+                                               default_sample_duration,
+                                               tfhd.get('default sample size', default_sample_size),
+                                               tfhd.get('default sample flags', default_sample_flags))
+                starts_with_sync_sample = not flags[0] & 0x10000 # sample_is_non_sync_sample
+            duration += ComputeTrunDuration(trun, default_sample_duration)
+            sample_count += trun['sample count']
+        return Mp4LiveFragment(track_id,
+                               tfdt['base media decode time'] if tfdt else None,
+                               duration,
+                               sample_count,
+                               starts_with_sync_sample,
+                               moof,
+                               moof_position,
+                               self.moof_atoms)
+
+    def read_fragments(self):
+        # returns the fragments that were completed since the last call
+        fragments = []
+        for (filename, type, position, size) in self.read_atoms():
+            if type in ['ftyp', 'moov', 'moof']:
+                with open(filename, 'rb') as file:
+                    data = ReadFileData(file, position, size)
+                if type == 'ftyp':
+                    self.ftyp = data
+                elif type == 'moov':
+                    self.moov = data
+                    self.parse_moov()
+                else:
+                    self.moof = (filename, data, position)
+                    self.moof_atoms = []
+            elif self.moof:
+                # a fragment ends with its 'mdat', other atoms before the next 'moof' are dropped
+                self.moof_atoms.append((filename, position, size))
+                if type == 'mdat':
+                    fragments.append(self.make_fragment())
+                    self.moof = None
+        return fragments
+
+class LiveSegmentIndex:
+    """
+    Index of the segments of a live track that are in its time shift window.
+    Segments are only added at the end and dropped from the start, so
+    the cost of keeping the index up to date does not depend on how long
+    the track has been running.
+    A segment can be built from several parts (CMAF chunks), in which case
+    the parts of the last segment are indexed as they arrive, and the
+    segment is complete when it is closed.
+    """
+    def __init__(self, timescale, window=0.0):
+        self.timescale     = timescale
+        self.window        = int(window*timescale) # 0 for an unlimited window
+        self.segments      = collections.deque() # (number, start time, duration, size, parts)
+        self.next_number   = 1
+        self.end_time      = 0
+        self.parts         = [] # (duration, offset, size, independent) of the parts of the next segment
+        self.open_time     = 0
+        self.open_duration = 0
+        self.open_size     = 0
+
+    def add_part(self, time, duration, size, independent):
+        # time is None when the part directly follows the previous one
+        if not self.parts:
+            self.open_time = self.end_time if time is None else time
+        self.parts.append((duration, self.open_size, size, independent))
+        self.open_duration += duration
+        self.open_size += size
+
+    def close(self):
+        # complete the segment made of the parts added since the last call
+        if not self.parts:
+            return
+        self.segments.append((self.next_number, self.open_time, self.open_duration, self.open_size, self.parts))
+        self.next_number += 1
+        self.end_time = self.open_time+self.open_duration
+        self.parts = []
+        self.open_duration = 0
+        self.open_size = 0
+        if self.window:
+            while self.segments[0][1]+self.segments[0][2] <= self.end_time-self.window:
+                self.segments.popleft()
+
+    def add(self, time, duration, size, independent=True):
+        # add a complete segment, made of a single part
+        self.close()
+        self.add_part(time, duration, size, independent)
+        self.close()
+
+    def first_number(self):
+        return self.segments[0][0] if self.segments else self.next_number
+
+    def start_time(self):
+        return self.segments[0][1] if self.segments else self.open_time if self.parts else self.end_time
+
+    def edge_time(self):
+        # end of the last part
+        return self.open_time+self.open_duration if self.parts else self.end_time
+
+#############################################
+# Analysis cache
+#
+# Keeps the output of 'mp4info' and the segment tables computed by Mp4File,
+# so that running the tools again on the same files does not need to analyze
+# them again. Entries are keyed by the path, size and modification time of
+# the file, and a hash of a few chunks of its content. Each entry is written
+# to a temporary file that is then renamed, so concurrent runs can share the
+# same cache directory, and the least recently used entries are removed
+# when the total size of the cache exceeds its limit.
+#############################################
+FILE_IDENTITY_CHUNK_SIZE = 65536
+
+def GetFileIdentity(filename):
+    # cheap identity: path, size, modification time and a hash of a few chunks
+    filename = path.abspath(filename)
+    stat = os.stat(filename)
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for position in sorted(set([0,
+                                    max(0, (stat.st_size-FILE_IDENTITY_CHUNK_SIZE)//2),
+                                    max(0, stat.st_size-FILE_IDENTITY_CHUNK_SIZE)])):
+            file.seek(position)
+            digest.update(file.read(FILE_IDENTITY_CHUNK_SIZE))
+    return '{}:{}:{}:{}'.format(filename, stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+def GetFileDigest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        while True:
+            chunk = file.read(1024*1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+#############################################
+ANALYSIS_CACHE_VERSION       = 2
+ANALYSIS_CACHE_MAGIC         = b'B4AC'
+ANALYSIS_CACHE_MAX_SIZE      = 256*1024*1024
+ANALYSIS_CACHE_TRACK_FIELDS  = ['timescale', 'default_sample_duration', 'default_sample_size', 'default_sample_flags']
+ANALYSIS_CACHE_TRACK_TABLES  = ['moofs', 'sample_counts', 'segment_offsets', 'segment_lengths', 'segment_sizes',
+                                'segment_sample_counts', 'segment_durations', 'segment_scaled_durations', 'segment_bitrates',
+                                'segment_iframe_offsets', 'segment_iframe_sizes']
+ANALYSIS_CACHE_SAMPLE_TABLES = ['sample_durations', 'sample_sizes', 'sample_sync_flags']
+
+class AnalysisCache:
+    def __init__(self, cache_dir, max_size=ANALYSIS_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_identity(self, filename):
+        return GetFileIdentity(filename)
+
+    def get_entry_path(self, identity, kind):
+        key = hashlib.sha1((str(ANALYSIS_CACHE_VERSION)+':'+identity).encode('utf-8')).hexdigest()
+        return path.join(self.cache_dir, key+'.'+kind)
+
+    def load(self, filename, kind):
+        # returns a (header, payload) tuple, or None if there is no valid entry
+        try:
+            identity = self.get_identity(filename)
+            entry_path = self.get_entry_path(identity, kind)
+            with open(entry_path, 'rb') as file:
+                data = file.read()
+            if data[:4] != ANALYSIS_CACHE_MAGIC:
+                return None
+            header_size = struct.unpack_from('>I', data, 4)[0]
+            header = json.loads(data[8:8+header_size].decode('utf-8'))
+            if header.get('identity') != identity:
+                return None
+
+            # mark the entry as recently used
+            os.utime(entry_path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+        return (header, memoryview(data)[8+header_size:])
+
+    def store(self, filename, kind, header, payload=b''):
+        temp_path = None
+        try:
+            header['identity'] = self.get_identity(filename)
+            header_data = json.dumps(header).encode('utf-8')
+            (temp_fd, temp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(temp_fd, 'wb') as file:
+                file.write(ANALYSIS_CACHE_MAGIC)
+                file.write(struct.pack('>I', len(header_data)))
+                file.write(header_data)
+                file.write(payload)
+            os.replace(temp_path, self.get_entry_path(header['identity'], kind))
+        except OSError:
+            # the cache is only an optimization, not being able to update it is not an error
+            if temp_path and path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            if not (name.endswith('.info') or name.endswith('.tables')):
+                continue
+            try:
+                stat = os.stat(path.join(self.cache_dir, name))
+            except OSError:
+                continue # removed by another process
+            entries.append((stat.st_mtime, name, stat.st_size))
+            total_size += stat.st_size
+
+        for (_, name, size) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total_size -= size
+
+    def load_info(self, filename):
+        entry = self.load(filename, 'info')
+        if entry is None:
+            return None
+        return entry[0]['mp4_info']
+
+    def store_info(self, filename, json_info):
+        if isinstance(json_info, bytes):
+            json_info = json_info.decode('utf-8')
+        self.store(filename, 'info', {'mp4_info': json_info})
+
+    def load_analysis(self, mp4_file, sample_tables):
+        entry = self.load(mp4_file.media_source.filename, 'tables')
+        if entry is None:
+            return False
+        (header, payload) = entry
+        if sample_tables and not header['sample_tables']:
+            return False
+        if sorted([track_info['id'] for track_info in header['tracks']]) != sorted(mp4_file.tracks.keys()):
+            return False
+
+        # decode all the tables before updating the tracks
+        track_tables = {}
+        offset = 0
+        for track_info in header['tracks']:
+            tables = {}
+            for (name, typecode, count) in track_info['tables']:
+                table = array.array(typecode)
+                end = offset+count*table.itemsize
+                if end > len(payload):
+                    return False
+                table.frombytes(payload[offset:end])
+                if header['byteorder'] != sys.byteorder:
+                    table.byteswap()
+                tables[name] = table
+                offset = end
+            track_tables[track_info['id']] = tables
+
+        for track_info in header['tracks']:
+            track = mp4_file.tracks[track_info['id']]
+            for field in ANALYSIS_CACHE_TRACK_FIELDS:
+                setattr(track, field, track_info[field])
+            track.key_info.update(track_info['key_info'])
+            for (name, table) in track_tables[track.id].items():
+                if name in ANALYSIS_CACHE_SAMPLE_TABLES and not sample_tables:
+                    continue
+                setattr(track, name, table)
+
+        return True
+
+    def store_analysis(self, mp4_file):
+        header = {'byteorder': sys.byteorder, 'sample_tables': True, 'tracks': []}
+        payload = []
+        for track in mp4_file.tracks.values():
+            track_info = {'id': track.id, 'key_info': track.key_info, 'tables': []}
+            for field in ANALYSIS_CACHE_TRACK_FIELDS:
+                track_info[field] = getattr(track, field)
+            for name in ANALYSIS_CACHE_TRACK_TABLES+ANALYSIS_CACHE_SAMPLE_TABLES:
+                table = getattr(track, name)
+                if table is None:
+                    header['sample_tables'] = False
+                    continue
+                track_info['tables'].append((name, table.typecode, len(table)))
+                payload.append(table.tobytes())
+            header['tracks'].append(track_info)
+
+        self.store(mp4_file.media_source.filename, 'tables', header, b''.join(payload))
+
+#############################################
+LINK_MODES = ['auto', 'copy', 'move', 'hardlink', 'reflink']
+FICLONE    = 0x40049409 # Linux ioctl to share the extents of a file (btrfs, XFS, ...)
+
+def CloneFile(source, destination):
+    if fcntl is None:
+        raise OSError('cloning is not supported on this platform')
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+def CopyFileRange(source, destination):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError('copy_file_range is not supported on this platform')
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        size = os.fstat(source_file.fileno()).st_size
+        while size > 0:
+            count = os.copy_file_range(source_file.fileno(), destination_file.fileno(), size)
+            if count == 0:
+                raise OSError('unexpected end of file')
+            size -= count
+
+def GetUmask():
+    # read it without changing it when possible, since the umask is shared by all the
+    # threads of the process, which may be creating files
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+def PlaceFile(source, destination, link_mode='copy', temporary=False):
+    # put the content of a file at its destination, without copying the data when
+    # possible: temporary files are moved, other files are hard-linked or cloned,
+    # falling back to a plain copy. Returns how the file was placed.
+    if temporary and link_mode != 'copy':
+        try:
+            os.replace(source, destination)
+        except OSError:
+            pass # not on the same filesystem
+        else:
+            # temporary files are only readable by their owner, give the file the
+            # permissions that a copy would have
+            os.chmod(destination, 0o666 & ~GetUmask())
+            return 'move'
+
+    if link_mode == 'hardlink':
+        try:
+            if path.exists(destination):
+                os.remove(destination)
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    if link_mode in ['reflink', 'auto']:
+        try:
+            CloneFile(source, destination)
+            return 'reflink'
+        except OSError:
+            pass
+
+    if link_mode == 'auto':
+        try:
+            CopyFileRange(source, destination)
+            return 'copy_file_range'
+        except OSError:
+            pass
+
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+#############################################
+BUILD_MANIFEST_VERSION  = 1
+BUILD_MANIFEST_NAME     = '.build-manifest.json'
+BUILD_MANIFEST_WORK_DIR = '.build-work'
+
+class BuildManifest:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.filename   = path.join(output_dir, BUILD_MANIFEST_NAME)
+        self.work_dir   = path.join(output_dir, BUILD_MANIFEST_WORK_DIR)
+        self.lock       = threading.Lock()
+        self.options    = {}
+        self.inputs     = {}
+        self.tasks      = {} # tasks run or verified by this build
+        self.previous   = {} # tasks recorded by the previous build
+
+        try:
+            with open(self.filename) as file:
+                manifest = json.load(file)
+            if manifest.get('version') == BUILD_MANIFEST_VERSION:
+                self.previous = manifest['tasks']
+        except (OSError, ValueError, KeyError):
+            pass # no usable manifest, everything will be rebuilt
+
+        # index the outputs of the previous build by path
+        self.previous_outputs = {}
+        for task in self.previous.values():
+            self.previous_outputs.update(task['outputs'])
+
+        os.makedirs(self.work_dir, exist_ok=True)
+
+    def set_options(self, options, excluded=[], secret=[]):
+        # record the effective options, with a digest in place of any secret value
+        self.options = {}
+        for (name, value) in sorted(vars(options).items()):
+            if name in excluded or not isinstance(value, (str, int, float, bool, list, dict, type(None))):
+                continue
+            if name in secret and value is not None:
+                value = 'sha256:'+hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()
+            self.options[name] = value
+
+    def set_inputs(self, filenames):
+        self.inputs = dict([(filename, GetFileIdentity(filename)) for filename in filenames])
+
+    def get_work_filename(self, name):
+        return path.join(self.work_dir, hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]+'.mp4')
+
+    def get_task_key(self, inputs, parameters):
+        task_input = {'inputs': [GetFileIdentity(filename) for filename in inputs], 'parameters': parameters}
+        return hashlib.sha256(json.dumps(task_input, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def is_up_to_date(self, name, key):
+        task = self.previous.get(name)
+        if task is None or task['key'] != key:
+            return False
+        for (output, output_info) in task['outputs'].items():
+            try:
+                stat = os.stat(path.join(self.output_dir, output))
+            except OSError:
+                return False
+            if stat.st_size != output_info['size'] or stat.st_mtime_ns != output_info['mtime_ns']:
+                return False
+        return True
+
+    def list_files(self, root):
+        files = {}
+        if path.isdir(root):
+            for (dir_path, dir_names, file_names) in os.walk(root):
+                if path.samefile(dir_path, self.output_dir):
+                    dir_names[:] = [x for x in dir_names if x != BUILD_MANIFEST_WORK_DIR]
+                    file_names = [x for x in file_names if x != BUILD_MANIFEST_NAME]
+                for file_name in file_names:
+                    file_path = path.join(dir_path, file_name)
+                    stat = os.stat(file_path)
+                    files[file_path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def run(self, name, inputs, outputs, parameters, function, *args, **kwargs):
+        # run a task, unless the previous build has already produced its outputs from
+        # the same inputs and parameters (tasks with no parameters always run)
+        key = None
+        if parameters is not None:
+            key = self.get_task_key(inputs, parameters)
+            if self.is_up_to_date(name, key):
+                with self.lock:
+                    self.tasks[name] = self.previous[name]
+                return None
+
+        # the outputs of a task are its output files, plus any file that it creates
+        # or modifies in its output directories
+        before = {}
+        for output in outputs:
+            before.update(self.list_files(output))
+        result = function(*args, **kwargs)
+        output_files = []
+        for output in outputs:
+            if path.isdir(output):
+                output_files += [x for (x, info) in self.list_files(output).items() if before.get(x) != info]
+            else:
+                output_files.append(output)
+
+        self.record(name, key, output_files)
+        return result
+
+    def record(self, name, key, output_files):
+        task = {'key': key, 'outputs': {}}
+        for output_file in sorted(output_files):
+            output = path.relpath(output_file, self.output_dir).replace(os.sep, '/')
+            digest = GetFileDigest(output_file)
+
+            # keep the modification time of outputs that have not changed,
+            # so that their HTTP validators (ETag, Last-Modified) stay the same.
+            # Hard-linked outputs are left alone: their modification time is that
+            # of the input they share their data with, which must not be changed
+            previous_output_info = self.previous_outputs.get(output)
+            if previous_output_info and previous_output_info['digest'] == digest and os.stat(output_file).st_nlink == 1:
+                os.utime(output_file, ns=(os.stat(output_file).st_atime_ns, previous_output_info['mtime_ns']))
+
+            stat = os.stat(output_file)
+            task['outputs'][output] = {'digest': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        with self.lock:
+            self.tasks[name] = task
+            self.save()
+
+    def save(self):
+        # tasks of the previous build that have not been run yet are kept, so that
+        # an interrupted build can resume where it stopped
+        tasks = dict(self.previous)
+        tasks.update(self.tasks)
+        manifest = {'version': BUILD_MANIFEST_VERSION,
+                    'options': self.options,
+                    'inputs':  self.inputs,
+                    'tasks':   tasks}
+        (temp_fd, temp_path) = tempfile.mkstemp(dir=self.work_dir, suffix='.tmp')
+        with os.fdopen(temp_fd, 'w') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.filename)
+
+    def finish(self):
+        # remove the outputs of the previous build that this build no longer produces
+        outputs = set()
+        for task in self.tasks.values():
+            outputs.update(task['outputs'].keys())
+        for output in set(self.previous_outputs.keys())-outputs:
+            try:
+                os.remove(path.join(self.output_dir, output))
+                os.removedirs(path.dirname(path.join(self.output_dir, output))) # only removes empty directories
+            except OSError:
+                pass
+
+        with self.lock:
+            self.previous = {}
+            self.save()
+
+#############################################
 def ComputeBandwidth(buffer_time, sizes, durations):
+    # Leaky bucket model: for each starting point i, the windows i..j are checked
+    # in order until one of them needs more than the current bandwidth (given a buffer
+    # of buffer_time*bandwidth bits), in which case the bandwidth is raised.
+    # Checking every window is quadratic, so the starting points from which no window
+    # can exceed the current bandwidth are skipped, using, for each starting point,
+    # the largest excess 8*size-bandwidth*duration of the windows that start there.
+    # Those excesses only decrease when the bandwidth increases, so they are only
+    # recomputed when they no longer allow skipping.
+    # This is a pruned version of the quadratic walk, not a linear one: each increase
+    # of the bandwidth can still lead to a full rescan, so the worst case is quadratic.
     bandwidth = 0.0
-    for i in range(len(sizes)):
+    count = len(sizes)
+    max_excesses = None
+    tolerance = 0.0
+    for i in range(count):
+        if max_excesses is not None and max_excesses[i] < buffer_time*bandwidth-tolerance:
+            continue
         accu_size     = 0
         accu_duration = 0
         buffer_size = (buffer_time*bandwidth)/8.0
-        for j in range(i, len(sizes)):
+        for j in range(i, count):
             accu_size     += sizes[j]
             accu_duration += durations[j]
             max_avail = buffer_size+accu_duration*bandwidth/8.0
             if accu_size > max_avail and accu_duration != 0:
                 bandwidth = 8.0*(accu_size-buffer_size)/accu_duration
                 break
+        else:
+            # no window starting here needed more, update the excesses for the current bandwidth
+            max_excesses = array.array('d', bytes(8*count))
+            max_excess = 0.0
+            for k in range(count-1, i, -1):
+                max_excess = 8.0*sizes[k]-bandwidth*durations[k]+max(max_excess, 0.0)
+                max_excesses[k] = max_excess
+            # allow for rounding errors, since the sums above are not computed in the same order
+            tolerance = 1e-9*(8.0*sum(sizes)+bandwidth*(sum(durations)+buffer_time))
+    return int(bandwidth)
+
+def ComputeSlidingWindowBandwidth(buffer_time, sizes, durations):
+    # Smallest bandwidth such that every window of consecutive entries can be delivered
+    # within its duration plus buffer_time, i.e the max of 8*size/(buffer_time+duration)
+    # over all the windows (windows with buffer_time+duration = 0, which cannot be
+    # delivered at any bandwidth, are ignored, like ComputeBandwidth does).
+    # For a candidate bandwidth, the window with the largest excess 8*size-bandwidth*duration
+    # is found in a single pass, and its ratio becomes the next candidate, until no window
+    # needs more (this converges in a few passes).
+    bandwidth = 0.0
+    while True:
+        best_excess   = 0.0
+        best_size     = 0
+        best_duration = 0.0
+        # window with the largest excess that ends at the current entry, and, when buffer_time
+        # is 0, the same among the windows with a zero duration, which do not count but may be
+        # extended into windows that do
+        has_window       = False
+        has_empty_window = False
+        for (size, duration) in zip(sizes, durations):
+            entry_excess = 8.0*size-bandwidth*duration
+            if buffer_time+duration > 0.0:
+                if has_empty_window and empty_excess > 0.0 and (not has_window or empty_excess > excess):
+                    # extend the zero-duration window
+                    excess        = empty_excess
+                    accu_size     = empty_size
+                    accu_duration = empty_duration
+                elif not has_window or excess <= 0.0:
+                    # start a new window here
+                    excess        = 0.0
+                    accu_size     = 0
+                    accu_duration = 0.0
+                excess        += entry_excess
+                accu_size     += size
+                accu_duration += duration
+                has_window       = True
+                has_empty_window = False
+            else:
+                if not has_empty_window or empty_excess <= 0.0:
+                    empty_excess   = 0.0
+                    empty_size     = 0
+                    empty_duration = 0.0
+                empty_excess   += entry_excess
+                empty_size     += size
+                empty_duration += duration
+                has_empty_window = True
+                if has_window:
+                    excess        += entry_excess
+                    accu_size     += size
+                    accu_duration += duration
+            if has_window and excess > best_excess:
+                best_excess   = excess
+                best_size     = accu_size
+                best_duration = accu_duration
+        if best_excess <= bandwidth*buffer_time:
+            break
+        next_bandwidth = 8.0*best_size/(buffer_time+best_duration)
+        if next_bandwidth <= bandwidth:
+            break
+        bandwidth = next_bandwidth
     return int(bandwidth)
 
 def MakeNewDir(dir, exit_if_exists=False, severity=None, recursive=False):
     if path.exists(dir):
+        if exit_if_exists:
+            raise Exception('directory "'+dir+'" already exists')
         if severity:
             sys.stderr.write(severity+': ')
             sys.stderr.write('directory "'+dir+'" already exists\n')
-        if exit_if_exists:
-            sys.exit(1)
     elif recursive:
         os.makedirs(dir)
     else:
@@ -1312,6 +3121,7 @@ __all__ = [
     'LanguageNames',
     'PrintErrorAndExit',
     'XmlDuration',
+    'XmlDateTime',
     'Base64Encode',
     'Base64Decode',
     'Bento4Command',
@@ -1322,12 +3132,25 @@ __all__ = [
     'Mp4Encrypt',
     'Mp42Hls',
     'Mp4IframeIndex',
+    'SplitMp4File',
+    'Mp4LiveReader',
+    'LiveSegmentIndex',
+    'JobRunner',
+    'StartTrace',
+    'TraceStage',
+    'SaveTrace',
     'WalkAtoms',
+    'Mp4AtomIndex',
+    'ParseMp4Atoms',
     'Mp4Track',
     'Mp4File',
     'MediaSource',
+    'AnalysisCache',
+    'BuildManifest',
     'ComputeBandwidth',
+    'ComputeSlidingWindowBandwidth',
     'MakeNewDir',
+    'PlaceFile',
     'MakePsshBox',
     'MakePsshBoxV1',
     'GetEncryptionKey',